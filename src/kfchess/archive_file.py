@@ -0,0 +1,285 @@
+"""
+archive_file.py
+
+An append-only file format for finished games, for analytics and replays without redis or MySQL.
+
+An archive is two files: <path>.dat holds the games one after the other, and <path>.idx holds a
+fixed-size index record per game (game id, offset in the data file). All numbers are little-endian.
+
+    index record    game_id u64, offset u64
+
+    game record     length u32 (of the whole record), game_id u64, start_time i64 (ms since epoch),
+                    duration u32 (ms), cd u32 (ms), moves u32, state u8 (index in kfc.STATES),
+                    white, black and nfen lengths u16 each,
+                    then white and black (utf-8), the starting nfen (ascii),
+                    then moves of 6 bytes each: squares u16, time u32 (ms since the start)
+
+A move's squares pack from (0 to 63, a1 to h8) in bits 0-5, to in bits 6-11 and the promotion in
+bits 12-14 (see PROMOTIONS). Player ids are stored as strings, and read back as strings.
+
+The writer appends games in batches: the data of a batch is written (and synced) before its index
+records, so only indexed games are ever read, and an interrupted batch is dropped when the archive
+is opened again. A game archived twice is indexed twice, lookups by id return the last one.
+
+The reader memory-maps both files. Lookups by id go through a dictionary built from the index the
+first time one is made, and scans walk the data file in order. Games are decoded from the map
+without copying it, and their moves only once asked for, so a scan is bound by I/O.
+
+    python -m kfchess.archive_file <path> [<game_id>]
+
+prints a game as JSON, or counts the games of the archive by state.
+"""
+import json
+import mmap
+import os
+import struct
+import time
+from collections import Counter
+
+import kfchess.game as kfc
+
+INDEX   = struct.Struct("<QQ")
+HEADER  = struct.Struct("<IQqIIIBHHH")
+MOVE    = struct.Struct("<HI")
+LENGTH  = struct.Struct("<I")
+
+PROMOTIONS = [None, kfc.QUEEN, kfc.ROOK, kfc.BISHOP, kfc.KNIGHT]
+
+NO_STATE = 255
+
+MAX_STRING = 0xFFFF
+
+FILES = "abcdefgh"
+
+def square_index(san):
+    return FILES.index(san[0]) + 8 * (int(san[1]) - 1)
+
+def square_san(index):
+    return "{}{}".format(FILES[index % 8], index // 8 + 1)
+
+def pack_move(entry):
+    """ Pack a history entry ("e7e8q@1234", see RedisKungFuBoard.history) into a move. """
+    move, at = entry.split("@")
+    squares = square_index(move[0:2]) | square_index(move[2:4]) << 6 | \
+              PROMOTIONS.index(move[4:] or None) << 12
+    return MOVE.pack(squares, int(float(at)))
+
+def encode_game(record):
+    """ Encode an archive record of a finished game (see prepare_archive_record) as a game record.
+
+    Raise ValueError if a player id or the nfen is longer than MAX_STRING bytes. """
+    white = str(record["white"]).encode() if record.get("white") is not None else b""
+    black = str(record["black"]).encode() if record.get("black") is not None else b""
+    nfen  = (record.get("start_nfen") or kfc.STARTING_NFEN).encode()
+    if max(len(white), len(black), len(nfen)) > MAX_STRING:
+        raise ValueError("Players or nfen of game {} too long to archive".format(record["game_id"]))
+    moves = b"".join(pack_move(entry) for entry in record["history"])
+    state = kfc.STATES.index(record["state"]) if record["state"] in kfc.STATES else NO_STATE
+    start, end = record.get("start_time"), record.get("end_time")
+    length = HEADER.size + len(white) + len(black) + len(nfen) + len(moves)
+    header = HEADER.pack(length, int(record["game_id"]), start if start is not None else -1,
+                         end - start if start is not None and end is not None else 0,
+                         record.get("cd") or 0, len(moves) // MOVE.size, state,
+                         len(white), len(black), len(nfen))
+    return header + white + black + nfen + moves
+
+class ArchivedGame():
+    """ A game read from an archive, from a buffer holding its record. Only the header is decoded
+    up front, the players, nfen and moves only when asked for. """
+
+    __slots__ = ["game_id", "start_time", "duration", "cd", "state", "_buf", "_at", "_lengths", "_count"]
+
+    def __init__(self, buf, offset):
+        (_, self.game_id, start, self.duration, self.cd, self._count, state,
+         white, black, nfen) = HEADER.unpack_from(buf, offset)
+        self.start_time = start if start >= 0 else None
+        self.state      = kfc.STATES[state] if state != NO_STATE else None
+        self._buf       = buf
+        self._at        = offset + HEADER.size
+        self._lengths   = (white, black, nfen)
+
+    def _string(self, i):
+        at = self._at + sum(self._lengths[:i])
+        return str(self._buf[at:at + self._lengths[i]], "utf-8") if self._lengths[i] else None
+
+    @property
+    def white(self):
+        return self._string(0)
+
+    @property
+    def black(self):
+        return self._string(1)
+
+    @property
+    def nfen(self):
+        """ The nfen the game started from. """
+        return self._string(2)
+
+    def __len__(self):
+        """ Number of moves of the game. """
+        return self._count
+
+    @property
+    def moves(self):
+        """ The moves of the game, as (from, to, promotion, time since start) tuples. """
+        start = self._at + sum(self._lengths)
+        return [(square_san(squares & 63), square_san(squares >> 6 & 63), PROMOTIONS[squares >> 12], at)
+                for squares, at in MOVE.iter_unpack(self._buf[start:start + self._count * MOVE.size])]
+
+    @property
+    def history(self):
+        """ The moves of the game as in RedisKungFuBoard.history. """
+        return ["{}{}{}@{}".format(f, t, p or "", at) for f, t, p, at in self.moves]
+
+    def to_dict(self):
+        return {"game_id": self.game_id, "white": self.white, "black": self.black,
+                "state": self.state, "cd": self.cd, "start_nfen": self.nfen, "history": self.history,
+                "start_time": self.start_time, "duration": self.duration}
+
+def open_map(f):
+    """ Memory-map an open file for reading, b"" if it's empty (which can't be mapped). """
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+        return b""
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+def indexed_size(index_size):
+    """ Size of the index without a partly written last record. """
+    return index_size - index_size % INDEX.size
+
+def data_end(idx, dat):
+    """ End of the data of the last indexed game, from the index and data buffers. """
+    count = indexed_size(len(idx)) // INDEX.size
+    if not count:
+        return 0
+    _, offset = INDEX.unpack_from(idx, (count - 1) * INDEX.size)
+    return offset + LENGTH.unpack_from(dat, offset)[0]
+
+class ArchiveWriter():
+    """ Appends games to an archive, in batches of up to batch_size games. """
+
+    def __init__(self, path, batch_size=1000):
+        self._batch_size = batch_size
+        self._pending    = []  # (game_id, encoded game)
+        self._dat = open(path + ".dat", "ab+")
+        self._idx = open(path + ".idx", "ab+")
+        self._recover()
+        self.written = 0
+
+    def _recover(self):
+        """ Drop what an interrupted batch left past the last indexed game. """
+        idx, dat = open_map(self._idx), open_map(self._dat)
+        end, index_size = data_end(idx, dat), indexed_size(len(idx))
+        for buf in (idx, dat):
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+        self._idx.truncate(index_size)
+        self._dat.truncate(end)
+        self._offset = end
+
+    def append(self, record):
+        """ Add a game (an archive record, see prepare_archive_record), written with its batch. """
+        self._pending.append((int(record["game_id"]), encode_game(record)))
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Write the pending games, their data before their index records. """
+        if not self._pending:
+            return
+        index = []
+        offset = self._offset
+        for game_id, game in self._pending:
+            index.append(INDEX.pack(game_id, offset))
+            offset += len(game)
+        self._dat.write(b"".join(game for _, game in self._pending))
+        self._dat.flush()
+        os.fsync(self._dat.fileno())
+        self._idx.write(b"".join(index))
+        self._idx.flush()
+        self._offset = offset
+        self.written += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._dat.close()
+        self._idx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ArchiveReader():
+    """ Reads games of an archive, memory-mapped. """
+
+    def __init__(self, path):
+        self._files = [open(path + ".idx", "rb"), open(path + ".dat", "rb")]
+        self._maps  = [open_map(f) for f in self._files]
+        # games are decoded from views of the maps, as slicing a map copies
+        self._idx, self._dat = [memoryview(m) for m in self._maps]
+        self._count = indexed_size(len(self._idx)) // INDEX.size
+        self._end   = data_end(self._idx, self._dat)
+        self._offsets = None  # game_id -> offset, built on the first lookup
+
+    def __len__(self):
+        return self._count
+
+    def ids(self):
+        """ Game ids in the order they were archived. """
+        for game_id, _ in INDEX.iter_unpack(self._idx[:self._count * INDEX.size]):
+            yield game_id
+
+    def get(self, game_id):
+        """ Return the game game_id, or None if it isn't archived. """
+        if self._offsets is None:
+            self._offsets = {game_id: offset for game_id, offset
+                             in INDEX.iter_unpack(self._idx[:self._count * INDEX.size])}
+        offset = self._offsets.get(game_id)
+        return ArchivedGame(self._dat, offset) if offset is not None else None
+
+    def __contains__(self, game_id):
+        return self.get(game_id) is not None
+
+    def scan(self):
+        """ Yield every archived game, in the order they were archived. """
+        dat, offset, end = self._dat, 0, self._end
+        while offset < end:
+            game = ArchivedGame(dat, offset)
+            offset += LENGTH.unpack_from(dat, offset)[0]
+            yield game
+
+    def close(self):
+        """ Close the archive, games read from it can't be used afterwards. """
+        self._idx.release()
+        self._dat.release()
+        for m in self._maps:
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    import sys
+    _, path, *args = sys.argv
+
+    with ArchiveReader(path) as archive:
+        if args:
+            game = archive.get(int(args[0]))
+            if game is None:
+                sys.exit("No game {} in {}".format(args[0], path))
+            print(json.dumps(game.to_dict(), indent=2))
+        else:
+            start  = time.time()
+            states = Counter(game.state for game in archive.scan())
+            print("{} games scanned in {:.2f}s".format(sum(states.values()), time.time() - start))
+            for state, count in states.most_common():
+                print("    {:<10} {}".format(str(state), count))
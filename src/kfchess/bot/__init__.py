@@ -0,0 +1 @@
+""" Bots playing Kung Fu Chess, see runner.py. """
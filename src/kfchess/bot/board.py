@@ -0,0 +1,249 @@
+"""
+board.py
+
+An in-memory Kung Fu Chess board for bots and simulations, following the rules of kfchess.game
+without a round trip to redis per square.
+
+Squares are 0x88 indices (as Square.idx), pieces are (type, color, last_move) tuples where
+last_move is relative to the start of the game, as in RedisKungFuBoard.
+"""
+from kfchess.game import Square, OFFSETS, SLIDE, PAWN_START_RANK, PAWN_PROMOTE_RANK, \
+    CASTLE_DISABLING_SQUARES, STARTING_NFEN, PLAYING, W_WINS, B_WINS, \
+    KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN, WHITE, BLACK
+
+PROMOTIONS = [QUEEN, ROOK, BISHOP, KNIGHT]
+
+PIECE_OFFSETS = {piece: [o.idx for o in offsets] for piece, offsets in OFFSETS.items() if piece != PAWN}
+PAWN_OFFSETS  = {color: o.idx for color, o in OFFSETS[PAWN].items()}
+CASTLE_SQUARES = {color: {side: [sq.idx for sq in sqs] for side, sqs in sides.items()}
+                  for color, sides in CASTLE_DISABLING_SQUARES.items()}
+
+def valid(idx):
+    # steps are at most a knight's jump from the board, so both ends are caught by the 0x88 bits
+    return not idx & 0x88
+
+def san(idx):
+    return Square(idx).san
+
+def idx(san):
+    return Square.FromSan(san).idx
+
+def rank(idx):
+    return (idx >> 4) + 1
+
+class FastBoard():
+    """ A Kung Fu Chess board held in memory. """
+
+    def __init__(self, cd, nfen=STARTING_NFEN, start_time=0):
+        """ Create a board with cooldown cd from nfen, started at start_time (ms since epoch). """
+        self.cd          = cd
+        self.start_time  = start_time
+        self.state       = PLAYING
+        self.squares     = [None] * 128
+        self._occupied   = {WHITE: set(), BLACK: set()}  # squares of the pieces of each color
+        rows, castles, move_number = nfen.split(" ")
+        self.castles     = castles
+        self.move_number = int(move_number)
+        for r, row in enumerate(rows.split("/")):
+            file = 1
+            for l in row:
+                if l.isdigit():
+                    file += int(l)
+                else:
+                    color = WHITE if l.isupper() else BLACK
+                    self._set(Square.FromFileRank(file, 8 - r).idx, (l.lower(), color, None))
+                    file += 1
+
+    @classmethod
+    def FromDict(cls, board):
+        """ Create a board from a game dictionary (kfchess.game.to_dict, as sent in sync-cnf). """
+        res = cls(board["cd"], board["nfen"], board["start_time"] or 0)
+        for sq, time in board["times"].items():
+            type, color, _ = res.squares[idx(sq)]
+            res._set(idx(sq), (type, color, time))
+        res.state = board["state"]
+        return res
+
+    def copy(self):
+        res = FastBoard.__new__(FastBoard)
+        res.__dict__.update(self.__dict__)
+        res.squares = list(self.squares)
+        res._occupied = {color: set(sqs) for color, sqs in self._occupied.items()}
+        return res
+
+    def _set(self, sq, piece):
+        old = self.squares[sq]
+        if old is not None:
+            self._occupied[old[1]].discard(sq)
+        if piece is not None:
+            self._occupied[piece[1]].add(sq)
+        self.squares[sq] = piece
+
+    def pieces(self, color=None):
+        """ Yield (square, piece) of all pieces, of color if given. """
+        squares = self.squares
+        for c in (WHITE, BLACK) if color is None else (color, ):
+            for sq in self._occupied[c]:
+                yield sq, squares[sq]
+
+    def ready(self, sq, time):
+        """ Return True if the piece on sq may move at time (relative to the start of the game). """
+        piece = self.squares[sq]
+        return piece is not None and (piece[2] is None or time - piece[2] >= self.cd)
+
+    def ready_at(self, sq):
+        """ Relative time at which the piece on sq may move. """
+        last = self.squares[sq][2]
+        return 0 if last is None else last + self.cd
+
+    def can_castle(self, color, side):
+        letter = 'k' if side == KING else 'q'
+        return (letter.upper() if color == WHITE else letter) in self.castles
+
+    def moves(self, sq):
+        """ Return the moves (from, to, promote) of the piece on sq, ignoring its cooldown. """
+        piece = self.squares[sq]
+        if piece is None:
+            return []
+        type, color, _ = piece
+        squares = self.squares
+        res = []
+        if type == PAWN:
+            forward = sq + PAWN_OFFSETS[color]
+            targets = []
+            if valid(forward) and squares[forward] is None:
+                targets.append(forward)
+                double = forward + PAWN_OFFSETS[color]
+                if rank(sq) == PAWN_START_RANK[color] and valid(double) and squares[double] is None:
+                    targets.append(double)
+            for capture in (forward - 1, forward + 1):
+                if valid(capture) and squares[capture] is not None and squares[capture][1] != color:
+                    targets.append(capture)
+            for to in targets:
+                if rank(to) == PAWN_PROMOTE_RANK[color]:
+                    res.extend((sq, to, promote) for promote in PROMOTIONS)
+                else:
+                    res.append((sq, to, None))
+            return res
+
+        slide = SLIDE[type]
+        for offset in PIECE_OFFSETS[type]:
+            to = sq + offset
+            while not to & 0x88:
+                target = squares[to]
+                if target is None:
+                    res.append((sq, to, None))
+                else:
+                    if target[1] != color:
+                        res.append((sq, to, None))
+                    break
+                if not slide:
+                    break
+                to += offset
+        if type == KING:
+            if self.can_castle(color, KING):
+                res.append((sq, sq + 2, None))
+            if self.can_castle(color, QUEEN):
+                res.append((sq, sq - 2, None))
+        return res
+
+    def attacks(self, sq):
+        """ Return the squares the piece on sq could capture on, whether there's a piece or not. """
+        squares = self.squares
+        type, color, _ = squares[sq]
+        if type == PAWN:
+            forward = sq + PAWN_OFFSETS[color]
+            return [c for c in (forward - 1, forward + 1) if valid(c)]
+        res = []
+        slide = SLIDE[type]
+        for offset in PIECE_OFFSETS[type]:
+            to = sq + offset
+            while not to & 0x88:
+                res.append(to)
+                if squares[to] is not None or not slide:
+                    break
+                to += offset
+        return res
+
+    def move(self, from_sq, to_sq, promote, time, color=None):
+        """ Make a move at time (relative to the start of the game), as kfchess.game.move would.
+
+        Return the captured piece (or True if nothing was captured) if the move was made, or None
+        if it is illegal, too early, or not of a piece of color (if given). """
+        if self.state != PLAYING:
+            return None
+        piece = self.squares[from_sq]
+        if piece is None or (color is not None and piece[1] != color):
+            return None
+        if (from_sq, to_sq, promote) not in self.moves(from_sq):
+            return None
+        if piece[2] is not None and self.cd > time - piece[2]:
+            return None
+
+        type, color, _ = piece
+        captured = self.squares[to_sq]
+        removed  = [captured]
+        self._move_piece(from_sq, to_sq, time)
+        if promote:
+            self._set(to_sq, (promote, color, time))
+        # like the server, castling moves whatever is on the rook square
+        if type == KING and to_sq - from_sq == 2:
+            removed.append(self.squares[to_sq - 1])
+            self._move_piece(to_sq + 1, to_sq - 1, time)
+        elif type == KING and from_sq - to_sq == 2:
+            removed.append(self.squares[to_sq + 1])
+            self._move_piece(to_sq - 2, to_sq + 1, time)
+
+        for c in (WHITE, BLACK):
+            for side in (KING, QUEEN):
+                if from_sq in CASTLE_SQUARES[c][side] or to_sq in CASTLE_SQUARES[c][side]:
+                    letter = 'k' if side == KING else 'q'
+                    self.castles = self.castles.replace(letter.upper() if c == WHITE else letter, "")
+
+        if any(p is not None and p[0] == KING for p in removed):
+            kings = {p[1] for _, p in self.pieces() if p[0] == KING}
+            if WHITE not in kings:
+                self.state = B_WINS
+            elif BLACK not in kings:
+                self.state = W_WINS
+        return captured or True
+
+    def _move_piece(self, from_sq, to_sq, time):
+        piece = self.squares[from_sq]
+        if piece is None:
+            return
+        self._set(from_sq, None)
+        self._set(to_sq, (piece[0], piece[1], time))
+        self.move_number += 1
+
+    def apply_changes(self, changes, castles=None, move_number=None, state=None):
+        """ Apply the changes of a move-cnf (square san -> piece dict) made by the server. """
+        for sq, piece in changes.items():
+            self._set(idx(sq), None if piece["type"] == "." else
+                      (piece["type"], piece["color"], piece["last_move"]))
+        if castles is not None:
+            self.castles = castles
+        if move_number is not None:
+            self.move_number = move_number
+        if state is not None:
+            self.state = state
+
+    @property
+    def nfen(self):
+        rows = []
+        for r in range(8, 0, -1):
+            row, empty = "", 0
+            for f in range(1, 9):
+                piece = self.squares[Square.FromFileRank(f, r).idx]
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    row, empty = row + str(empty), 0
+                row += piece[0].upper() if piece[1] == WHITE else piece[0]
+            rows.append(row + (str(empty) if empty else ""))
+        return "{} {} {}".format("/".join(rows), self.castles, self.move_number)
+
+    @property
+    def winner(self):
+        return {W_WINS: WHITE, B_WINS: BLACK}.get(self.state)
@@ -0,0 +1,145 @@
+"""
+engine.py
+
+Move choice of bots, by difficulty level, within a time budget.
+
+In Kung Fu Chess there are no turns, so a bot doesn't search a game tree. Every decision is a
+single pass over the moves of its ready pieces, scored with a material heuristic, and must end
+well within the cooldown: choose() stops scoring once its budget is spent and returns the best
+move found so far. Levels differ in what they look at:
+
+    0 - any ready move, at random
+    1 - takes the most valuable piece it can, else moves at random
+    2 - weighs captures against pieces it would leave or put en prise, given which enemy
+        pieces will be ready to take them
+    3 - also looks at the best reply of the opponent to each of its best moves, and guards its king
+
+Lower levels also wait longer between moves (see LEVELS), which is what makes them beatable.
+"""
+import random
+import time
+
+from kfchess.game import KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN, other
+from kfchess.bot.board import rank, PAWN_PROMOTE_RANK
+
+PIECE_VALUES = {PAWN: 1, KNIGHT: 3, BISHOP: 3, ROOK: 5, QUEEN: 9, KING: 100}
+
+# level -> (name, delay between moves in ms)
+LEVELS = {
+    0: ("novice",   2000),
+    1: ("beginner", 1000),
+    2: ("player",    400),
+    3: ("master",    100),
+}
+
+# moves looked at by the lookahead of level 3
+LOOKAHEAD_WIDTH = 8
+
+class Engine():
+    """ Chooses the moves of a bot of some level. """
+
+    def __init__(self, level, rng=None):
+        if level not in LEVELS:
+            raise ValueError("Unknown bot level {}".format(level))
+        self.level     = level
+        self.name, self.delay = LEVELS[level]
+        self._rng      = rng or random.Random()
+        self.decisions = 0
+        self.timeouts  = 0  # decisions cut short by their budget
+
+    def choose(self, board, color, at, budget=50):
+        """ Return the move (from, to, promote) color should make on board, at time at (relative
+        to the start of the game), or None if no piece of color can move. Spend at most budget ms, or
+        look at everything if budget is None (for reproducible simulations). """
+        deadline = time.perf_counter() + budget / 1000 if budget is not None else float("inf")
+        self.decisions += 1
+        moves = [m for sq, _ in board.pieces(color) if board.ready(sq, at) for m in board.moves(sq)]
+        if not moves:
+            return None
+        if self.level == 0:
+            return self._rng.choice(moves)
+        self._rng.shuffle(moves)  # break ties at random
+        if self.level == 1:
+            return max(moves, key=lambda m: capture_value(board, m))
+
+        # a cooled down piece can take within the opponent's delay, so count what's ready soon
+        threats = attack_map(board, other(color), at + self.delay)
+        best, best_score = None, None
+        scored = []
+        for i, move in enumerate(moves):
+            if i % 16 == 0 and time.perf_counter() > deadline:
+                self.timeouts += 1
+                break
+            score = static_score(board, move, threats)
+            scored.append((score, move))
+            if best_score is None or score > best_score:
+                best, best_score = move, score
+        if self.level == 2 or time.perf_counter() > deadline:
+            return best
+
+        scored.sort(key=lambda s: s[0], reverse=True)
+        for score, move in scored[:LOOKAHEAD_WIDTH]:
+            if time.perf_counter() > deadline:
+                self.timeouts += 1
+                break
+            score -= reply_loss(board, move, color, at)
+            if score > best_score or move == best:
+                best, best_score = move, score
+        return best
+
+def capture_value(board, move):
+    """ Value of what move captures or promotes to. """
+    _, to_sq, promote = move
+    target = board.squares[to_sq]
+    value = PIECE_VALUES[target[0]] if target is not None else 0
+    if promote:
+        value += PIECE_VALUES[promote] - PIECE_VALUES[PAWN]
+    return value
+
+def attack_map(board, color, until):
+    """ Return, per square, the value of the cheapest piece of color ready by until that attacks it
+    (None if there is none). """
+    res = [None] * 128
+    for sq, piece in board.pieces(color):
+        if piece[2] is not None and until - piece[2] < board.cd:
+            continue
+        value = PIECE_VALUES[piece[0]]
+        for target in board.attacks(sq):
+            if res[target] is None or value < res[target]:
+                res[target] = value
+    return res
+
+def static_score(board, move, threats):
+    """ Score a move by material: what it takes, minus what it risks on the target square, plus
+    what it saves from its square. """
+    from_sq, to_sq, promote = move
+    piece = board.squares[from_sq]
+    value = PIECE_VALUES[promote or piece[0]]
+    score = capture_value(board, move)
+    attacker = threats[to_sq]
+    if attacker is not None:
+        # a moved piece can't move again for a cooldown, so it can't escape
+        score -= value
+    if threats[from_sq] is not None and attacker is None:
+        score += PIECE_VALUES[piece[0]]
+    if piece[0] == PAWN:
+        # push pawns toward promotion, a little
+        distance = abs(PAWN_PROMOTE_RANK[piece[1]] - rank(to_sq))
+        score += 0.05 * (7 - distance)
+    return score
+
+def reply_loss(board, move, color, at):
+    """ Value color loses to the best capture the opponent could make right after move. """
+    after = board.copy()
+    after.move(move[0], move[1], move[2], at)
+    if after.winner == color:
+        return -PIECE_VALUES[KING]  # we took the king, nothing to lose
+    loss = 0
+    for sq, piece in after.pieces(other(color)):
+        if not after.ready(sq, at):
+            continue
+        for target in after.attacks(sq):
+            victim = after.squares[target]
+            if victim is not None and victim[1] == color:
+                loss = max(loss, PIECE_VALUES[victim[0]])
+    return loss
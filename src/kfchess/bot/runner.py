@@ -0,0 +1,228 @@
+"""
+runner.py
+
+Bots playing on the game manager, from a pool of worker processes.
+
+Bots are requested by pushing an assignment to the bots queue (see request_bot). Workers take
+assignments and play through the manager's queues like any player: a bot joins (or creates) its
+game and syncs, then sends move-reqs, keeping its own FastBoard up to date from the confirmations
+of the game. The manager must run with --fanout, as bots follow their games on game channels.
+
+Each worker plays up to max_games games at once in a single loop, so the cost of bots is set by
+the number of workers, and never taken from the manager or the web tier. A bot has one move in
+flight at a time, and decides within budget milliseconds (at most a quarter of the cooldown).
+
+    python -m kfchess.bot.runner in out bots host port [--workers=<n>] [--games=<n>] [--budget=<ms>]
+"""
+import json
+import multiprocessing
+import time
+import traceback
+from uuid import uuid4
+
+import redis
+
+import kfchess.game as kfc
+from kfchess.redis_games_manager import game_channel, queue_for, lane_for, LOBBY_LANE
+from kfchess.bot.board import FastBoard, san
+from kfchess.bot.engine import Engine
+
+# a move not confirmed by then is given up on, and the game synced again
+PENDING_TIMEOUT = 5000
+# a bot waiting for its game to start syncs again this often
+WAITING_SYNC    = 1000
+
+def request_bot(db, bots_queue, game_id, level, cd=None, vs=None):
+    """ Ask for a bot of level to join game_id.
+
+    If cd is given the bot creates the game instead (playing white), and if vs is given too a
+    second bot of level vs joins it, which makes bot games a source of load. """
+    db.rpush(bots_queue, json.dumps({"game_id": game_id, "level": level, "cd": cd, "vs": vs}))
+
+class BotGame():
+    """ A game played by a bot. """
+
+    def __init__(self, game_id, player_id, engine, delay=None):
+        """ Play game_id as player_id, moving every delay ms (the engine's delay by default). """
+        self.game_id   = game_id
+        self.player_id = player_id
+        self.engine    = engine
+        self.delay     = engine.delay if delay is None else delay
+        self.board     = None
+        self.color     = None
+        self.offset    = 0     # server clock minus ours
+        self.pending   = None  # (from square, time sent) of the move in flight
+        self.next_move = 0
+        self.synced    = kfc.now()  # time of the last sync-req or sync-cnf
+        self.done      = False
+
+    def on_sync(self, data):
+        """ Reset the board from a sync-cnf. """
+        if data is None:  # no such game (any more)
+            self.done = True
+            return
+        board = data["board"]
+        self.board  = FastBoard.FromDict(board)
+        self.offset = board["current_time"] - kfc.now()
+        self.color  = kfc.WHITE if data["white"] == self.player_id else \
+                      kfc.BLACK if data["black"] == self.player_id else None
+        self.pending = None
+        self.synced  = kfc.now()
+        if self.board.state not in (kfc.WAITING, kfc.PLAYING):
+            self.done = True
+
+    def on_move(self, player_id, data):
+        """ Apply a move-cnf. Return True if the game should be synced again. """
+        if data is None:
+            # only failures of our own moves reach us without a move
+            if player_id == self.player_id:
+                self.pending = None
+                return True
+            return False
+        move = data["move"]
+        if self.board is None:
+            return True
+        self.board.apply_changes(move["changes"], move["castles"], move["move_number"], move["state"])
+        if player_id == self.player_id:
+            self.pending = None
+        if self.board.state != kfc.PLAYING:
+            self.done = True
+        return False
+
+    def time(self):
+        """ Time on the server, relative to the start of the game. """
+        return kfc.now() + self.offset - self.board.start_time
+
+    def decide(self, budget):
+        """ Return the move-req payload of the next move, if it is time for one. """
+        if self.done or self.board is None or self.color is None or self.pending is not None:
+            return None
+        if self.board.state != kfc.PLAYING or kfc.now() < self.next_move:
+            return None
+        budget = min(budget, self.board.cd // 4)
+        move = self.engine.choose(self.board, self.color, self.time(), budget)
+        self.next_move = kfc.now() + self.delay
+        if move is None:
+            return None
+        from_sq, to_sq, promote = move
+        self.pending = (from_sq, kfc.now())
+        return {"from": san(from_sq), "to": san(to_sq), "promote": promote}
+
+class BotWorker():
+    """ Plays the games of many bots, taking assignments from bots_queue. """
+
+    def __init__(self, db, in_queue, out_queue, bots_queue, max_games=50, budget=50, tick=20):
+        self._db      = db
+        self._in      = in_queue
+        self._out     = out_queue
+        self._bots    = bots_queue
+        self._max     = max_games
+        self._budget  = budget
+        self._tick    = tick
+        self._pubsub  = db.pubsub(ignore_subscribe_messages=True)
+        self.games    = {}  # game_id -> [BotGame], both sides of bot games are played here
+        self.moves    = 0
+        self.finished = 0
+
+    def run(self):
+        while True:
+            self.step()
+
+    def step(self):
+        """ Take an assignment if there's room, handle confirmations and make due moves. """
+        if len(self.games) < self._max:
+            assignment = self._db.lpop(self._bots)
+            if assignment is not None:
+                self.assign(**json.loads(assignment))
+        if self.games:
+            message = self._pubsub.get_message(timeout=self._tick / 1000)
+            while message is not None:
+                self.handle(message["data"])
+                message = self._pubsub.get_message()
+        else:
+            time.sleep(self._tick / 1000)
+        for game_id, bots in list(self.games.items()):
+            for bot in bots:
+                self._play(bot)
+            if all(bot.done for bot in bots):
+                self._drop(game_id)
+
+    def assign(self, game_id, level, cd=None, vs=None):
+        """ Play game_id with a bot of level, see request_bot. """
+        key = str(game_id)
+        if key not in self.games:
+            self.games[key] = []
+            self._pubsub.subscribe(game_channel(self._out, game_id))
+        levels = [level] if vs is None or cd is None else [level, vs]
+        for i, level in enumerate(levels):
+            bot = BotGame(game_id, "bot:{}:{}".format(level, uuid4().hex[:12]), Engine(level))
+            self.games[key].append(bot)
+            if i == 0 and cd is not None:
+                self._push(game_id, bot.player_id, "game-req", {"cd": cd})
+            else:
+                self._push(game_id, bot.player_id, "join-req", None)
+            # after the join in the same lane, so that it sees the bot playing
+            self._push(game_id, bot.player_id, "sync-req", None, LOBBY_LANE)
+
+    def handle(self, message):
+        """ Apply a confirmation published on the channel of a game. """
+        try:
+            game_id, player_id, cmd, data = json.loads(message)[:4]
+            for bot in self.games.get(str(game_id), []):
+                if cmd == "sync-cnf":
+                    if data is None and player_id != bot.player_id:
+                        continue
+                    bot.on_sync(data)
+                elif cmd == "move-cnf" and bot.on_move(player_id, data):
+                    self._push(game_id, bot.player_id, "sync-req", None)
+        except Exception:
+            traceback.print_exc()
+
+    def _play(self, bot):
+        if (bot.board is None or bot.board.state == kfc.WAITING) and kfc.now() - bot.synced > WAITING_SYNC:
+            bot.synced = kfc.now()
+            self._push(bot.game_id, bot.player_id, "sync-req", None)
+            return
+        if bot.pending is not None and kfc.now() - bot.pending[1] > PENDING_TIMEOUT:
+            bot.pending = None
+            self._push(bot.game_id, bot.player_id, "sync-req", None)
+            return
+        move = bot.decide(self._budget)
+        if move is not None:
+            self.moves += 1
+            self._push(bot.game_id, bot.player_id, "move-req", move)
+
+    def _drop(self, game_id):
+        del self.games[game_id]
+        self._pubsub.unsubscribe(game_channel(self._out, game_id))
+        self.finished += 1
+
+    def _push(self, game_id, player_id, cmd, data, lane=None):
+        if lane is None:
+            lane = lane_for(cmd)
+        self._db.rpush(queue_for(self._in, lane),
+                       json.dumps([game_id, player_id, cmd, data, {"t": kfc.now()}]))
+
+def run_bot_worker(host, port, in_q, out_q, bots_q, **kwargs):
+    db = redis.StrictRedis(host=host, port=port)
+    BotWorker(db, in_q, out_q, bots_q, **kwargs).run()
+
+def run_bot_workers(host, port, in_q, out_q, bots_q, workers=2, **kwargs):
+    """ Run bots in workers processes, until they are all done. """
+    processes = [multiprocessing.Process(target=run_bot_worker, args=(host, port, in_q, out_q, bots_q),
+                                         kwargs=kwargs, name="bots-{}".format(i))
+                 for i in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+if __name__ == "__main__":
+    import sys
+    _, in_q, out_q, bots_q, host, port, *flags = sys.argv
+    options = dict(flag.split("=", 1) for flag in flags if "=" in flag)
+
+    run_bot_workers(host, port, in_q, out_q, bots_q,
+                    workers=int(options.get("--workers", multiprocessing.cpu_count())),
+                    max_games=int(options.get("--games", 50)),
+                    budget=int(options.get("--budget", 50)))
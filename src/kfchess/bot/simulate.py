@@ -0,0 +1,166 @@
+"""
+simulate.py
+
+Headless bot-vs-bot games, to tune cooldowns and rule variants with data.
+
+Games are played in memory on a FastBoard with a virtual clock: each side moves as soon as its
+engine's delay has passed and it has a ready piece, so a game takes as long as its moves take to
+compute, not as long as it would on the server. A configuration is a cooldown, a starting nfen and
+the levels (and optionally delays) of both sides. Games of every configuration are split into
+shards played on a multiprocessing pool, each game with its own seed so any of them can be replayed.
+
+Every game is written to the output as a JSON line as soon as its shard is done, followed by one
+summary line per configuration: win rates, game lengths and captures.
+
+    python -m kfchess.bot.simulate <out.jsonl> [--cds=1000,5000] [--levels=0,1,2,3] [--games=<n>]
+        [--nfen=<nfen>] [--max-time=<ms>] [--workers=<n>] [--shard=<n>] [--seed=<n>] [--no-games]
+"""
+import json
+import multiprocessing
+import random
+import time
+from collections import Counter
+
+from kfchess.game import STARTING_NFEN, PLAYING, WHITE, BLACK
+from kfchess.redis_games_manager import percentile
+from kfchess.bot.board import FastBoard
+from kfchess.bot.engine import Engine
+
+# games still going after this long (virtual ms) are draws
+DEFAULT_MAX_TIME = 30 * 60 * 1000
+
+def play(config, seed):
+    """ Play a game of config (see make_configs) with seed, return its record. """
+    rng    = random.Random(seed)
+    board  = FastBoard(config["cd"], config.get("nfen") or STARTING_NFEN)
+    levels = {WHITE: config["white"], BLACK: config["black"]}
+    engines = {color: Engine(level, rng) for color, level in levels.items()}
+    delays  = {color: config.get("delay", {}).get(color, engines[color].delay) for color in engines}
+    max_time = config.get("max_time", DEFAULT_MAX_TIME)
+
+    # start in a random order, as players don't join at the same instant
+    next_move = {color: rng.randint(0, delays[color]) for color in engines}
+    moves     = Counter()
+    captures  = {WHITE: Counter(), BLACK: Counter()}
+    at = 0
+    while board.state == PLAYING:
+        color = min(next_move, key=next_move.get)
+        at = next_move[color]
+        if at > max_time:
+            at = max_time
+            break
+        ready = min(board.ready_at(sq) for sq, _ in board.pieces(color))
+        if ready > at:
+            # nothing ready, wait for the first piece to cool down
+            next_move[color] = ready
+            continue
+        move = engines[color].choose(board, color, at, None)
+        if move is None:  # stuck pieces, try again once another one is ready
+            next_move[color] = at + max(board.cd, 1)
+            continue
+        captured = board.move(move[0], move[1], move[2], at)
+        moves[color] += 1
+        if captured is not True:
+            captures[color][captured[0]] += 1
+        next_move[color] = at + delays[color]
+
+    return {"config": config["id"],
+            "seed":   seed,
+            "winner": board.winner,
+            "time":   at,
+            "moves":  {color: moves[color] for color in (WHITE, BLACK)},
+            "captures": {color: dict(captures[color]) for color in (WHITE, BLACK)}}
+
+def play_shard(shard):
+    """ Play count games of a configuration, with seeds from seed. """
+    config, seed, count = shard
+    return [play(config, s) for s in range(seed, seed + count)]
+
+class Summary():
+    """ Aggregated results of the games of a configuration. """
+
+    def __init__(self, config):
+        self.config   = config
+        self.games    = 0
+        self.wins     = Counter()
+        self.times    = []
+        self.moves    = 0
+        self.captures = {WHITE: Counter(), BLACK: Counter()}
+
+    def add(self, record):
+        self.games += 1
+        self.wins[record["winner"]] += 1
+        self.times.append(record["time"])
+        self.moves += sum(record["moves"].values())
+        for color, captured in record["captures"].items():
+            self.captures[color].update(captured)
+
+    def to_dict(self):
+        times = sorted(self.times)
+        games = self.games or 1
+        return {"config":    self.config,
+                "games":     self.games,
+                "white_wins": self.wins[WHITE] / games,
+                "black_wins": self.wins[BLACK] / games,
+                "draws":      self.wins[None] / games,
+                "time": {"mean": sum(times) / games,
+                         "p50":  percentile(times, 50),
+                         "p95":  percentile(times, 95),
+                         "max":  times[-1] if times else 0},
+                "moves_per_game": self.moves / games,
+                "captures_per_game": {color: {piece: n / games for piece, n in captured.items()}
+                                      for color, captured in self.captures.items()}}
+
+def make_configs(cds, levels, nfen=None, max_time=DEFAULT_MAX_TIME):
+    """ Return a configuration for every cooldown in cds and every pair of levels. """
+    configs = []
+    for cd in cds:
+        for white in levels:
+            for black in levels:
+                configs.append({"id": len(configs), "cd": cd, "white": white, "black": black,
+                                "nfen": nfen, "max_time": max_time})
+    return configs
+
+def simulate(configs, games, out, workers=None, shard_size=100, seed=0, write_games=True):
+    """ Play games games of every configuration on a pool of workers processes, writing JSON lines
+    to the file out. Return the summaries, by configuration id. """
+    shards = []
+    for config in configs:
+        base = seed + config["id"] * games
+        for start in range(0, games, shard_size):
+            shards.append((config, base + start, min(shard_size, games - start)))
+    summaries = {config["id"]: Summary(config) for config in configs}
+
+    with multiprocessing.Pool(workers) as pool:
+        for records in pool.imap_unordered(play_shard, shards):
+            for record in records:
+                summaries[record["config"]].add(record)
+                if write_games:
+                    out.write(json.dumps(record) + "\n")
+            out.flush()
+    for summary in summaries.values():
+        out.write(json.dumps(dict(summary.to_dict(), summary=True)) + "\n")
+    return summaries
+
+if __name__ == "__main__":
+    import sys
+    _, out_path, *flags = sys.argv
+    options = dict(flag.split("=", 1) for flag in flags if "=" in flag)
+
+    configs = make_configs([int(cd) for cd in options.get("--cds", "1000").split(",")],
+                           [int(level) for level in options.get("--levels", "0,1,2,3").split(",")],
+                           nfen=options.get("--nfen"),
+                           max_time=int(options.get("--max-time", DEFAULT_MAX_TIME)))
+    start = time.time()
+    with open(out_path, "w") as out:
+        summaries = simulate(configs, int(options.get("--games", 1000)), out,
+                             workers=int(options["--workers"]) if "--workers" in options else None,
+                             shard_size=int(options.get("--shard", 100)),
+                             seed=int(options.get("--seed", 0)),
+                             write_games="--no-games" not in flags)
+    total = sum(summary.games for summary in summaries.values())
+    print("Played {} games in {:.1f}s".format(total, time.time() - start))
+    for summary in summaries.values():
+        res = summary.to_dict()
+        print("cd={cd} {white} vs {black}: ".format(**summary.config) +
+              "white {white_wins:.1%} black {black_wins:.1%} draws {draws:.1%}".format(**res))
@@ -10,6 +10,10 @@ from collections import defaultdict
 import pprint
 import json
 
+from kfchess import logs
+
+log = logs.get_log("game")
+
 STARTING_NFEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR KQkq 1"
 
 # pieces
@@ -166,6 +170,10 @@ class Move():
     KCASTLE = "kcastle"
     QCASTLE = "qcastle"
     TIME    = "time"
+    READY   = "ready"
+    CHANGES = "changes"
+    CASTLES = "castles"
+    MOVE_NUMBER = "move_number"
 
     def __init__(self, from_sq, to_sq, metadata=None):
         self.from_sq = from_sq
@@ -199,6 +207,35 @@ class Move():
     def time(self):
         return self._metadata[Move.TIME]
 
+    @property
+    def ready_time(self):
+        """ Absolute time (ms since epoch) at which the moved pieces can move again """
+        return self._metadata[Move.READY]
+
+    @property
+    def changes(self):
+        """ Dictionary of the squares changed by the move (san) to the pieces now on them (as dict) """
+        return self._metadata[Move.CHANGES]
+
+    @property
+    def castles(self):
+        """ Castle rights after the move """
+        return self._metadata[Move.CASTLES]
+
+    @property
+    def move_number(self):
+        """ Move number after the move """
+        return self._metadata[Move.MOVE_NUMBER]
+
+    @property
+    def moved_squares(self):
+        """ Squares of the pieces moved by this move (the rook too when castling) """
+        if self.is_kingside_castle:
+            return [self.to_sq, self.to_sq.left]
+        if self.is_queenside_castle:
+            return [self.to_sq, self.to_sq.right]
+        return [self.to_sq]
+
 
 # Offsets for each piece (same as standard chess)
 OFFSETS = {
@@ -297,7 +334,7 @@ class RedisKungFuBoard(KungFuBoard):
         try:
             san = sq.san
         except AttributeError:
-            print(sq)
+            log.debug("square from index", sq=sq)
             try:
                 san = Square(sq).san
             except:
@@ -412,6 +449,9 @@ class RedisKungFuBoard(KungFuBoard):
     def set_castles(self, castles):
         self._set("castles", castles)
 
+    def set_start_nfen(self, nfen):
+        self._set("start_nfen", nfen)
+
     def set_move_number(self, move):
         self._set("move_number", move)
 
@@ -421,6 +461,13 @@ class RedisKungFuBoard(KungFuBoard):
     def set_last_move(self, time):
         self._set("last_move", time)
 
+    def add_history(self, entry):
+        """ Append a move to the history of the game, kept in its own list (see history_key). """
+        key = history_key(self._store_key)
+        self._db.rpush(key, entry)
+        if self._exp:
+            self._db.pexpire(key, self._exp)
+
     def can_castle(self, color, side):
         letter = 'k' if side == KING else 'q'
         fen_letter = letter.upper() if color == WHITE else letter
@@ -466,6 +513,11 @@ class RedisKungFuBoard(KungFuBoard):
         res = self._get("start_time")
         return res
 
+    @property
+    def start_nfen(self):
+        """ The nfen the game was created from. """
+        return self._get("start_nfen")
+
     @property
     def cd(self):
         return self._cd
@@ -510,6 +562,11 @@ class RedisKungFuBoard(KungFuBoard):
                 res += "/"
         return res
 
+    @property
+    def history(self):
+        """ Moves of the game as "<from><to><promote>@<time>" strings, in order. """
+        return [m.decode() for m in self._db.lrange(history_key(self._store_key), 0, -1)]
+
     @property
     def last_time(self):
         """ last recorded move time. """
@@ -640,12 +697,13 @@ def move(player, db, store_key, san_from_sq, san_to_sq, promote=None):
     board = RedisKungFuBoard(db, store_key)
 
     if board.state != PLAYING:
-        print("bad state")
+        log.debug("move while not playing", store_key=store_key, state=board.state)
         return None
 
     piece = board[from_sq]
     if piece.type == EMPTY or board.get_player(piece.color) != player:
-        print(from_sq, piece)
+        log.debug("move of another player's piece", store_key=store_key, player=player, sq=from_sq.san,
+                  piece=piece.type)
         return None
 
     o_piece = board[to_sq]
@@ -656,20 +714,23 @@ def move(player, db, store_key, san_from_sq, san_to_sq, promote=None):
             relative_move_time = move_time - board.start_time  # internally we hold relative times
             if piece.last_move is not None and board.cd > (relative_move_time - piece.last_move):  # move too early
                 return None
-            # TODO: Update history here
+            board.add_history("{}{}{}@{}".format(from_sq.san, to_sq.san, promote or "", relative_move_time))
 
             # Do move
             board.move_piece(from_sq, to_sq, relative_move_time)
+            changed = [from_sq, to_sq]
             # Do special moves
             if move.is_kingside_castle:
                 castle_from = to_sq.right
                 castle_to   = to_sq.left
                 board.move_piece(castle_from, castle_to, relative_move_time)
+                changed.extend([castle_from, castle_to])
 
             if move.is_queenside_castle:
                 castle_from = to_sq.left.left
                 castle_to = to_sq.right
                 board.move_piece(castle_from, castle_to, relative_move_time)
+                changed.extend([castle_from, castle_to])
 
             if move.promote:
                 board.put_piece(move.promote, piece.color, to_sq, relative_move_time)
@@ -684,6 +745,10 @@ def move(player, db, store_key, san_from_sq, san_to_sq, promote=None):
                     board.disable_castle(color, QUEEN)
 
             move._metadata[Move.TIME] = relative_move_time
+            move._metadata[Move.READY] = move_time + board.cd
+            move._metadata[Move.CHANGES] = {sq.san: board[sq].dict() for sq in changed}
+            move._metadata[Move.CASTLES] = board.castles
+            move._metadata[Move.MOVE_NUMBER] = board.move_number
 
             if board.winner == WHITE:
                 board.set_state(W_WINS)
@@ -691,30 +756,80 @@ def move(player, db, store_key, san_from_sq, san_to_sq, promote=None):
                 board.set_state(B_WINS)
             return move, board.state
 
-def to_dict(db, store_key):
-    """ Return a dictionary representing the game """
+def ready_time(player, db, store_key, san_sq):
+    """ Return the time (in miliseconds since epoch) at which player may move the piece at san_sq,
+    or None if it is not a piece of player in a game being played. """
+    try:
+        sq = Square.FromSan(san_sq)
+    except:
+        return None
+
+    if not sq.valid:
+        return None
+
     board = RedisKungFuBoard(db, store_key)
+    if board.state != PLAYING:
+        return None
+
+    piece = board[sq]
+    if piece.type == EMPTY or board.get_player(piece.color) != player:
+        return None
+
+    if piece.last_move is None:
+        return board.start_time
+    return board.start_time + piece.last_move + board.cd
+
+def history_key(store_key):
+    """ Return the key of the list of moves of the game at store_key. """
+    return "{}:history".format(store_key)
+
+def to_dict(db, store_key):
+    """ Return a dictionary representing the game
+
+    The whole game is read with a single HGETALL instead of a read per square. """
+    board = RedisKungFuBoard(db, store_key)  # refreshes expiry
+    fields = {}
+    for key, value in db.hgetall(str(store_key)).items():
+        if isinstance(key, bytes):
+            key = key.decode()
+        fields[key] = json.loads(value)
+
     res = {
         "cd": board.cd,
-        "history": None, #TODO,
-        "white": board.white,
-        "black": board.black,
-        "state": board.state,
+        "history": board.history,
+        "white": fields.get(WHITE),
+        "black": fields.get(BLACK),
+        "state": fields.get("state"),
         "current_time": now(),
-        "start_time":   board.start_time,
-        "nfen": "{} {} {}".format(board.fen, board.castles, board.move_number),
+        "start_time":   fields.get("start_time"),
+        "nfen": None,
         "times": {}
     }
 
+    fen = ""
     for r in range(8):
-        rank = r + 1
+        rank = 8 - r
+        e_cnt = 0
         for f in range(8):
             file = f + 1
             sq = Square.FromFileRank(file, rank)
-            piece = board[sq]
+            piece = fields.get(sq.san)
+            piece = Piece(**piece) if piece else Piece(EMPTY, EMPTY, 0)
             if (piece.last_move):  # only pass non-None times
                 res["times"][sq.san] = piece.last_move
-
+            if (piece.type == EMPTY):
+                e_cnt += 1
+            else:
+                if (e_cnt != 0):
+                    fen += str(e_cnt)
+                    e_cnt = 0
+                fen += str(piece)
+        if (e_cnt != 0):
+            fen += str(e_cnt)
+        if (rank > 1):
+            fen += "/"
+
+    res["nfen"] = "{} {} {}".format(fen, fields.get("castles"), fields.get("move_number"))
     return res
 
 def create_pawn_moves(from_sq, to_sq, color, extra_flags=None):
@@ -769,6 +884,7 @@ def create_game_from_nfen(db, cd, store_key, *, exp=None, nfen=None):
     board.set_move_number(int(move_num))
     board.set_start_time(now())
     board.set_castles(castles)
+    board.set_start_nfen(nfen)
 
     board.set_state(WAITING) # for player assigment
 
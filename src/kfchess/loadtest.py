@@ -0,0 +1,463 @@
+"""
+loadtest.py
+
+Synthetic load on the game manager, end to end, to size a deployment before it's needed.
+
+Players are paired into games: one creates a game, the other joins it, and both then send moves
+and sync every so often. Moves are either realistic (legal moves of ready pieces, as a novice bot
+plays them, at most rate per second) or adversarial (random moves, mostly illegal or too early,
+sent at rate per second regardless of cooldowns and confirmations). Finished games are replaced
+by new ones, so the load holds for the whole run.
+
+Requests go either straight into the manager's queues (redis mode), or through the socket.io
+/game namespace of the web tier (socket.io mode). In redis mode the generator reads the out queue
+itself, so run a manager with queues of its own for it, and a single generator process per manager
+(one process easily outpaces a manager). In socket.io mode players log in as <users><i>
+(registered on the way if needed), which needs the requests and websocket-client packages, and
+games have the cooldown of the web tier.
+
+Latency is measured from each request to its confirmation, per command (game, join, move, sync).
+Requests unanswered after TIMEOUT are counted as lost. At the end the throughput and latency
+percentiles of every command are printed, and written to --out as JSON if given.
+
+    python -m kfchess.loadtest redis <in> <out> <host> <port> [--fanout] [options]
+    python -m kfchess.loadtest socketio <url> [--users=<prefix>] [--password=<password>] [options]
+
+    options: [--players=<n>] [--duration=<s>] [--rate=<moves/s>] [--sync-rate=<syncs/s>]
+             [--cd=<ms>] [--adversarial] [--processes=<n>] [--out=<file>]
+"""
+import json
+import multiprocessing
+import queue
+import random
+import time
+from collections import Counter, defaultdict, deque
+from uuid import uuid4
+
+import redis
+
+import kfchess.game as kfc
+from kfchess.redis_games_manager import queue_for, lane_for, game_channel, percentile, LOBBY_LANE
+from kfchess.bot.board import san
+from kfchess.bot.engine import Engine
+from kfchess.bot.runner import BotGame
+
+# requests unanswered after this long (ms) are lost
+TIMEOUT = 10000
+
+CNF_KINDS = {"game-cnf": "game", "join-cnf": "join", "move-cnf": "move", "sync-cnf": "sync"}
+
+class LatencyStats():
+    """ Latencies of requests to their confirmations, by kind of request.
+
+    Confirmations are matched to requests in order, per game, player and kind, as the manager
+    answers the requests of one kind in the order they were sent. """
+
+    def __init__(self):
+        self.sent      = Counter()
+        self.lost      = Counter()
+        self.errors    = 0
+        self.latencies = defaultdict(list)
+        self._pending  = defaultdict(deque)  # (game_id, player_id, kind) -> send times
+
+    def request(self, game_id, player_id, kind):
+        self.sent[kind] += 1
+        self._pending[(str(game_id), player_id, kind)].append(kfc.now())
+
+    def confirm(self, game_id, player_id, kind):
+        pending = self._pending.get((str(game_id), player_id, kind))
+        if pending:
+            self.latencies[kind].append(kfc.now() - pending.popleft())
+
+    def expire(self, older_than=TIMEOUT):
+        """ Count requests pending for longer than older_than ms as lost. """
+        limit = kfc.now() - older_than
+        for (_, _, kind), pending in list(self._pending.items()):
+            while pending and pending[0] <= limit:
+                pending.popleft()
+                self.lost[kind] += 1
+
+    @property
+    def pending(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+    def merge(self, other):
+        self.sent.update(other.sent)
+        self.lost.update(other.lost)
+        self.errors += other.errors
+        for kind, latencies in other.latencies.items():
+            self.latencies[kind].extend(latencies)
+
+    def report(self, duration):
+        """ Return throughput (confirmations per second) and latencies (ms) by kind. """
+        res = {}
+        for kind in sorted(self.sent):
+            latencies = sorted(self.latencies[kind])
+            res[kind] = {"sent":       self.sent[kind],
+                         "confirmed":  len(latencies),
+                         "lost":       self.lost[kind],
+                         "throughput": len(latencies) / duration,
+                         "p50":        percentile(latencies, 50),
+                         "p95":        percentile(latencies, 95),
+                         "p99":        percentile(latencies, 99),
+                         "max":        latencies[-1] if latencies else 0}
+        res["errors"] = self.errors
+        return res
+
+    def __getstate__(self):
+        # pending requests don't travel between processes, expire them first
+        state = dict(self.__dict__, _pending=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pending = defaultdict(deque)
+
+class RedisTransport():
+    """ Players sending requests straight into the manager's queues. """
+
+    def __init__(self, db, in_queue, out_queue, fanout=False, batch=256):
+        self._db     = db
+        self._in     = in_queue
+        self._out    = out_queue
+        self._batch  = batch
+        self._pubsub = db.pubsub(ignore_subscribe_messages=True) if fanout else None
+
+    def create(self, player_id, cd):
+        """ Create a game for player_id, return its id. """
+        game_id = int(uuid4()) >> 80
+        if self._pubsub is not None:
+            self._pubsub.subscribe(game_channel(self._out, game_id))
+        self._push(game_id, player_id, "game-req", {"cd": cd})
+        self._push(game_id, player_id, "sync-req", None, LOBBY_LANE)
+        return game_id
+
+    def join(self, game_id, player_id):
+        # the sync must see the join, so it rides the same lane
+        self._push(game_id, player_id, "join-req", None)
+        self._push(game_id, player_id, "sync-req", None, LOBBY_LANE)
+
+    def move(self, game_id, player_id, move):
+        self._push(game_id, player_id, "move-req", move)
+
+    def sync(self, game_id, player_id):
+        self._push(game_id, player_id, "sync-req", None)
+
+    def leave(self, game_id):
+        if self._pubsub is not None:
+            self._pubsub.unsubscribe(game_channel(self._out, game_id))
+
+    def receive(self, timeout):
+        """ Return the confirmations that arrived, waiting up to timeout ms for some. """
+        pipe = self._db.pipeline()
+        pipe.lrange(self._out, 0, self._batch - 1)
+        pipe.ltrim(self._out, self._batch, -1)
+        res = [json.loads(cnf) for cnf in pipe.execute()[0]]
+        if self._pubsub is not None and self._pubsub.subscribed:
+            message = self._pubsub.get_message(timeout=0 if res else timeout / 1000)
+            while message is not None:
+                res.append(json.loads(message["data"]))
+                message = self._pubsub.get_message()
+        elif not res:
+            time.sleep(timeout / 1000)
+        return res
+
+    def _push(self, game_id, player_id, cmd, data, lane=None):
+        if lane is None:
+            lane = lane_for(cmd)
+        self._db.rpush(queue_for(self._in, lane),
+                       json.dumps([game_id, player_id, cmd, data, {"t": kfc.now()}]))
+
+class SocketIOTransport():
+    """ Players connected to the /game namespace of the web tier, with a socket.io client each.
+
+    Confirmations are turned back into the manager's [game_id, player_id, cmd, data] form. A
+    successful move is sent to every socket of the game without its player, so it is attributed
+    to a player only on the socket of the player who sent it. """
+
+    def __init__(self, url, users="loadtest-", password="loadtest"):
+        import requests
+        import socketio
+
+        self._requests = requests
+        self._socketio = socketio
+        self._url      = url.rstrip("/")
+        self._users    = users
+        self._password = password
+        self._clients  = {}  # player_id -> (socket.io client, http session)
+        self._games    = {}  # player_id -> game_id
+        self._joining  = set()  # players who joined a game and weren't synced yet
+        self._moves    = defaultdict(list)  # player_id -> (from, to) of moves in flight
+        self._inbox    = queue.Queue()
+
+    def create(self, player_id, cd):
+        """ Create a game for player_id (with the cooldown of the web tier), return its id. """
+        _, session = self._connect(player_id)
+        res = session.get(self._url + "/game/", allow_redirects=False)
+        game_id = int(res.headers["Location"].rstrip("/").rsplit("/", 1)[-1])
+        self._inbox.put([game_id, player_id, "game-cnf", {}])
+        self.join(game_id, player_id)
+        return game_id
+
+    def join(self, game_id, player_id):
+        client, _ = self._connect(player_id)
+        self._games[player_id] = game_id
+        self._joining.add(player_id)
+        client.emit("join-req", game_id, namespace="/game")
+
+    def move(self, game_id, player_id, move):
+        self._moves[player_id].append((move["from"], move["to"]))
+        self._connect(player_id)[0].emit("move-req", (game_id, move), namespace="/game")
+
+    def sync(self, game_id, player_id):
+        self._connect(player_id)[0].emit("sync-req", game_id, namespace="/game")
+
+    def leave(self, game_id):
+        pass
+
+    def receive(self, timeout):
+        res = []
+        try:
+            res.append(self._inbox.get(timeout=timeout / 1000))
+            while True:
+                res.append(self._inbox.get_nowait())
+        except queue.Empty:
+            return res
+
+    def _connect(self, player_id):
+        if player_id in self._clients:
+            return self._clients[player_id]
+        session = self._requests.Session()
+        credentials = {"username": player_id, "password": self._password}
+        session.post(self._url + "/register", data=credentials)  # already registered is fine
+        session.post(self._url + "/login", data=credentials)
+        client = self._socketio.Client(reconnection=False)
+        client.on("sync-cnf", lambda payload: self._on_sync(player_id, payload), namespace="/game")
+        client.on("move-cnf", lambda payload: self._on_move(player_id, payload), namespace="/game")
+        client.on("move-cnf-batch", lambda payload: [self._on_moved(player_id, move) for move in payload["moves"]],
+                  namespace="/game")
+        cookies = "; ".join("{}={}".format(k, v) for k, v in session.cookies.items())
+        client.connect(self._url, headers={"Cookie": cookies}, namespaces=["/game"])
+        self._clients[player_id] = (client, session)
+        return self._clients[player_id]
+
+    def _on_sync(self, player_id, payload):
+        if player_id in self._joining:
+            # join-cnfs aren't sent to sockets, the first sync after the join stands for it
+            self._joining.discard(player_id)
+            self._inbox.put([self._games.get(player_id), player_id, "join-cnf", {}])
+        data = None
+        if payload.get("result") != "fail":
+            color = payload["color"]
+            data = {"board": payload["board"],
+                    "white": player_id if color == kfc.WHITE else None,
+                    "black": player_id if color == kfc.BLACK else None}
+        self._inbox.put([self._games.get(player_id), player_id, "sync-cnf", data])
+
+    def _on_move(self, player_id, payload):
+        if payload.get("result") == "fail":
+            if self._moves[player_id]:
+                self._moves[player_id].pop(0)
+            self._inbox.put([self._games.get(player_id), player_id, "move-cnf", None])
+        else:
+            self._on_moved(player_id, payload["move"])
+
+    def _on_moved(self, player_id, move):
+        key = (move["from"], move["to"])
+        own = key in self._moves[player_id]
+        if own:
+            self._moves[player_id].remove(key)
+        self._inbox.put([self._games.get(player_id), player_id if own else None, "move-cnf",
+                         {"state": move["state"], "move": move}])
+
+class LoadPlayer(BotGame):
+    """ A player of the load test, a novice bot that also syncs, or floods moves if adversarial. """
+
+    def __init__(self, game_id, player_id, rate, sync_rate, adversarial, rng):
+        super().__init__(game_id, player_id, Engine(0, rng), delay=1000 / rate)
+        self.rate        = rate
+        self.sync_rate   = sync_rate
+        self.adversarial = adversarial
+        self.rng         = rng
+        self.next_sync   = kfc.now() + self._wait(sync_rate)
+
+    def _wait(self, rate):
+        """ Time to the next event of a Poisson process of rate events per second. """
+        return self.rng.expovariate(rate) * 1000 if rate > 0 else float("inf")
+
+    def next_request(self):
+        """ Return the (cmd, data) of the request to send now, if any. """
+        at = kfc.now()
+        if at >= self.next_sync:
+            self.next_sync = at + self._wait(self.sync_rate)
+            return "sync-req", None
+        if not self.adversarial:
+            move = self.decide(budget=10)
+            return ("move-req", move) if move is not None else None
+        if self.board is None or self.color is None or at < self.next_move:
+            return None
+        self.next_move = at + self._wait(self.rate)
+        pieces = [sq for sq, _ in self.board.pieces(self.color)]
+        if not pieces:
+            return None
+        return "move-req", {"from": san(self.rng.choice(pieces)),
+                            "to":   san(self.rng.randrange(8) * 16 + self.rng.randrange(8)),
+                            "promote": None}
+
+class LoadTest():
+    """ Run players in games against each other through a transport, measuring latencies. """
+
+    def __init__(self, transport, players=10, duration=60, rate=1.0, sync_rate=0.1, cd=1000,
+                 adversarial=False, users="load-", tick=10, seed=None):
+        self._transport   = transport
+        self._players     = players
+        self._duration    = duration
+        self._rate        = rate
+        self._sync_rate   = sync_rate
+        self._cd          = cd
+        self._adversarial = adversarial
+        self._users       = users
+        self._tick        = tick
+        self._rng         = random.Random(seed)
+        self.games        = {}  # game_id -> [white, black]
+        self._pairs       = {}  # game_id -> index of its pair of players
+        self.stats        = LatencyStats()
+        self.finished     = 0
+
+    def run(self, drain=TIMEOUT):
+        """ Play for duration seconds, then wait up to drain ms for answers. Return the stats. """
+        for pair in range(self._players // 2):
+            self._start_game(pair)
+        end = time.time() + self._duration
+        while time.time() < end:
+            self.step()
+        drain_end = time.time() + drain / 1000
+        while self.stats.pending and time.time() < drain_end:
+            for cnf in self._transport.receive(self._tick):
+                self.handle(*cnf[:4])
+        self.stats.expire(0)
+        return self.stats
+
+    def step(self):
+        for cnf in self._transport.receive(self._tick):
+            self.handle(*cnf[:4])
+        for game_id, players in list(self.games.items()):
+            for player in players:
+                request = player.next_request()
+                if request is not None:
+                    self._send(player, *request)
+            if all(player.done for player in players):
+                self._replace(game_id)
+        self.stats.expire()
+
+    def handle(self, game_id, player_id, cmd, data):
+        """ Match a confirmation to its request and apply it to the players of its game. """
+        if cmd == "error-ind":
+            self.stats.errors += 1
+            return
+        kind = CNF_KINDS.get(cmd)
+        if kind is None:
+            return
+        self.stats.confirm(None if kind == "game" else game_id, player_id, kind)
+        for player in self.games.get(str(game_id), []):
+            if kind == "sync" and (data is not None or player.player_id == player_id):
+                player.on_sync(data)
+            elif kind == "move" and player.on_move(player_id, data) and not player.adversarial:
+                self._send(player, "sync-req", None)
+
+    def _start_game(self, pair):
+        white_id = "{}{}".format(self._users, 2 * pair)
+        black_id = "{}{}".format(self._users, 2 * pair + 1)
+        # the game id may only be known once created, so creations are tracked by player
+        self.stats.request(None, white_id, "game")
+        game_id = self._transport.create(white_id, self._cd)
+        self.stats.request(game_id, white_id, "sync")
+        self.stats.request(game_id, black_id, "join")
+        self.stats.request(game_id, black_id, "sync")
+        self._transport.join(game_id, black_id)
+        self.games[str(game_id)] = [LoadPlayer(game_id, player_id, self._rate, self._sync_rate,
+                                               self._adversarial, self._rng)
+                                    for player_id in (white_id, black_id)]
+        self._pairs[str(game_id)] = pair
+
+    def _replace(self, game_id):
+        white = self.games.pop(game_id)[0]
+        self._transport.leave(white.game_id)
+        self.finished += 1
+        self._start_game(self._pairs.pop(game_id))
+
+    def _send(self, player, cmd, data):
+        self.stats.request(player.game_id, player.player_id, CNF_KINDS[cmd.replace("-req", "-cnf")])
+        if cmd == "move-req":
+            self._transport.move(player.game_id, player.player_id, data)
+        else:
+            self._transport.sync(player.game_id, player.player_id)
+
+def make_transport(spec):
+    """ Create the transport of spec (mode and arguments, see __main__). """
+    mode, *args = spec
+    if mode == "redis":
+        in_q, out_q, host, port, fanout = args
+        return RedisTransport(redis.StrictRedis(host=host, port=port), in_q, out_q, fanout)
+    url, users, password = args
+    return SocketIOTransport(url, users, password)
+
+def run_load(spec, index, **kwargs):
+    """ Run the index-th process of a load test, return its stats. """
+    transport = make_transport(spec)
+    users = "{}{}-".format(kwargs.pop("users", "load-"), index)
+    return LoadTest(transport, users=users, seed=index, **kwargs).run()
+
+def _run_load(args):
+    spec, index, kwargs = args
+    return run_load(spec, index, **kwargs)
+
+def run_processes(spec, processes=1, **kwargs):
+    """ Run a load test of kwargs["players"] players split over processes processes, return the merged stats. """
+    if processes > 1 and spec[0] == "redis":
+        raise ValueError("Processes would take each other's confirmations from the out queue")
+    kwargs["players"] = max(2, kwargs.get("players", 10) // processes)
+    if processes == 1:
+        return run_load(spec, 0, **kwargs)
+    stats = LatencyStats()
+    with multiprocessing.Pool(processes) as pool:
+        for res in pool.imap_unordered(_run_load, [(spec, i, dict(kwargs)) for i in range(processes)]):
+            stats.merge(res)
+    return stats
+
+def format_report(report):
+    lines = ["{:<6}{:>9}{:>11}{:>7}{:>10}{:>8}{:>8}{:>8}{:>8}".format(
+             "cmd", "sent", "confirmed", "lost", "per sec", "p50", "p95", "p99", "max")]
+    for kind, res in report.items():
+        if kind == "errors":
+            continue
+        lines.append("{:<6}{sent:>9}{confirmed:>11}{lost:>7}{throughput:>10.1f}{p50:>8}{p95:>8}{p99:>8}{max:>8}"
+                     .format(kind, **res))
+    lines.append("errors: {}".format(report["errors"]))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    import sys
+    _, mode, *args = sys.argv
+    flags   = [arg for arg in args if arg.startswith("--")]
+    args    = [arg for arg in args if not arg.startswith("--")]
+    options = dict(flag.split("=", 1) for flag in flags if "=" in flag)
+
+    if mode == "redis":
+        in_q, out_q, host, port = args
+        spec = ("redis", in_q, out_q, host, int(port), "--fanout" in flags)
+    else:
+        spec = ("socketio", args[0], options.get("--users", "loadtest-"), options.get("--password", "loadtest"))
+    duration = float(options.get("--duration", 60))
+    stats = run_processes(spec, int(options.get("--processes", 1)),
+                          players=int(options.get("--players", 10)),
+                          duration=duration,
+                          rate=float(options.get("--rate", 1)),
+                          sync_rate=float(options.get("--sync-rate", 0.1)),
+                          cd=int(options.get("--cd", 1000)),
+                          adversarial="--adversarial" in flags)
+    report = stats.report(duration)
+    print(format_report(report))
+    if "--out" in options:
+        with open(options["--out"], "w") as out:
+            json.dump(report, out, indent=2)
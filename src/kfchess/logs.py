@@ -0,0 +1,199 @@
+"""
+logs.py
+
+Structured logging for the game manager and the web tier.
+
+Events are logged by category (manager, game, requests, cnfs, ...), each category with its own
+level, as JSON lines holding the event name and its fields:
+
+    {"ts": 1546300800123, "level": "DEBUG", "cat": "manager", "event": "request", "cmd": "move-req", ...}
+
+Debug and info events of high volume categories can be sampled, so that only a share of them is
+logged. Levels and sampling are checked before anything is formatted, so a dropped event costs a
+dict lookup and at most one random().
+
+Once configured, records are put on a bounded queue and written by a native thread, so a slow
+stream or file never stalls the manager loop or the eventlet hub (with eventlet monkey patching
+too). When the queue is full records are dropped and counted, rather than waited for.
+
+Until configure is called, events go through logging's defaults (warnings and errors to stderr).
+"""
+import json
+import logging
+import logging.handlers
+import random
+import sys
+
+ROOT = "kfc"
+
+# categories of the log, and their levels unless configured otherwise
+DEFAULT_LEVELS = {
+    "manager":  logging.INFO,
+    "game":     logging.WARNING,
+    "requests": logging.INFO,
+    "cnfs":     logging.INFO,
+    "hub":      logging.WARNING,
+}
+
+_logs = {}
+
+class EventLog():
+    """ Logs the events of a category. """
+
+    def __init__(self, category, sample_rate=1):
+        self.category    = category
+        self.sample_rate = sample_rate  # share of debug and info events logged
+        self.logger      = logging.getLogger("{}.{}".format(ROOT, category))
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """ Log an error event with the exception being handled. """
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+    def enabled(self, level=logging.DEBUG):
+        """ Whether events of level would be logged, to skip preparing their fields otherwise. """
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, event, fields, exc_info=False):
+        if not self.logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        self.logger.log(level, event, extra={"fields": fields}, exc_info=exc_info)
+
+def get_log(category):
+    """ Get the event log of category. """
+    if category not in _logs:
+        _logs[category] = EventLog(category)
+        logging.getLogger("{}.{}".format(ROOT, category)).setLevel(DEFAULT_LEVELS.get(category, logging.INFO))
+    return _logs[category]
+
+class JsonFormatter(logging.Formatter):
+    """ Formats events as JSON lines. """
+
+    def format(self, record):
+        line = {"ts":    int(record.created * 1000),
+                "level": record.levelname,
+                "cat":   record.name[len(ROOT) + 1:],
+                "event": record.getMessage()}
+        line.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:  # formatted before being queued
+            line["exc"] = record.exc_text
+        return json.dumps(line, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Puts records on a bounded queue without waiting, dropping them when it's full. """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting is left to the writer thread, only the traceback can't wait
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Exception:  # full
+            self.dropped += 1
+
+class LogWriter():
+    """ Writes queued records to handlers from a native thread. """
+
+    def __init__(self, queue, threading, *handlers):
+        self._queue    = queue
+        self._handlers = handlers
+        self._thread   = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """ Write the records queued so far and stop. """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            for handler in self._handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self._handlers:
+            handler.flush()
+
+_handler = None
+_writer  = None
+
+def native_modules():
+    """ Return the queue and threading modules, as they were before eventlet patched them. """
+    if "eventlet" not in sys.modules:
+        import queue, threading
+        return queue, threading
+    from eventlet import patcher
+    return patcher.original("queue"), patcher.original("threading")
+
+def parse_levels(spec):
+    """ Parse "category=level,..." (levels by name, or sample rates) into a dict. """
+    if not spec:
+        return {}
+    return dict(item.split("=", 1) for item in spec.split(",") if "=" in item)
+
+def configure(levels=None, samples=None, path=None, stream=None, queue_size=10000):
+    """ Log events to path (or stream, stderr by default) through a writer thread.
+
+    levels maps categories to level names (or numbers), and samples maps categories to the share
+    of their debug and info events to log. Configuring again replaces the previous setup. """
+    global _handler, _writer
+    shutdown()
+    for category, level in dict(DEFAULT_LEVELS, **(levels or {})).items():
+        level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+        get_log(category).logger.setLevel(level)
+    for category, rate in (samples or {}).items():
+        get_log(category).sample_rate = float(rate)
+
+    queue, threading = native_modules()
+    target = logging.FileHandler(path) if path else logging.StreamHandler(stream or sys.stderr)
+    target.setFormatter(JsonFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _writer  = LogWriter(_handler.queue, threading, target)
+    _writer.start()
+
+    root = logging.getLogger(ROOT)
+    root.addHandler(_handler)
+    root.propagate = False
+
+def dropped():
+    """ Number of records dropped since configured, as the writer couldn't keep up. """
+    return _handler.dropped if _handler is not None else 0
+
+def shutdown():
+    """ Write pending records and stop the writer, if configured. """
+    global _handler, _writer
+    if _handler is None:
+        return
+    root = logging.getLogger(ROOT)
+    root.removeHandler(_handler)
+    root.propagate = True
+    _writer.stop()
+    _handler = _writer = None
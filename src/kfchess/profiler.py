@@ -0,0 +1,101 @@
+"""
+profiler.py
+
+A stack sampling profiler, to find where a live manager or web worker spends its time.
+
+A native thread samples the stack of the profiled thread every interval milliseconds for a given
+duration, then writes the samples as collapsed stacks, one line per distinct stack with its count:
+
+    move-req;redis_games_manager.py:run;redis_games_manager.py:_move;game.py:move 42
+
+which flamegraph.pl (or speedscope, ...) turns into a flame graph. Stacks are rooted at the tag
+of the profiled thread at the time of the sample, the command being handled by the manager.
+
+The profiled thread doesn't pay for anything but setting its tag, so the overhead is that of the
+sampling thread taking the GIL every interval. Under eventlet the web worker's greenlets all run
+in the main thread, which is sampled from a thread eventlet didn't patch.
+
+Managers are profiled by a profile-req (see kfchess.stats), web workers by a POST to
+/game/admin/profile (see web.game.routes).
+"""
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from kfchess.logs import native_modules
+
+DEFAULT_DURATION = 10000
+DEFAULT_INTERVAL = 5
+
+def profile_path(directory, name):
+    """ Return a new path for a profile of name (e.g. manager) in directory, the temp dir by default. """
+    return os.path.join(directory or tempfile.gettempdir(),
+                        "{}-{}-{}.folded".format(name, os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+
+class SamplingProfiler():
+    """ Samples the stack of a thread for a while, and writes the collapsed stacks to a file. """
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL, thread_id=None, on_done=None, tag=None):
+        """ Profile the thread thread_id (the calling thread by default) every interval ms,
+        writing to path. on_done(profiler) is called from the sampling thread once written. """
+        _, threading  = native_modules()
+        self.path     = path
+        self.interval = interval / 1000
+        self.tag      = tag  # root of the stacks sampled from now on
+        self.samples  = 0
+        self.stacks   = Counter()
+        self._target  = thread_id if thread_id is not None else threading.get_ident()
+        self._on_done = on_done
+        self._labels  = {}   # code object -> frame label
+        self._until   = 0
+        self._stopped = threading.Event()  # sleeps between samples (time.sleep may be green)
+        self._thread  = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self, duration=DEFAULT_DURATION):
+        """ Sample for duration ms, in the background. """
+        self._until = time.monotonic() + duration / 1000
+        self._thread.start()
+
+    def stop(self):
+        """ Stop sampling early, and wait until the profile is written. """
+        self._stopped.set()
+        self._thread.join()
+
+    def sample(self):
+        """ Take a sample of the stack of the profiled thread. """
+        frame = sys._current_frames().get(self._target)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            code  = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = "{}:{}".format(os.path.basename(code.co_filename),
+                                                            code.co_name).replace(";", ":").replace(" ", "_")
+            stack.append(label)
+            frame = frame.f_back
+        if self.tag is not None:
+            stack.append(str(self.tag).replace(";", ":").replace(" ", "_"))
+        self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def write(self):
+        with open(self.path, "w") as out:
+            for stack, count in self.stacks.most_common():
+                out.write("{} {}\n".format(stack, count))
+
+    def _run(self):
+        while time.monotonic() < self._until:
+            self.sample()
+            if self._stopped.wait(self.interval):
+                break
+        self.write()
+        if self._on_done is not None:
+            self._on_done(self)
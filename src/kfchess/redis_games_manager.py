@@ -3,107 +3,652 @@
 Manage a stream of commands for games sitting in redis. Reading
 requests from input queue and sending responses to output queue.
 
+Requests are read from priority lanes: moves are served before syncs, and syncs before lobby
+commands (game creation, joins, ...), with weighted fairness so that no lane is starved. Since
+all requests of the same type share one lane, the order of moves within a game is preserved.
+
+Requests may carry a trace (meta "trace", see web.game.tracing). The confirmation of a traced
+request gets the request's meta back as a fifth element, with the time the manager started and
+finished handling it ("start" and "end"), so where its time went can be told apart.
+
+A stats-req returns the live internals of the manager (see ManagerStats and kfchess.stats for a
+command line client), to diagnose it without a restart. A profile-req samples its stack for a
+while (see kfchess.profiler), tagging the samples with the command being handled.
+
+Events are logged to the "manager" category (see kfchess.logs), every request at debug level.
+
 Future:
     - Manage workers handling games, possibly with separate queues
-    - Move to real loggig library (project-wide)
 """
 import threading
 import multiprocessing
 import json
-import traceback
+import os
+import resource
+import time
+import tracemalloc
+from collections import deque, Counter
 from uuid import uuid4
 
 import redis
 
 import kfchess.game as kfc
+from kfchess import logs
+from kfchess.profiler import SamplingProfiler, profile_path, DEFAULT_DURATION, DEFAULT_INTERVAL
+from kfchess.timer_wheel import TimerWheel
+
+log = logs.get_log("manager")
+
+# request lanes, in order of priority
+MOVE_LANE  = "move"
+SYNC_LANE  = "sync"
+LOBBY_LANE = "lobby"
+
+LANES = [MOVE_LANE, SYNC_LANE, LOBBY_LANE]
+
+# Share of requests served from each lane when all lanes are backlogged
+DEFAULT_LANE_WEIGHTS = {
+    MOVE_LANE:  8,
+    SYNC_LANE:  3,
+    LOBBY_LANE: 1
+}
+
+CMD_LANES = {
+    "move-req": MOVE_LANE,
+    "premove-req": MOVE_LANE,
+    "sync-req": SYNC_LANE,
+    # served first, so stats come back even from a backlogged manager
+    "stats-req": MOVE_LANE,
+    "profile-req": MOVE_LANE,
+}
+
+# expire of games created without one, in milliseconds
+DEFAULT_GAME_EXP = 3600000
+
+# kinds of timers in the timer wheel
+READY_TIMER   = "ready"
+PREMOVE_TIMER = "premove"
+
+def lane_for(cmd):
+    """ Return the lane a command should be queued in. Unknown commands go to the lobby lane. """
+    return CMD_LANES.get(cmd, LOBBY_LANE)
+
+def game_channel(out_queue, game_id):
+    """ Return the channel game confirmations are published on when fanout is enabled. """
+    return "{}:game:{}".format(out_queue, game_id)
+
+def snapshot_key(out_queue, game_id):
+    """ Return the key of the snapshot of a game, when snapshots are enabled. """
+    return "{}:snapshot:{}".format(out_queue, game_id)
+
+def queue_for(in_queue, lane):
+    """ Return the redis list used for given lane of in_queue.
+
+    The lobby lane is in_queue itself, so producers which know nothing about lanes still work. """
+    if lane == LOBBY_LANE:
+        return in_queue
+    return "{}:{}".format(in_queue, lane)
+
+class WeightedLanes():
+    """ Smooth weighted round robin over the request lanes.
+
+    Every served request credits each lane by its weight and charges the served lane by the
+    total weight, lanes are then tried in order of credit (ties broken by priority). Empty lanes
+    are skipped by BLPOP, so no time is wasted on them, and credits are clamped so a lane that
+    was idle for a long time can't monopolize the manager once it fills up. """
+
+    def __init__(self, in_queue, weights=None):
+        if weights is None:
+            weights = DEFAULT_LANE_WEIGHTS
+        self._weights = {lane: weights.get(lane, 1) for lane in LANES}
+        self._total   = sum(self._weights.values())
+        self._credits = {lane: 0 for lane in LANES}
+        self._queues  = {lane: queue_for(in_queue, lane) for lane in LANES}
+        self._lanes   = {q: lane for lane, q in self._queues.items()}
+
+    def order(self):
+        """ Return the lane queues in the order they should be popped. """
+        lanes = sorted(LANES, key=lambda lane: (-self._credits[lane], LANES.index(lane)))
+        return [self._queues[lane] for lane in lanes]
+
+    def lane_of(self, queue):
+        """ Return the lane of a queue name as returned by BLPOP. """
+        if isinstance(queue, bytes):
+            queue = queue.decode()
+        return self._lanes[queue]
+
+    def charge(self, served):
+        """ Account for a request served from the given lane. """
+        for lane in LANES:
+            credit = self._credits[lane] + self._weights[lane]
+            if lane == served:
+                credit -= self._total
+            self._credits[lane] = max(-self._total, min(self._total, credit))
+
+class QueueWaitStats():
+    """ Track how long requests waited in each lane before being handled.
+
+    Requests carry their enqueue time (meta "t", in milliseconds since epoch) which is compared
+    to the time they are popped. The last samples of each lane are kept for percentiles. """
+
+    def __init__(self, samples=1024):
+        self._count   = {lane: 0 for lane in LANES}
+        self._total   = {lane: 0 for lane in LANES}
+        self._max     = {lane: 0 for lane in LANES}
+        self._samples = {lane: deque(maxlen=samples) for lane in LANES}
+
+    def record(self, lane, wait):
+        self._count[lane] += 1
+        self._total[lane] += wait
+        self._max[lane]    = max(self._max[lane], wait)
+        self._samples[lane].append(wait)
+
+    def summary(self):
+        """ Return a dictionary of count, mean, max and p50/p95/p99 queue wait (ms) per lane. """
+        res = {}
+        for lane in LANES:
+            count   = self._count[lane]
+            samples = sorted(self._samples[lane])
+            res[lane] = {
+                "count": count,
+                "mean":  self._total[lane] / count if count else 0,
+                "max":   self._max[lane],
+                "p50":   percentile(samples, 50),
+                "p95":   percentile(samples, 95),
+                "p99":   percentile(samples, 99)
+            }
+        return res
+
+class ManagerStats():
+    """ Counters of the work done by a manager since it started, for stats-req.
+
+    Processing times (ms) are measured from the time a request is popped to the time it's been
+    handled, the last samples of them are kept for percentiles. """
+
+    def __init__(self, samples=1024):
+        self.start    = kfc.now()
+        self.requests = Counter()  # by command
+        self.errors   = Counter()  # by kind
+        self.games    = Counter()  # created, archived, expired
+        self._time    = Counter()  # total processing time by command
+        self._samples = deque(maxlen=samples)
+
+    def record(self, cmd, elapsed):
+        self.requests[cmd] += 1
+        self._time[cmd] += elapsed
+        self._samples.append(elapsed)
+
+    def summary(self):
+        """ Return a dictionary of the counters, and mean and percentiles of processing times. """
+        samples = sorted(self._samples)
+        count   = sum(self.requests.values())
+        return {"uptime":   kfc.now() - self.start,
+                "requests": {cmd: {"count": n, "mean": self._time[cmd] / n}
+                             for cmd, n in self.requests.items()},
+                "errors":   dict(self.errors),
+                "games":    dict(self.games),
+                "processing": {"count": count,
+                               "mean":  sum(self._time.values()) / count if count else 0,
+                               "max":   samples[-1] if samples else 0,
+                               "p50":   percentile(samples, 50),
+                               "p95":   percentile(samples, 95),
+                               "p99":   percentile(samples, 99)}}
+
+def rss():
+    """ Return the resident set size of the process in kB (its peak where /proc isn't available). """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def top_allocations(top=10):
+    """ Return the top allocation sites by size if tracemalloc is tracing, else None. """
+    if not tracemalloc.is_tracing():
+        return None
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:top]
+    return [{"site": "{}:{}".format(stat.traceback[0].filename, stat.traceback[0].lineno),
+             "size": stat.size // 1024,
+             "count": stat.count} for stat in stats]
 
 class RedisGamesManager():
     """ Manage games using redis queue for incoming and outgoing messages """
-    def __init__(self, redis_db, in_queue, out_queue, key_base_suffix=None):
+    def __init__(self, redis_db, in_queue, out_queue, key_base_suffix=None, lane_weights=None,
+                 stats_interval=10000, fanout=False, notify_ready=False, timer_resolution=10,
+                 snapshots=False, snapshot_ttl=3600, sweep_interval=1000, sweep_batch=100,
+                 archive_queue=None, profile_dir=None):
         """ initialize a games manager.
 
         This object runs new kfchess games in processes, relaying messages to them through redis.
         By default all respodatao a single queue, but a different queue
-        per process (game) can also be submitted. """
+        per process (game) can also be submitted.
+
+        Requests are read from the lanes of in_queue (see queue_for), weighted by lane_weights.
+        Queue wait statistics are written to the "<key_base>:stats:lanes" hash every
+        stats_interval milliseconds. Processing statistics are returned by stats-req.
+
+        If fanout is set, confirmations for a game (move-cnf, sync-cnf) are published on the
+        game's channel (see game_channel) instead of being pushed to out_queue, so that every
+        web worker holding sockets of the game receives them.
+
+        Cooldowns of moved pieces are tracked in a timer wheel with ticks of timer_resolution
+        milliseconds. If notify_ready is set, a ready-ind is sent to the game when they expire.
+
+        If snapshots is set, the sync data of a game is written to its snapshot (see snapshot_key)
+        whenever the game changes, so that the web tier can sync spectators without asking the
+        manager. The snapshot hash holds a "version", incremented on every change, and the "data".
+
+        Games are expired once their expire (exp of the game-req) has passed since they last
+        changed. Their expiry times are kept in the "<key_base>:expiry" sorted set, swept every
+        sweep_interval milliseconds for up to sweep_batch games at a time. Expired games are
+        deleted along with their snapshot and premoves, and an expire-ind is sent to out_queue so
+        the web tier drops them from the lobby.
+
+        If archive_queue is given, a record of every finished game (see prepare_archive_record)
+        is pushed to it, to be written to permanent storage by web.game.archive, and the game is
+        deleted from redis right away.
+
+        Profiles asked for by profile-req are written to profile_dir (the temp dir by default). """
         if not key_base_suffix:
             key_base_suffix = str(uuid4())
         self._db  = redis_db
         self._key_base = "manager:{}".format(key_base_suffix)
         self._out = out_queue
         self._in  = in_queue
+        self._lanes = WeightedLanes(in_queue, lane_weights)
+        self._wait_stats = QueueWaitStats()
+        self._stats = ManagerStats()
+        self._stats_interval = stats_interval
+        self._stats_time = kfc.now()
+        self._fanout = fanout
+        self._notify_ready = notify_ready
+        self._timers = TimerWheel(kfc.now(), resolution=timer_resolution)
+        self._timers_cond = threading.Condition()
+        self._snapshots = snapshots
+        self._snapshot_ttl = snapshot_ttl
+        self._premoves = {}  # (game_id, from square) -> (player_id, id of premove)
+        self._premove_ids = 0
+        self._sweep_interval = sweep_interval
+        self._sweep_batch = sweep_batch
+        self._sweep_time = kfc.now() + sweep_interval
+        self._game_exps = {}  # game_id -> exp, read from the game once per run
+        self._archive_queue = archive_queue
+        self._trace = None  # meta of the traced request being handled
+        self._profile_dir = profile_dir
+        self._profiler = None
 
     def run(self):
         """ an event loop, reading for messages on in_queue and responding on out_queue """
         done = False
         db = self._db
-        in_q = self._in
+        lanes = self._lanes
         out_q = self._out
+        timers = threading.Thread(target=self._run_timers, daemon=True)
+        timers.start()
         while not done:
-            _, out = db.blpop(in_q)
+            if self._profiler is not None:
+                self._profiler.tag = "idle"
+            popped = db.blpop(lanes.order(), self._sweep_timeout())
+            if kfc.now() >= self._sweep_time:
+                self._sweep()
+            if popped is None:
+                continue
+            queue, out = popped
+            lane = lanes.lane_of(queue)
+            lanes.charge(lane)
+            started = time.perf_counter()
+            cmd = None
             try:
-                game_id, player_id, cmd, data = json.loads(out)
+                game_id, player_id, cmd, data, *meta = json.loads(out)
+                if self._profiler is not None:
+                    self._profiler.tag = cmd
+                self._record_wait(lane, meta)
+                self._trace = trace_start(meta)
                 game_key = self.game_key_from_id(game_id)
-                print("[{}, {}] responding to {}, data={}".format(game_id, player_id, cmd, data))
+                log.debug("request", game=game_id, player=player_id, cmd=cmd, data=data, lane=lane)
                 if cmd == "game-req":
                     if not db.exists(game_key):
-                        print("creating game with exp={}".format(data.get("exp")))
+                        log.debug("create", game=game_id, exp=data.get("exp"))
+                        exp = data.get("exp", DEFAULT_GAME_EXP)
                         board = kfc.create_game_from_nfen(db = self._db,
                                                       cd = data["cd"],
                                                       store_key=game_key,
                                                       nfen = data.get("nfen", None),
-                                                      exp=data.get("exp", 3600000))
+                                                      exp=exp)
                         board.set_white(player_id)
-                        self._db.rpush(self._out, json.dumps([game_id, player_id, "game-cnf", {"state": board.state,
-                                                                                               "store_key": game_key}]))
+                        self._game_exps[str(game_id)] = exp
+                        self._stats.games["created"] += 1
+                        self._touch(game_id, game_key)
+                        self._publish_snapshot(game_id, game_key)  # before the cnf, as for moves
+                        self._db.rpush(self._out, self._traced([game_id, player_id, "game-cnf", {"state": board.state,
+                                                                                                 "store_key": game_key}]))
                     else:
-                        self._db.rpush(self._out, json.dumps([game_id, player_id, "game-cnf", None]))
+                        self._db.rpush(self._out, self._traced([game_id, player_id, "game-cnf", None]))
                 elif cmd == "join-req":
                     if not db.exists(game_key):
-                        self._db.rpush(self._out, json.dumps([game_id, player_id, "join-cnf", None]))
+                        self._db.rpush(self._out, self._traced([game_id, player_id, "join-cnf", None]))
                     else:
                         board = kfc.get_board(db, game_key)
                         if board.white != player_id and board.black is None:
                             board.set_black(player_id)
-                        self._db.rpush(self._out, json.dumps([game_id, player_id, "join-cnf", {"state": board.state,
-                                                                       "store_key": game_key}]))
+                            self._touch(game_id, game_key)
+                            self._publish_snapshot(game_id, game_key)
+                        self._db.rpush(self._out, self._traced([game_id, player_id, "join-cnf", {"state": board.state,
+                                                                         "store_key": game_key}]))
                 elif cmd == "exit-req":
-                    print("exit-req received")
-
+                    log.info("exit")
                     cnf = prepare_exit_cnf()
                     self._db.rpush(self._out, cnf)
                     done = True
                 elif cmd == "move-req":
-                    res = None
-                    try:
-                        res = kfc.move(player_id, db, game_key, data['from'], data['to'], data.get('promote'))
-                    except KeyError:
-                        print("Invalid move!")
-                    db.rpush(out_q, prepare_move_cnf(res, game_id, player_id))
+                    self._move(game_id, player_id, game_key, data)
+                elif cmd == "premove-req":
+                    self._premove(game_id, player_id, game_key, data)
                 elif cmd == "sync-req":
                     if not db.exists(game_key):
-                        db.rpush(out_q, json.dumps([game_id, player_id, "sync-cnf", None]))
+                        self._send_game_cnf(game_id, self._traced([game_id, player_id, "sync-cnf", None]))
                     else:
-                        db.rpush(out_q, prepare_sync_cnf(game_id, player_id, db, game_key))
+                        self._sync(game_id, player_id, game_key)
+                elif cmd == "stats-req":
+                    self._send_stats(player_id, data or {})
+                elif cmd == "profile-req":
+                    self._profile(player_id, data or {})
                 else:
-                    print("Unknown command {}".format(cmd))
+                    self._stats.errors["unknown command"] += 1
+                    log.warning("unknown command", game=game_id, player=player_id, cmd=cmd)
                     self._db.rpush(self._out, prepare_error_ind(command=cmd, reason="Unknown command"))
                 db.expire(out_q, 3600)
             except Exception as ex:
-                print(_, out)
-                traceback.print_exc()
+                log.exception("request failed", queue=queue, request=out)
+                self._stats.errors[type(ex).__name__] += 1
                 self._db.rpush(self._out, prepare_error_ind(reason="exception", exc=ex))
-                cmd = None
+            self._stats.record(cmd, (time.perf_counter() - started) * 1000)
+            self._trace = None
 
     def game_key_from_id(self, game_id):
         return "{}:games:{}".format(self._key_base, game_id)
 
+    def _traced(self, cnf):
+        """ Return the json of cnf, a confirmation of the request being handled, with its trace if it has one. """
+        return json.dumps(cnf + [trace_end(self._trace)] if self._trace else cnf)
 
-def run_game_manager(db, in_q, out_q):
-    game_manager = RedisGamesManager(db, in_q, out_q)
+    def _move(self, game_id, player_id, game_key, data):
+        """ Make a move, confirming it to the player and scheduling the cooldown of moved pieces. """
+        res = None
+        try:
+            res = kfc.move(player_id, self._db, game_key, data['from'], data['to'], data.get('promote'))
+        except KeyError:
+            log.debug("invalid move", game=game_id, player=player_id, data=data)
+        if res is not None:
+            self._touch(game_id, game_key)
+            # before the cnf, so a player's next move is never checked against an older snapshot
+            self._publish_snapshot(game_id, game_key)
+        self._send_game_cnf(game_id, prepare_move_cnf(res, game_id, player_id, trace_end(self._trace)))
+        if res is not None and res[1] != kfc.PLAYING and self._archive_queue:
+            self._archive(game_id, game_key)
+        if res is not None and res[1] == kfc.PLAYING and self._notify_ready:
+            move = res[0]
+            self._schedule(move.ready_time, (READY_TIMER, game_id, [sq.san for sq in move.moved_squares], move.time))
+
+    def _sync(self, game_id, player_id, game_key):
+        """ Send the state of the game to the player, refreshing the snapshot while at it. """
+        try:
+            data = prepare_sync_data(self._db, game_key)
+        except ValueError as e:
+            self._send_game_cnf(game_id, prepare_error_ind(game_id, player_id, reason=repr(e)))
+            return
+        self._send_game_cnf(game_id, self._traced([game_id, player_id, 'sync-cnf', data]))
+        self._publish_snapshot(game_id, game_key, data)
+
+    def _publish_snapshot(self, game_id, game_key, data=None):
+        """ Write the sync data of a game (read from game_key if not given) to its snapshot. """
+        if not self._snapshots:
+            return
+        if data is None:
+            data = prepare_sync_data(self._db, game_key)
+        key = snapshot_key(self._out, game_id)
+        pipe = self._db.pipeline()  # transaction, so version and data always match
+        pipe.hincrby(key, "version", 1)
+        pipe.hset(key, "data", json.dumps(data))
+        pipe.expire(key, self._snapshot_ttl)
+        pipe.execute()
+
+    @property
+    def expiry_key(self):
+        """ Sorted set of games by the time they expire if nothing happens in them. """
+        return "{}:expiry".format(self._key_base)
+
+    def _touch(self, game_id, game_key):
+        """ Note activity in a game, pushing back its expiry. """
+        game_id = str(game_id)
+        exp = self._game_exps.get(game_id)
+        if exp is None:
+            exp = json.loads(self._db.hget(game_key, "exp") or "null") or DEFAULT_GAME_EXP
+            self._game_exps[game_id] = exp
+        self._db.zadd(self.expiry_key, {game_id: kfc.now() + exp})
+
+    def _sweep_timeout(self):
+        """ BLPOP timeout (whole seconds, 0 is forever) to wake up for the next sweep. """
+        return max(1, -(-(self._sweep_time - kfc.now()) // 1000))
+
+    def _sweep(self):
+        """ Expire a batch of games past their expiry time.
+
+        Sweeps again right away while there are more expired games than fit in a batch. """
+        now = kfc.now()
+        expired = [g.decode() for g in self._db.zrangebyscore(self.expiry_key, "-inf", now,
+                                                              start=0, num=self._sweep_batch)]
+        if len(expired) < self._sweep_batch:
+            self._sweep_time = now + self._sweep_interval
+        if not expired:
+            return
+
+        pipe = self._db.pipeline(transaction=False)
+        for game_id in expired:
+            pipe.hget(self.game_key_from_id(game_id), "state")
+        states = pipe.execute()
+        for game_id, state in zip(expired, states):
+            log.info("expire", game=game_id, state=state)
+            game_key = self.game_key_from_id(game_id)
+            pipe.delete(game_key, kfc.history_key(game_key), snapshot_key(self._out, game_id))
+            pipe.rpush(self._out, prepare_expire_ind(game_id, json.loads(state) if state else None))
+            self._game_exps.pop(game_id, None)
+            self._stats.games["expired"] += 1
+        pipe.zrem(self.expiry_key, *expired)
+        pipe.execute()
+
+        expired = set(expired)
+        with self._timers_cond:
+            for key in [key for key in self._premoves if str(key[0]) in expired]:
+                del self._premoves[key]
+
+    def _archive(self, game_id, game_key):
+        """ Queue a finished game for archival and delete it. """
+        record = prepare_archive_record(game_id, self._db, game_key)
+        pipe = self._db.pipeline(transaction=False)
+        pipe.lpush(self._archive_queue, record)  # archiver pops from the right
+        pipe.delete(game_key, kfc.history_key(game_key), snapshot_key(self._out, game_id))
+        pipe.zrem(self.expiry_key, str(game_id))
+        pipe.execute()
+        self._game_exps.pop(str(game_id), None)
+        self._stats.games["archived"] += 1
+        with self._timers_cond:
+            for key in [key for key in self._premoves if str(key[0]) == str(game_id)]:
+                del self._premoves[key]
+
+    def _premove(self, game_id, player_id, game_key, data):
+        """ Hold a move until the cooldown of the piece is over, then make it as a move-req.
+
+        The player gets a single move-cnf, when the move is made or once it can't be (including
+        when it is replaced by a newer premove of the same piece). """
+        try:
+            ready = kfc.ready_time(player_id, self._db, game_key, data['from'])
+        except (KeyError, TypeError):
+            ready = None
+
+        if ready is None:
+            self._send_game_cnf(game_id, prepare_move_cnf(None, game_id, player_id, trace_end(self._trace)))
+        elif ready <= kfc.now():
+            self._move(game_id, player_id, game_key, data)
+        else:
+            with self._timers_cond:
+                self._premove_ids += 1
+                premove_id = self._premove_ids
+                replaced = self._premoves.get((game_id, data['from']))
+                self._premoves[(game_id, data['from'])] = (player_id, premove_id)
+            if replaced is not None:
+                self._send_game_cnf(game_id, prepare_move_cnf(None, game_id, replaced[0]))
+            self._schedule(ready, (PREMOVE_TIMER, game_id, player_id, data, premove_id))
+
+    def _send_game_cnf(self, game_id, cnf, db=None):
+        """ Send a confirmation concerning game_id to the web tier, through db if given (e.g. a pipeline). """
+        if db is None:
+            db = self._db
+        if self._fanout:
+            db.publish(game_channel(self._out, game_id), cnf)
+        else:
+            db.rpush(self._out, cnf)
+
+    def _schedule(self, when, timer):
+        """ Schedule a cooldown timer to expire at time when. """
+        with self._timers_cond:
+            self._timers.schedule(when, timer)
+            self._timers_cond.notify()
+
+    def _run_timers(self):
+        """ Timer thread, expiring cooldowns on every tick of the timer wheel (sleeping while there are none). """
+        while True:
+            with self._timers_cond:
+                while not len(self._timers):
+                    self._timers_cond.wait()
+                wake = self._timers.next_tick_time
+            time.sleep(max(0, wake - kfc.now()) / 1000)
+            with self._timers_cond:
+                expired = self._timers.advance(kfc.now())
+            if expired:
+                self._cooldowns_expired(expired)
+
+    def _cooldowns_expired(self, timers):
+        """ Notify games of pieces whose cooldown is over, and make the premoves waiting for them.
+
+        Premoves are pushed to the head of the move lane, so the main loop (which alone changes
+        games) makes them right away. Caller must not hold the timers lock. """
+        pipe = self._db.pipeline(transaction=False)
+        move_q = queue_for(self._in, MOVE_LANE)
+        for kind, game_id, *timer in timers:
+            if kind == READY_TIMER:
+                squares, move_time = timer
+                self._send_game_cnf(game_id, prepare_ready_ind(game_id, squares, move_time), pipe)
+            elif kind == PREMOVE_TIMER:
+                player_id, data, premove_id = timer
+                with self._timers_cond:
+                    if self._premoves.get((game_id, data['from'])) != (player_id, premove_id):
+                        continue  # replaced
+                    del self._premoves[(game_id, data['from'])]
+                pipe.lpush(move_q, json.dumps([game_id, player_id, "move-req", data,
+                                               {"t": kfc.now(), "premove": True}]))
+        pipe.execute()
+
+    @property
+    def wait_stats(self):
+        return self._wait_stats
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def _profile(self, player_id, data):
+        """ Profile the manager for data["duration"] ms, sampling every data["interval"] ms.
+
+        The profile-cnf is sent to data["reply"] (out_queue by default) once the profile is
+        written, with its path and number of samples. It's None if a profile is already running. """
+        if self._profiler is not None and self._profiler.running:
+            self._reply(data, [-1, player_id, "profile-cnf", None])
+            return
+
+        def done(profiler):
+            self._reply(data, [-1, player_id, "profile-cnf", {"path": profiler.path,
+                                                              "samples": profiler.samples}])
+            log.info("profiled", path=profiler.path, samples=profiler.samples)
+
+        self._profiler = SamplingProfiler(profile_path(self._profile_dir, "manager"),
+                                          data.get("interval", DEFAULT_INTERVAL), on_done=done, tag="profile-req")
+        self._profiler.start(data.get("duration", DEFAULT_DURATION))
+
+    def _send_stats(self, player_id, data):
+        """ Reply to a stats-req on data["reply"] (out_queue by default).
+
+        data may also hold "tracemalloc", to start (true) or stop (false) tracing allocations, and
+        "top", the number of allocation sites to return while tracing. Stopping returns the sites
+        traced so far. """
+        if data.get("tracemalloc") is True and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        pipe = self._db.pipeline(transaction=False)
+        for lane in LANES:
+            pipe.llen(queue_for(self._in, lane))
+        pipe.llen(self._out)
+        pipe.zcard(self.expiry_key)
+        *lanes, out_depth, active = pipe.execute()
+
+        stats = self._stats.summary()
+        stats["games"]["active"] = active
+        stats.update({"queues":      {"in": dict(zip(LANES, lanes)), "out": out_depth},
+                      "waits":       self._wait_stats.summary(),
+                      "rss":         rss(),
+                      "allocations": top_allocations(data.get("top", 10)),
+                      "pid":         os.getpid()})
+        if data.get("tracemalloc") is False:
+            tracemalloc.stop()
+        self._reply(data, [-1, player_id, "stats-cnf", stats])
+
+    def _reply(self, data, cnf):
+        """ Send the cnf of an admin request to data["reply"], or to out_queue if not given.
+
+        A reply key expires in case the caller gave up waiting, out_queue of course doesn't. """
+        if "reply" in data:
+            pipe = self._db.pipeline(transaction=False)
+            pipe.rpush(data["reply"], json.dumps(cnf))
+            pipe.expire(data["reply"], 3600)
+            pipe.execute()
+        else:
+            self._db.rpush(self._out, json.dumps(cnf))
+
+    def _record_wait(self, lane, meta):
+        """ Record the queue wait of a request from its meta, publishing the stats if it's time. """
+        if meta and isinstance(meta[0], dict) and "t" in meta[0]:
+            self._wait_stats.record(lane, max(0, kfc.now() - meta[0]["t"]))
+
+        if kfc.now() - self._stats_time >= self._stats_interval:
+            self._stats_time = kfc.now()
+            summary = self._wait_stats.summary()
+            self._db.hmset("{}:stats:lanes".format(self._key_base),
+                           {lane: json.dumps(stats) for lane, stats in summary.items()})
+
+
+def run_game_manager(db, in_q, out_q, fanout=False, notify_ready=False, snapshots=False,
+                     archive_queue=None, profile_dir=None):
+    game_manager = RedisGamesManager(db, in_q, out_q, fanout=fanout, notify_ready=notify_ready,
+                                     snapshots=snapshots, archive_queue=archive_queue,
+                                     profile_dir=profile_dir)
     game_manager.run()
 
-def prepare_move_cnf(move_state, game_id, player_id):
-    """ Prepare json for a move command response. """
+def trace_start(meta):
+    """ Return the trace of a request from its meta, or None if it isn't traced. """
+    if meta and isinstance(meta[0], dict) and "trace" in meta[0]:
+        return dict(meta[0], start=kfc.now())
+    return None
+
+def trace_end(trace):
+    """ Return the trace of a request handled by now, to be sent with its confirmation. """
+    return dict(trace, end=kfc.now()) if trace else None
+
+def prepare_move_cnf(move_state, game_id, player_id, trace=None):
+    """ Prepare json for a move command response.
+
+    The move holds the new contents of every square it changed (a castle moves the rook too,
+    a capture or promotion replaces a piece), the new castle rights, move number and game state.
+    The trace of the move-req, if any, is sent along (see trace_end). """
     data = None
     if move_state != None:
         move, state = move_state
@@ -111,23 +656,58 @@ def prepare_move_cnf(move_state, game_id, player_id):
                 "from":    move.from_sq.san,
                 "to":      move.to_sq.san,
                 "promote": move.promote,
-                "time":    move.time
+                "time":    move.time,
+                # everything the move changed, so clients can apply it as a patch
+                "changes":     move.changes,
+                "castles":     move.castles,
+                "move_number": move.move_number,
+                "state":       state
                 }
         data = {"state": state, "move": move}
+    if trace:
+        return json.dumps([game_id, player_id, 'move-cnf', data, trace])
     return json.dumps([game_id, player_id, 'move-cnf', data])
 
+def prepare_sync_data(db, store_key):
+    """ Prepare the data of a sync command response (also used for snapshots). """
+    board = kfc.to_dict(db, store_key)
+    return {'board': board,
+            'white': board["white"],
+            'black': board["black"]}
+
 def prepare_sync_cnf(game_id, player_id, db, store_key):
     """ Prepare json for a sync command response. """
     try:
-        board = kfc.get_board(db, store_key)
-        res = json.dumps([game_id, player_id, 'sync-cnf', 
-            {'board': kfc.to_dict(db, store_key),
-            'white': board.white,
-            'black': board.black}])
-        return res
+        return json.dumps([game_id, player_id, 'sync-cnf', prepare_sync_data(db, store_key)])
     except ValueError as e:
         return prepare_error_ind(game_id, player_id, reason=repr(e))
 
+def prepare_archive_record(game_id, db, store_key):
+    """ Prepare json of the record of a finished game: players, cooldown, final state and nfen, the
+    nfen it started from and its history (see RedisKungFuBoard.history), and start and end times. """
+    board = kfc.to_dict(db, store_key)
+    redis_board = kfc.get_board(db, store_key)
+    return json.dumps({"game_id":    game_id,
+                       "white":      board["white"],
+                       "black":      board["black"],
+                       "cd":         board["cd"],
+                       "state":      board["state"],
+                       "nfen":       board["nfen"],
+                       "start_nfen": redis_board.start_nfen,
+                       "history":    redis_board.history,
+                       "start_time": board["start_time"],
+                       "end_time":   kfc.now()})
+
+def prepare_ready_ind(game_id, squares, move_time):
+    """ Prepare json for an indication that the pieces on squares, moved at move_time, can move again. """
+    return json.dumps([game_id, -1, 'ready-ind', {"sqs": squares, "time": move_time}])
+
+def prepare_expire_ind(game_id, state):
+    """ Prepare json for an indication that a game expired and was deleted.
+
+    state is the state of the game when it expired, None if redis expired the game key first. """
+    return json.dumps([game_id, -1, 'expire-ind', {"state": state}])
+
 def prepare_exit_cnf():
     return json.dumps(['exit-cnf', multiprocessing.current_process().name])
 
@@ -136,9 +716,21 @@ def prepare_error_ind(game_id=-1, player_id=-1, **kwargs):
     """ prepare an error indication. game_id is -1 if error is not relevant to specific game """
     return json.dumps([game_id, player_id, "error-ind", {k: str(v) for k,v in kwargs.items()}])
 
+def percentile(samples, p):
+    """ Return the p-th percentile of a sorted list of samples, or 0 if there are none. """
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
 if __name__ == "__main__":
     import sys
-    _, in_q, out_q, host, port = sys.argv
+    _, in_q, out_q, host, port, *flags = sys.argv
+    options = dict(flag.split("=", 1) for flag in flags if "=" in flag)
+    logs.configure(levels=logs.parse_levels(options.get("--log-levels")),
+                   samples=logs.parse_levels(options.get("--log-sample")),
+                   path=options.get("--log-file"))
 
     db = redis.StrictRedis(host=host, port=port)
-    run_game_manager(db, in_q, out_q)
+    run_game_manager(db, in_q, out_q, fanout="--fanout" in flags, notify_ready="--notify-ready" in flags,
+                     snapshots="--snapshots" in flags, archive_queue=options.get("--archive"),
+                     profile_dir=options.get("--profile-dir"))
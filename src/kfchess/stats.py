@@ -0,0 +1,93 @@
+"""
+stats.py
+
+Query the live internals of a running game manager, through its input queue (see stats-req and
+profile-req in redis_games_manager).
+
+    python -m kfchess.stats in host port [--timeout=<s>] [--top=<n>] [--tracemalloc=on|off] [--json]
+    python -m kfchess.stats in host port --profile=<ms> [--interval=<ms>]
+
+--tracemalloc=on starts tracing allocations in the manager, so that the following queries list its
+top allocation sites, until --tracemalloc=off. Tracing slows the manager down noticeably.
+
+--profile samples the manager's stack for the given duration (see kfchess.profiler), and prints
+where the collapsed stacks were written on the manager's host.
+"""
+import json
+from uuid import uuid4
+
+import redis
+
+import kfchess.game as kfc
+from kfchess.redis_games_manager import queue_for, lane_for, LANES
+from kfchess.profiler import DEFAULT_INTERVAL
+
+def query(db, in_queue, cmd, options, timeout):
+    """ Send an admin request cmd with options to the manager reading in_queue, and return the data
+    of its reply, or None if there was none within timeout seconds. """
+    client = "{}:{}".format(cmd, uuid4().hex[:12])
+    reply  = "{}:{}".format(in_queue, client)
+    db.rpush(queue_for(in_queue, lane_for(cmd)),
+             json.dumps([-1, client, cmd, dict(options, reply=reply), {"t": kfc.now()}]))
+    res = db.blpop(reply, timeout)
+    db.delete(reply)
+    if res is None:
+        return None
+    return json.loads(res[1])[3]
+
+def query_stats(db, in_queue, timeout=5, **options):
+    """ Send a stats-req to the manager reading in_queue, return its stats or None on timeout.
+
+    options are sent along with the request (top, tracemalloc). """
+    return query(db, in_queue, "stats-req", options, timeout)
+
+def query_profile(db, in_queue, duration, interval=DEFAULT_INTERVAL, timeout=5):
+    """ Ask the manager reading in_queue for a profile of duration ms, and wait for it.
+
+    Return the path and number of samples of the profile, or None if the manager was already
+    profiling or didn't reply in time. """
+    return query(db, in_queue, "profile-req", {"duration": duration, "interval": interval},
+                 timeout + -(-duration // 1000))
+
+def format_stats(stats):
+    """ Return stats as a human readable report. """
+    proc  = stats["processing"]
+    lines = ["pid {pid}, up {uptime_s:.0f}s, rss {rss} kB".format(uptime_s=stats["uptime"] / 1000, **stats),
+             "queues: " + ", ".join("{} {}".format(lane, stats["queues"]["in"][lane]) for lane in LANES) +
+             ", out {}".format(stats["queues"]["out"]),
+             "games: " + ", ".join("{} {}".format(k, v) for k, v in sorted(stats["games"].items())),
+             "processing (ms): {count} requests, mean {mean:.2f} p50 {p50:.2f} p95 {p95:.2f} "
+             "p99 {p99:.2f} max {max:.2f}".format(**proc)]
+    for cmd, req in sorted(stats["requests"].items(), key=lambda item: -item[1]["count"]):
+        lines.append("    {:<12} {:>8} mean {:.2f}".format(str(cmd), req["count"], req["mean"]))
+    lines.append("errors: " + (", ".join("{} {}".format(k, v) for k, v in stats["errors"].items()) or "none"))
+    lines.append("queue waits (ms): " + ", ".join("{} p50 {p50} p99 {p99}".format(lane, **stats["waits"][lane])
+                                                   for lane in LANES))
+    if stats["allocations"] is not None:
+        lines.append("top allocations:")
+        for alloc in stats["allocations"]:
+            lines.append("    {size:>8} kB {count:>8} {site}".format(**alloc))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    import sys
+    _, in_q, host, port, *flags = sys.argv
+    options = dict(flag.split("=", 1) for flag in flags if "=" in flag)
+
+    db = redis.StrictRedis(host=host, port=port)
+    timeout = int(options.get("--timeout", 5))
+    if "--profile" in options:
+        profile = query_profile(db, in_q, int(options["--profile"]),
+                                int(options.get("--interval", DEFAULT_INTERVAL)), timeout)
+        if profile is None:
+            sys.exit("No profile from the manager on {} (already profiling?)".format(in_q))
+        print("{samples} samples written to {path}".format(**profile))
+        sys.exit()
+
+    request = {"top": int(options.get("--top", 10))}
+    if "--tracemalloc" in options:
+        request["tracemalloc"] = options["--tracemalloc"] == "on"
+    stats = query_stats(db, in_q, timeout=timeout, **request)
+    if stats is None:
+        sys.exit("No reply from the manager on {}".format(in_q))
+    print(json.dumps(stats, indent=2) if "--json" in flags else format_stats(stats))
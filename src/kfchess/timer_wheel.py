@@ -0,0 +1,87 @@
+"""
+timer_wheel.py
+
+Hierarchical timing wheel (Varghese & Lauck) used to track piece cooldown expirations.
+
+Time is divided into ticks of a fixed resolution. Level 0 holds a slot per tick for the next
+`slots` ticks, each higher level holds a slot per full rotation of the level below it. Timers
+are inserted into the lowest level that covers them and cascade down as time advances, so both
+inserting and expiring a timer are O(1), regardless of the number of pending timers.
+"""
+
+
+class TimerWheel():
+    """ A hierarchical timer wheel of arbitrary items expiring at given times (milliseconds). """
+
+    def __init__(self, start, resolution=10, slots=64, levels=4):
+        """ Create a wheel starting at time start, with ticks of resolution milliseconds.
+
+        slots must be a power of two. Timers further than slots**levels ticks away are parked in
+        the top level and cascaded again until they are in range. """
+        if slots & (slots - 1):
+            raise ValueError("Number of slots must be a power of two")
+        self._resolution = resolution
+        self._bits       = slots.bit_length() - 1
+        self._mask       = slots - 1
+        self._levels     = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._tick       = start // resolution
+        self._due        = []
+        self._count      = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, when, item):
+        """ Schedule item to expire at time when. Items due already expire on the next advance. """
+        self._count += 1
+        self._insert(-(-when // self._resolution), item)  # round up, never expire early
+
+    def advance(self, now):
+        """ Advance the wheel to time now, returning a list of the expired items. """
+        target  = now // self._resolution
+        expired = self._due
+        self._due = []
+        while self._tick < target:
+            self._tick += 1
+            self._cascade()
+            if self._due:
+                expired.extend(self._due)
+                self._due = []
+            slot = self._levels[0][self._tick & self._mask]
+            if slot:
+                expired.extend(item for _, item in slot)
+                slot.clear()
+        self._count -= len(expired)
+        return expired
+
+    @property
+    def next_tick_time(self):
+        """ Time at which the next tick will be processed. """
+        return (self._tick + 1) * self._resolution
+
+    def _insert(self, expire, item):
+        delta = expire - self._tick
+        if delta <= 0:
+            self._due.append(item)
+            return
+        for level, slots in enumerate(self._levels):
+            if delta < 1 << (self._bits * (level + 1)):
+                slots[(expire >> (self._bits * level)) & self._mask].append((expire, item))
+                return
+        # too far away, park in the last slot of the top level to be cascaded again
+        level = len(self._levels) - 1
+        slot  = ((self._tick >> (self._bits * level)) - 1) & self._mask
+        self._levels[level][slot].append((expire, item))
+
+    def _cascade(self):
+        """ Move timers of higher levels whose slot starts at the current tick to lower levels. """
+        level = 1
+        while level < len(self._levels) and not self._tick & ((1 << (self._bits * level)) - 1):
+            level += 1
+        for level in reversed(range(1, level)):
+            slot = self._levels[level][(self._tick >> (self._bits * level)) & self._mask]
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                for expire, item in timers:
+                    self._insert(expire, item)
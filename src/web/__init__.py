@@ -8,14 +8,16 @@ from flask import Flask
 
 from flask_socketio import SocketIO
 from flask_login import LoginManager
-from flask_mysqldb import MySQL
 from flask_bcrypt import Bcrypt
 
-from web import defaultconfig
+from kfchess import logs
+
+from web import defaultconfig, hubwatch
+from web.mysql_pool import MySQLPool
 
 socketio = SocketIO()
 login_manager = LoginManager()
-mysql = MySQL()
+mysql = MySQLPool()
 bcrypt = Bcrypt()
 
 def create_app():
@@ -28,16 +30,25 @@ def create_app():
     else:
         print("KFCHESS_CONFIG envvar is not present, using default config")
 
+    logs.configure(app.config["LOG_LEVELS"], app.config["LOG_SAMPLE"], app.config["LOG_FILE"])
+    if app.config["HUB_WATCH"]:
+        hubwatch.start_hub_watch(app.config["HUB_SLOW_THRESHOLD"], app.config["HUB_LAG_INTERVAL"])
+
     app.redis = redis.StrictRedis(host=app.config["REDIS_HOSTNAME"],
                                   port=app.config["REDIS_PORT"])
 
-    socketio.init_app(app)
+    # cross-node emits go through redis, so the web tier can run as several processes
+    message_queue = app.config["SOCKETIO_MESSAGE_QUEUE"]
+    if message_queue is None:
+        message_queue = "redis://{}:{}".format(app.config["REDIS_HOSTNAME"], app.config["REDIS_PORT"])
+    socketio.init_app(app, message_queue=message_queue)
     login_manager.init_app(app)
     mysql.init_app(app)
     bcrypt.init_app(app)
 
     # this weird local import on create seems to be necessitated by flask-socketio's lack of support of blueprints
     from web.main import main, user
+    user.init_users(app)
     app.register_blueprint(main, url_prefix='/')
 
     from web.game import game_bp, init_game
@@ -32,10 +32,13 @@ CREATE TABLE IF NOT EXISTS `game` (
         ON DELETE SET NULL,
 
     `white_rating` SMALLINT NULL,
-    `black_int` SMALLINT NULL,
+    `black_rating` SMALLINT NULL,
 
-    `history` VARCHAR(1024) NULL,
+    `history` TEXT NULL,
+    `nfen` VARCHAR(127) NULL,
     `winner` ENUM('BLACK', 'WHITE') NULL,
     `state` ENUM('WAITING', 'PLAYING', 'DONE') NOT NULL,
+    `started_on` DATETIME NULL,
+    `duration` INT UNSIGNED NULL,
     PRIMARY KEY (`game_id`)
 );
@@ -10,11 +10,106 @@ REDIS_GAMES_STORE          = "games"
 REDIS_GAMES_REQ_QUEUE      = "reqs"
 REDIS_GAMES_CNF_QUEUE      = "cnfs"
 
+# Message queue used by socketio for emits between web processes, None to use the redis above.
+SOCKETIO_MESSAGE_QUEUE     = None
+
+# Confirmations are read in batches of up to CNF_BATCH_SIZE by CNF_READERS greenlets, moves of a
+# game arriving within CNF_COALESCE_WINDOW milliseconds are emitted together.
+CNF_READERS                = 4
+CNF_BATCH_SIZE             = 64
+CNF_COALESCE_WINDOW        = 10
+
 MYSQL_HOST                 = "127.0.0.1"
 MYSQL_USER                 = "kfchess"
 MYSQL_PASSWORD             = "passw0rd"
 MYSQL_DB                   = "kfchess"
 
+# Connections pooled per web process, and how long (seconds) to wait for a free one
+MYSQL_POOL_SIZE            = 8
+MYSQL_POOL_TIMEOUT         = 5
+
+# Users loaded by Flask-Login are cached per web process for USER_CACHE_TTL seconds
+USER_CACHE_SIZE            = 4096
+USER_CACHE_TTL             = 300
+
+# Passwords are hashed on up to PASSWORD_HASH_THREADS OS threads, with up to PASSWORD_HASH_QUEUE
+# more waiting before logins and registrations are turned away
+PASSWORD_HASH_THREADS      = 4
+PASSWORD_HASH_QUEUE        = 64
+
+# Finished games are queued by the manager (with --archive=<queue>) for the archiver
+# (python -m web.game.archive), which writes them to MySQL in batches of up to ARCHIVE_BATCH_SIZE,
+# retrying a failed batch up to ARCHIVE_RETRIES times.
+REDIS_GAMES_ARCHIVE_QUEUE  = "archive"
+ARCHIVE_BATCH_SIZE         = 100
+ARCHIVE_RETRIES            = 5
+# Path (without extension) of an archive file the archiver appends games to as well, see
+# kfchess/archive_file.py. None to archive to MySQL only.
+ARCHIVE_FILE               = None
+
+# Games against bots are handed to the bot workers (python -m kfchess.bot.runner) on this queue.
+# Bots follow their games on game channels, so the manager must run with --fanout.
+REDIS_BOTS_QUEUE           = "bots"
+
+# Elo K factor and rating of new players. After changing them, recompute all ratings from the
+# archived games with python -m web.ratings
+RATING_K                   = 32
+RATING_INITIAL             = 1500
+
+# Number of game snapshots (published by the manager for spectators) cached by each web process
+SNAPSHOT_CACHE_SIZE        = 1024
+
+# Moves are rejected by the web tier for cooldown only if it has more than this many ms left
+MOVE_GATE_COOLDOWN_SLACK   = 50
+
+# Token buckets of game commands per player, as cmd: (tokens per second, burst), commands not
+# listed are not limited. With RATE_LIMIT_SHARED the buckets are kept in redis, limiting players
+# across all web processes rather than per process.
+RATE_LIMITS                = {"move-req":    (10, 20),
+                              "premove-req": (10, 20),
+                              "sync-req":    (2, 10),
+                              "join-req":    (1, 5),
+                              "match-req":   (1, 5)}
+RATE_LIMIT_SHARED          = False
+
+# Number of recent ping exchanges kept per client to estimate its clock offset
+CLOCK_SAMPLES              = 8
+
+# Levels of the log categories (see kfchess/logs.py), "manager", "game", "requests", "cnfs" and "hub".
+# Every request and confirmation is logged at DEBUG, LOG_SAMPLE sets the share of debug and info
+# events of a category that are logged. Events go to LOG_FILE (JSON lines), or stderr if None.
+LOG_LEVELS                 = {"requests": "INFO", "cnfs": "INFO"}
+LOG_SAMPLE                 = {"requests": 0.01, "cnfs": 0.01}
+LOG_FILE                   = None
+
+# Token of the admin endpoints of web workers (/game/admin/...), None disables them.
+ADMIN_TOKEN                = None
+
+# Web workers can be profiled by a POST to /game/admin/profile (see kfchess/profiler.py).
+# Profiles are written to PROFILE_DIR (the temp dir if None).
+PROFILE_DIR                = None
+
+# Watch the eventlet hub of web workers for greenlets running HUB_SLOW_THRESHOLD ms or more
+# without yielding, and measure the hub lag every HUB_LAG_INTERVAL ms (see web/hubwatch.py).
+# The report is served by /game/admin/hub. Off by default, as every greenlet switch is traced.
+HUB_WATCH                  = False
+HUB_SLOW_THRESHOLD         = 100
+HUB_LAG_INTERVAL           = 100
+
+# Share of game requests traced from push_req to the emit of their confirmation (0 to 1), see
+# web/game/tracing.py. Traces are appended to TRACE_LOG (JSON lines) if set.
+TRACE_SAMPLE_RATE          = 0.01
+TRACE_LOG                  = None
+
+# Matchmaking offers games with cooldowns in MATCH_CDS (ms). Players are paired within
+# MATCH_WINDOW rating points, widened by MATCH_WIDEN every MATCH_WIDEN_INTERVAL ms of waiting,
+# up to MATCH_MAX_WINDOW. Pairing is done by python -m web.game.matchmaking.
+MATCH_CDS                  = [1000, 5000, 10000]
+MATCH_WINDOW               = 50
+MATCH_WIDEN                = 50
+MATCH_WIDEN_INTERVAL       = 5000
+MATCH_MAX_WINDOW           = 500
+
 #BCRYPT_HANDLE_LONG_PASSWORDS = True
 # Games will be deleted without result if no move (from either player) was made during this time.
 GAME_MAX_LENGTH  = 3600
@@ -2,28 +2,58 @@ import json
 
 from flask import Blueprint
 
-from . import queue_reader
+from kfchess.redis_games_manager import lane_for, queue_for
+from kfchess.game import now
+from kfchess import logs, profiler
+
+from . import queue_reader, clock, snapshots, validation, ratelimit, matchmaking, tracing
+
+log = logs.get_log("requests")
+
+_profiler = None
 
 game_bp = Blueprint('game', __name__, static_folder='static', template_folder='templates')
 
 def init_game(i_app, i_socketio):
-    global _app
+    global _app, _channels, _clocks, _snapshots, _move_gate, _limiter, _matchmaker, _tracer
     _app = i_app
+    _channels = queue_reader.GameChannels(_app.redis, get_cnfs_queue())
+    _clocks = clock.ClockOffsets(_app.config["CLOCK_SAMPLES"])
+    _snapshots = snapshots.SnapshotCache(_app.redis, get_cnfs_queue(), _app.config["SNAPSHOT_CACHE_SIZE"])
+    _move_gate = validation.MoveGate(_snapshots, _app.config["MOVE_GATE_COOLDOWN_SLACK"])
+    _limiter = ratelimit.create_limiter(_app.config["RATE_LIMITS"], _app.config["RATE_LIMIT_SHARED"],
+                                        _app.redis, _app.config["REDIS_STORE_KEY"])
+    _matchmaker = matchmaker_from_config(_app.redis, _app.config)
+    _tracer = tracing.Tracer(_app.config["TRACE_SAMPLE_RATE"], _app.config["TRACE_LOG"])
 
+    readers = {"readers":    _app.config["CNF_READERS"],
+               "batch_size": _app.config["CNF_BATCH_SIZE"],
+               "window":     _app.config["CNF_COALESCE_WINDOW"],
+               "tracer":     _tracer}
     _t = i_socketio.start_background_task(queue_reader.poll_game_cnfs, _app.redis,
             "{}:games".format(_app.config["REDIS_STORE_KEY"]),
             get_cnfs_queue(),
-            i_socketio)
+            i_socketio, **readers)
+    _tc = i_socketio.start_background_task(queue_reader.poll_game_channels, _channels, _app.redis,
+            "{}:games".format(_app.config["REDIS_STORE_KEY"]),
+            i_socketio, **readers)
+
+def game_id_key(config):
+    return "{}:games:game_id".format(config["REDIS_STORE_KEY"])
 
 def next_game_id():
-    key = "{}:games:game_id".format(_app.config["REDIS_STORE_KEY"])
-    cid = _app.redis.get(key)
-    print(cid)
-    if not cid:
-        cid = 0
-    cid = int(cid) + 1
-    _app.redis.set(key, cid)
-    return cid
+    # atomic, as the matchmaker takes game ids from the same counter
+    return _app.redis.incr(game_id_key(_app.config))
+
+def matchmaker_from_config(db, config):
+    """ Create the matchmaker (see matchmaking.py) of the given app config. """
+    return matchmaking.Matchmaker(db, "{}:matchmaking".format(config["REDIS_STORE_KEY"]),
+                                  config["REDIS_GAMES_REQ_QUEUE"], config["REDIS_GAMES_CNF_QUEUE"],
+                                  game_id_key(config), config["MATCH_CDS"],
+                                  window=config["MATCH_WINDOW"], widen=config["MATCH_WIDEN"],
+                                  widen_interval=config["MATCH_WIDEN_INTERVAL"],
+                                  max_window=config["MATCH_MAX_WINDOW"],
+                                  game_exp=config["GAME_MAX_LENGTH"] * 1000)
 
 def get_active_game_set():
     return "{}:games:playing".format(_app.config["REDIS_STORE_KEY"])
@@ -38,10 +68,59 @@ def redis_game_store():
 def get_app():
     return _app
 
-def push_req(req, payload, game_id, player_id):
-    q_id = get_app().config["REDIS_GAMES_REQ_QUEUE"]
-    print("[{}, {}] Requesting {} ({}) in {}".format(game_id, player_id, req,payload, q_id))
-    _app.redis.rpush (q_id, json.dumps([game_id, player_id, req, payload]))
+def get_game_channels():
+    """ Get the game channel subscriptions of this worker. """
+    return _channels
+
+def get_clock_offsets():
+    """ Get the clock offsets of the clients connected to this worker. """
+    return _clocks
+
+def get_snapshots():
+    """ Get the game snapshots cache of this worker. """
+    return _snapshots
+
+def get_move_gate():
+    """ Get the move pre-validation of this worker. """
+    return _move_gate
+
+def get_rate_limiter():
+    """ Get the game commands rate limiter of this worker. """
+    return _limiter
+
+def get_tracer():
+    """ Get the request tracing of this worker. """
+    return _tracer
+
+def get_matchmaker():
+    """ Get the matchmaking queues (players are paired by the matcher process). """
+    return _matchmaker
+
+def start_profile(duration, interval):
+    """ Profile this worker for duration ms (see kfchess.profiler), writing to PROFILE_DIR.
+
+    Return the profiler, or None if a profile is already running. """
+    global _profiler
+    if _profiler is not None and _profiler.running:
+        return None
+    _profiler = profiler.SamplingProfiler(profiler.profile_path(_app.config["PROFILE_DIR"], "web"), interval)
+    _profiler.start(duration)
+    return _profiler
+
+def push_req(req, payload, game_id, player_id, lane=None):
+    """ Push a request to the game manager, in the lane of req unless another lane is given.
+
+    The enqueue time is sent along so the manager can measure queue waits, and a trace id if the
+    request is sampled for tracing (see tracing.py). """
+    if lane is None:
+        lane = lane_for(req)
+    q_id = queue_for(get_app().config["REDIS_GAMES_REQ_QUEUE"], lane)
+    log.debug("request", game=game_id, player=player_id, cmd=req, data=payload, queue=q_id)
+    meta = {"t": now()}
+    trace = _tracer.new_trace()
+    if trace is not None:
+        meta["trace"] = trace
+    _app.redis.rpush (q_id, json.dumps([game_id, player_id, req, payload, meta]))
     _app.redis.expire(q_id, 3600)
 
 def get_cnfs_queue():
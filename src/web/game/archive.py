@@ -0,0 +1,274 @@
+"""
+archive.py
+
+Archival of finished games to MySQL.
+
+The game manager (run with --archive=<queue>) pushes a record of every finished game to a redis
+queue and deletes the game from redis. The archiver moves records from the queue to a processing
+list, writes them with a single multi-row INSERT per batch in one transaction, and only then
+drops the processing list, so no game is lost if the archiver dies midway. Games already
+archived are skipped, so records left in the processing list are simply written again.
+
+The players of decisive games are rated (see web.ratings) in the same transaction, and their
+ratings before the game are stored with it. The leaderboard is updated once it commits.
+
+If ARCHIVE_FILE is set, games are also appended to an archive file (see kfchess.archive_file)
+once written to MySQL, for analytics and replays. Only games newly inserted are appended, so a
+batch written again after a crash isn't appended twice (but a crash between the commit and the
+append leaves its games out of the file).
+
+Run as `python -m web.game.archive`, configured like the web app (KFCHESS_CONFIG).
+"""
+import json
+import time
+import traceback
+from datetime import datetime
+
+import MySQLdb
+
+from kfchess.game import W_WINS, B_WINS
+from kfchess.archive_file import ArchiveWriter
+
+from web.ratings import rate, update_ratings, SCORES, DEFAULT_K, DEFAULT_RATING
+
+COLUMNS = ["game_id", "white_user_id", "black_user_id", "white_rating", "black_rating", "history",
+           "nfen", "winner", "state", "started_on", "duration"]
+
+WINNERS = {W_WINS: "WHITE", B_WINS: "BLACK"}
+
+def insert_games_query(count):
+    """ Return a query inserting count games, leaving already archived games as they are. """
+    row = "({})".format(", ".join(["%s"] * len(COLUMNS)))
+    return "INSERT INTO `game` ({}) VALUES {} ON DUPLICATE KEY UPDATE `game_id` = `game_id`".format(
+            ", ".join("`{}`".format(c) for c in COLUMNS), ", ".join([row] * count))
+
+def user_id(player):
+    """ Return the user id of a player, None for players without a user row (bots, guests). """
+    player = str(player) if player is not None else ""
+    return int(player) if player.isdigit() else None
+
+def game_row(record):
+    """ Return the game table row (a dictionary of COLUMNS) of a record of a finished game.
+    Ratings are filled when the game is archived. """
+    winner = WINNERS.get(record["state"])
+    start, end = record.get("start_time"), record.get("end_time")
+    return {"game_id":       int(record["game_id"]),
+            "white_user_id": user_id(record["white"]),
+            "black_user_id": user_id(record["black"]),
+            "white_rating":  None,
+            "black_rating":  None,
+            "history":       " ".join(record["history"]),
+            "nfen":          record["nfen"],
+            "winner":        winner,
+            "state":         "DONE" if winner else str(record["state"]).upper(),
+            "started_on":    datetime.utcfromtimestamp(start / 1000) if start else None,
+            "duration":      end - start if start and end else None}
+
+def inserted_games(parsed, inserted):
+    """ Return the games of parsed ((record, game, row) tuples) whose rows are in inserted, once each. """
+    ids = {row["game_id"] for row in inserted}
+    games = {}
+    for _, game, row in parsed:
+        if row["game_id"] in ids:
+            games.setdefault(row["game_id"], game)
+    return list(games.values())
+
+def rate_games(cur, rows, k=DEFAULT_K, initial=DEFAULT_RATING):
+    """ Rate the players of the decisive games in rows (in order) with cursor cur, locking them
+    until the transaction ends. Fill the ratings before each game in rows, and return the new
+    ratings (user_id -> rating). """
+    rows = [row for row in rows if row["winner"] and row["white_user_id"] and row["black_user_id"]]
+    if not rows:
+        return {}
+    players = list({str(row[color]) for row in rows for color in ("white_user_id", "black_user_id")})
+    cur.execute("SELECT `user_id`, `rating` FROM `user` WHERE `user_id` IN ({}) FOR UPDATE".format(
+                ", ".join(["%s"] * len(players))), players)
+    ratings = {str(user_id): rating if rating is not None else initial
+               for user_id, rating in cur.fetchall()}
+
+    rated = {}
+    for row in rows:
+        white, black = str(row["white_user_id"]), str(row["black_user_id"])
+        if white not in ratings or black not in ratings:
+            continue  # deleted player
+        row["white_rating"], row["black_rating"] = round(ratings[white]), round(ratings[black])
+        ratings[white], ratings[black] = rate(ratings[white], ratings[black], SCORES[row["winner"]], k)
+        rated[white], rated[black] = ratings[white], ratings[black]
+    update_ratings(cur, rated)
+    return rated
+
+class GameArchiver():
+    """ Move finished games from a redis queue to MySQL, in batches. """
+
+    def __init__(self, db, queue, connect, batch_size=100, retries=5, backoff=500,
+                 leaderboard=None, k=DEFAULT_K, initial=DEFAULT_RATING, archive_file=None):
+        """ Archive records from queue in db, to MySQL connections made by connect().
+
+        A batch failing to be written (e.g. lost connection or deadlock) is retried up to retries
+        times, backing off from backoff milliseconds, and then left in the processing list for the
+        next batch. If the data itself is rejected, its games are written one at a time and the
+        ones failing again are moved to the "<queue>:failed" list.
+
+        Players are rated with factor k, starting from initial, and leaderboard (a
+        web.ratings.Leaderboard) is updated if given.
+
+        If archive_file (a kfchess.archive_file.ArchiveWriter) is given, the games of every batch
+        are appended to it once inserted. """
+        self._db         = db
+        self._queue      = queue
+        self._processing = "{}:processing".format(queue)
+        self._failed     = "{}:failed".format(queue)
+        self._connect    = connect
+        self._conn       = None
+        self._batch_size = batch_size
+        self._retries    = retries
+        self._backoff    = backoff
+        self._leaderboard = leaderboard
+        self._k          = k
+        self._initial    = initial
+        self._file       = archive_file
+        self.archived    = 0
+        self.failed      = 0
+        self.batches     = 0
+
+    def run(self):
+        while True:
+            self.archive_batch()
+
+    def archive_batch(self, timeout=1):
+        """ Archive the next batch of games, waiting up to timeout seconds for one. Return its size. """
+        records = self._take(timeout)
+        if not records:
+            return 0
+        inserted = self._store(records)
+        if inserted is not None:
+            if self._file is not None:
+                self._write_file(inserted)
+            self._db.delete(self._processing)
+        return len(records)
+
+    def _take(self, timeout):
+        """ Return the records of the next batch, moved to the processing list. """
+        pending = self._db.lrange(self._processing, 0, -1)
+        if pending:  # left from an earlier run
+            return pending
+        first = self._db.brpoplpush(self._queue, self._processing, timeout)
+        if first is None:
+            return []
+        pipe = self._db.pipeline(transaction=False)
+        for _ in range(self._batch_size - 1):
+            pipe.rpoplpush(self._queue, self._processing)
+        return [first] + [r for r in pipe.execute() if r is not None]
+
+    def _store(self, records):
+        """ Write records to MySQL. Return the games (parsed records) inserted, the ones archived
+        before or failing left out, or None if MySQL can't be reached (to try again later). """
+        parsed = []  # (record, game, row)
+        for record in records:
+            try:
+                game = json.loads(record)
+                parsed.append((record, game, game_row(game)))
+            except (ValueError, KeyError, TypeError):
+                traceback.print_exc()
+                self._fail(record)
+        rows = [row for _, _, row in parsed]
+
+        for attempt in range(self._retries + 1):
+            try:
+                inserted = self._insert(rows)
+                self.archived += len(inserted)
+                self.batches  += 1
+                return inserted_games(parsed, inserted)
+            except MySQLdb.OperationalError:
+                traceback.print_exc()
+                self._conn = None  # reconnect, the connection may be gone
+                if attempt == self._retries:
+                    return None
+                time.sleep(self._backoff * 2 ** attempt / 1000)
+            except MySQLdb.Error:
+                traceback.print_exc()
+                break
+
+        # a single bad game fails the whole batch, find it
+        inserted = []
+        for record, _, row in parsed:
+            try:
+                row_inserted = self._insert([row])
+                inserted += row_inserted
+                self.archived += len(row_inserted)
+            except MySQLdb.OperationalError:
+                traceback.print_exc()
+                self._conn = None
+                return None
+            except MySQLdb.Error:
+                traceback.print_exc()
+                self._fail(record)
+        return inserted_games(parsed, inserted)
+
+    def _insert(self, rows):
+        """ Insert rows not archived yet in a single statement, rating their players, in one transaction.
+        Return the rows inserted. """
+        if not rows:
+            return []
+        if self._conn is None:
+            self._conn = self._connect()
+        cur = self._conn.cursor()
+        try:
+            ids = [row["game_id"] for row in rows]
+            cur.execute("SELECT `game_id` FROM `game` WHERE `game_id` IN ({}) FOR UPDATE".format(
+                        ", ".join(["%s"] * len(ids))), ids)
+            archived = {game_id for game_id, in cur.fetchall()}
+            unique = {}  # a game may be queued twice, insert it once
+            for row in rows:
+                if row["game_id"] not in archived:
+                    unique.setdefault(row["game_id"], row)
+            rows = list(unique.values())
+            ratings = rate_games(cur, rows, self._k, self._initial)
+            if rows:
+                cur.execute(insert_games_query(len(rows)), [row[c] for row in rows for c in COLUMNS])
+            self._conn.commit()
+        except MySQLdb.Error:
+            try:
+                self._conn.rollback()
+            except MySQLdb.Error:
+                self._conn = None
+            raise
+        finally:
+            cur.close()
+        if self._leaderboard is not None:
+            self._leaderboard.update(ratings)
+        return rows
+
+    def _write_file(self, games):
+        """ Append games (parsed records) to the archive file, skipping the ones it can't hold. """
+        for game in games:
+            try:
+                self._file.append(game)
+            except ValueError:
+                traceback.print_exc()
+        self._file.flush()
+
+    def _fail(self, record):
+        self.failed += 1
+        self._db.rpush(self._failed, record)
+
+if __name__ == "__main__":
+    import os
+    import redis
+    from flask import Config
+    from web.ratings import Leaderboard, leaderboard_key
+
+    config = Config(os.getcwd())
+    config.from_object("web.defaultconfig")
+    if "KFCHESS_CONFIG" in os.environ:
+        config.from_envvar("KFCHESS_CONFIG")
+
+    db = redis.StrictRedis(host=config["REDIS_HOSTNAME"], port=config["REDIS_PORT"])
+    connect = lambda: MySQLdb.connect(host=config["MYSQL_HOST"], user=config["MYSQL_USER"],
+                                      passwd=config["MYSQL_PASSWORD"], db=config["MYSQL_DB"])
+    leaderboard = Leaderboard(db, leaderboard_key(config["REDIS_STORE_KEY"]))
+    archive_file = ArchiveWriter(config["ARCHIVE_FILE"]) if config["ARCHIVE_FILE"] else None
+    GameArchiver(db, config["REDIS_GAMES_ARCHIVE_QUEUE"], connect,
+                 batch_size=config["ARCHIVE_BATCH_SIZE"], retries=config["ARCHIVE_RETRIES"],
+                 leaderboard=leaderboard, k=config["RATING_K"], initial=config["RATING_INITIAL"],
+                 archive_file=archive_file).run()
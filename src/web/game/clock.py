@@ -0,0 +1,42 @@
+"""
+clock.py
+
+NTP-style estimation of the clock offset and round trip time of clients.
+
+A client sends a ping-req with its send time t0, and the server answers with a ping-cnf holding
+t0, its receive time t1 and its send time t2. The client notes the receive time t3 and sends the
+four timestamps along with its next ping-req, so that the offsets are kept on the server.
+As in NTP, the sample with the smallest round trip among the last few is the most accurate one.
+"""
+from collections import deque
+
+class ClockOffsets():
+    """ Clock offset (server time - client time) and round trip estimates of connected clients. """
+
+    def __init__(self, samples=8):
+        self._samples = samples
+        self._clients = {}  # sid -> deque of (rtt, offset)
+
+    def sample(self, sid, t0, t1, t2, t3):
+        """ Record a ping exchange of a client. Exchanges that can't be right are ignored. """
+        t0, t1, t2, t3 = (int(t) for t in (t0, t1, t2, t3))
+        rtt = (t3 - t0) - (t2 - t1)
+        if rtt < 0 or t2 < t1:
+            return
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self._clients.setdefault(sid, deque(maxlen=self._samples)).append((rtt, offset))
+
+    def estimate(self, sid):
+        """ Return (offset, rtt) of a client in milliseconds, or None if it has no samples. """
+        samples = self._clients.get(sid)
+        if not samples:
+            return None
+        rtt, offset = min(samples)
+        return offset, rtt
+
+    def drop(self, sid):
+        """ Forget a disconnected client. """
+        self._clients.pop(sid, None)
+
+    def __len__(self):
+        return len(self._clients)
@@ -6,12 +6,32 @@ from flask_socketio import emit, join_room, rooms
 from flask_login import current_user
 from flask import request
 
-from web.game import push_req
-from web.game.queue_reader import FAIL
+from kfchess.redis_games_manager import LOBBY_LANE
+from kfchess.game import now
+
+from web.game import push_req, get_game_channels, get_clock_offsets, get_snapshots, get_move_gate, \
+    get_rate_limiter, get_matchmaker
+from web.ratings import DEFAULT_RATING
+from web.game.queue_reader import FAIL, prepare_sync_payload
 from web import socketio
 
-def send_sync_req(game_id, player_id):
-    push_req("sync-req", None, game_id, player_id)
+def send_sync_req(game_id, player_id, lane=None):
+    push_req("sync-req", None, game_id, player_id, lane)
+
+def send_cached_sync(game_id, player_id):
+    """ Sync the requesting socket from the game snapshot, without going through the manager.
+
+    Return False if there is no snapshot of the game. """
+    data = get_snapshots().get(game_id)
+    if data is None:
+        return False
+    payload = prepare_sync_payload(player_id, data)
+    payload['board'] = dict(payload['board'], current_time=now())
+    # the client's clock offset as estimated here (see handle_ping_req), to place the board's times
+    estimate = get_clock_offsets().estimate(request.sid)
+    payload['clock_offset'] = estimate[0] if estimate else None
+    emit('sync-cnf', payload)
+    return True
 
 def send_join_req(game_id, player_id):
     push_req("join-req", None, game_id, player_id)
@@ -19,28 +39,119 @@ def send_join_req(game_id, player_id):
 def send_move_req(game_id, player_id, move):
     push_req("move-req", move, game_id, player_id)
 
+def send_premove_req(game_id, player_id, move):
+    push_req("premove-req", move, game_id, player_id)
+
+
+def requester_id():
+    """ Id of the player (or anonymous socket) sending the current request. """
+    return current_user.get_id() if current_user.is_authenticated else request.sid
+
+def reject_move(game_id, player_id, move, premove=False):
+    """ Check a move in the web tier, answering right away with a failed move-cnf if it's invalid
+    or the player is sending too many.
+
+    Return True if the move was rejected. """
+    if not get_rate_limiter().allow(player_id, "premove-req" if premove else "move-req"):
+        reason = "rate limited"
+    else:
+        reason = get_move_gate().check(game_id, player_id, move, premove)
+    if reason is None:
+        return False
+    emit('move-cnf', {'result': FAIL, 'reason': reason})
+    return True
 
 @socketio.on('move-req', namespace='/game')
 def handle_game_move(game_id, move_json):
     """ ask to play a move """
     if current_user.is_authenticated:
         sid = current_user.get_id()
-        send_move_req(game_id, sid, move_json)
+        if not reject_move(game_id, sid, move_json):
+            send_move_req(game_id, sid, move_json)
+    else:
+        emit('move-cnf', {'result': FAIL, 'reason': "not a player"})
+
+@socketio.on('premove-req', namespace='/game')
+def handle_game_premove(game_id, move_json):
+    """ ask to play a move as soon as the piece is off cooldown """
+    if current_user.is_authenticated:
+        sid = current_user.get_id()
+        if not reject_move(game_id, sid, move_json, premove=True):
+            send_premove_req(game_id, sid, move_json)
+    else:
+        emit('move-cnf', {'result': FAIL, 'reason': "not a player"})
 
 @socketio.on('join-req', namespace='/game')
 def handle_join_req(game_id):
     """ Ask to get updates for given game id"""
+    if not get_rate_limiter().allow(requester_id(), "join-req"):
+        return
     join_room(game_id)
-    sid = current_user.get_id() if current_user.is_authenticated else request.sid
+    get_game_channels().subscribe(game_id, request.sid)
+    sid = requester_id()
     if current_user.is_authenticated:
+        # the sync must not overtake the join (or the game creation before it), so it rides the same lane
         send_join_req(game_id, sid)
-    send_sync_req(game_id, sid)
+        send_sync_req(game_id, sid, LOBBY_LANE)
+    elif not send_cached_sync(game_id, sid):
+        send_sync_req(game_id, sid)
 
 @socketio.on('sync-req', namespace='/game')
 def handle_sync_req(game_id):
     """ ask to be synced about the state of the game """
-    sid = current_user.get_id() if current_user.is_authenticated else request.sid
-    send_sync_req(game_id, sid)
+    sid = requester_id()
+    if not get_rate_limiter().allow(sid, "sync-req"):
+        return
+    if not send_cached_sync(game_id, sid):
+        send_sync_req(game_id, sid)
+
+@socketio.on('match-req', namespace='/game')
+def handle_match_req(match):
+    """ Look for an opponent for a game with cooldown match["cd"], a match-ind comes when found. """
+    if not current_user.is_authenticated or not get_rate_limiter().allow(requester_id(), "match-req"):
+        return
+    try:
+        cd = int(match["cd"])
+    except (KeyError, TypeError, ValueError):
+        cd = None
+    rating = current_user.rating if current_user.rating is not None else DEFAULT_RATING
+    if not get_matchmaker().enqueue(current_user.get_id(), rating, cd, request.sid):
+        emit('match-cnf', {'result': FAIL, 'reason': "invalid cd"})
+        return
+    emit('match-cnf', {'result': "success"})
+
+@socketio.on('match-cancel', namespace='/game')
+def handle_match_cancel():
+    if current_user.is_authenticated:
+        get_matchmaker().cancel(current_user.get_id())
+
+@socketio.on('ping-req', namespace='/game')
+def handle_ping_req(ping):
+    """ Clock synchronization, see web.game.clock.
+
+    ping holds the client send time t0, and the timestamps of the previous exchange (if any) """
+    t1 = now()
+    clocks = get_clock_offsets()
+    try:
+        if ping.get("prev"):
+            clocks.sample(request.sid, *ping["prev"])
+        t0 = int(ping["t0"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return
+    estimate = clocks.estimate(request.sid)
+    emit('ping-cnf', {"t0":     t0,
+                      "t1":     t1,
+                      "offset": estimate[0] if estimate else None,
+                      "rtt":    estimate[1] if estimate else None,
+                      "t2":     now()})
+
+@socketio.on('disconnect', namespace='/game')
+def handle_disconnect():
+    get_game_channels().unsubscribe(request.sid)
+    get_clock_offsets().drop(request.sid)
+    if current_user.is_authenticated:
+        # players who left can't be paired anymore
+        get_matchmaker().cancel(current_user.get_id(), request.sid)
 
 @socketio.on('connect')
 def handle_connect():
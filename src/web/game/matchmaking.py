@@ -0,0 +1,172 @@
+"""
+matchmaking.py
+
+Pairing of players looking for a game, by rating and preferred cooldown.
+
+Waiting players are kept in a sorted set per cooldown, scored by rating, so the closest opponent
+above and below a player are found in O(log n). A player may be paired with anyone within a
+rating window that widens the longer they wait. The matcher (`python -m web.game.matchmaking`)
+doesn't scan all waiting players: a "retry" sorted set holds each player by the time their
+window next widens, and only players who just arrived or whose window just widened are looked
+at. Once paired, a single script checks both are still waiting and atomically removes them,
+queues the game-req and join-req of their game to the manager, and sends both a match-ind.
+"""
+import json
+import random
+import time
+
+from kfchess.game import now
+
+MATCH_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 or redis.call('HEXISTS', KEYS[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREM', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZREM', KEYS[3], ARGV[1], ARGV[2])
+redis.call('RPUSH', KEYS[4], ARGV[3], ARGV[4])
+redis.call('RPUSH', KEYS[5], ARGV[5], ARGV[6])
+return 1
+"""
+
+class Matchmaker():
+    """ Matchmaking queues of players in redis, with the matcher pairing them. """
+
+    def __init__(self, db, key, in_queue, cnfs_queue, game_id_key, cds, window=50, widen=50,
+                 widen_interval=5000, max_window=500, game_exp=3600000):
+        """ Players wait for games with cooldowns in cds under key. Opponents may be window
+        rating points apart, widened by widen every widen_interval milliseconds up to
+        max_window. Games (expiring after game_exp) get ids from the counter at game_id_key and
+        are requested on the manager's in_queue, match-inds are sent to the web tier on cnfs_queue. """
+        self._db         = db
+        self._key        = key
+        self._in         = in_queue
+        self._cnfs       = cnfs_queue
+        self._cds        = list(cds)
+        self._window     = window
+        self._widen      = widen
+        self._interval   = widen_interval
+        self._max_window = max_window
+        self._game_exp   = game_exp
+        self._game_id    = game_id_key
+        self._players    = "{}:players".format(key)
+        self._retry      = "{}:retry".format(key)
+        self._match      = db.register_script(MATCH_SCRIPT)
+        self.matches     = 0
+        self.attempts    = 0
+
+    def cd_key(self, cd):
+        """ Sorted set of the players waiting for a game with cooldown cd, by rating. """
+        return "{}:cd:{}".format(self._key, cd)
+
+    def enqueue(self, player_id, rating, cd, sid=None):
+        """ Look for a game for player_id, replacing an earlier request. Return False if cd isn't offered.
+
+        sid is the socket the request came from, see cancel. """
+        if cd not in self._cds:
+            return False
+        player_id = str(player_id)
+        info = json.dumps({"rating": rating, "cd": cd, "since": now(), "sid": sid})
+        pipe = self._db.pipeline()
+        for other in self._cds:
+            pipe.zrem(self.cd_key(other), player_id)
+        pipe.hset(self._players, player_id, info)
+        pipe.zadd(self.cd_key(cd), {player_id: rating})
+        pipe.zadd(self._retry, {player_id: 0})  # look for an opponent right away
+        pipe.execute()
+        return True
+
+    def cancel(self, player_id, sid=None):
+        """ Stop looking for a game for player_id, if sid is given only if it was requested by that socket. """
+        player_id = str(player_id)
+        if sid is not None:
+            info = self._db.hget(self._players, player_id)
+            if info is None or json.loads(info).get("sid") != sid:
+                return
+        pipe = self._db.pipeline()
+        pipe.hdel(self._players, player_id)
+        pipe.zrem(self._retry, player_id)
+        for cd in self._cds:
+            pipe.zrem(self.cd_key(cd), player_id)
+        pipe.execute()
+
+    def window(self, waited):
+        """ Rating window of a player who waited for waited milliseconds. """
+        return min(self._max_window, self._window + self._widen * (waited // self._interval))
+
+    def run(self, tick=100, batch=256):
+        while True:
+            if self.match_due(batch) < batch:
+                time.sleep(tick / 1000)
+
+    def match_due(self, batch=256):
+        """ Look for opponents for up to batch players who arrived or whose window widened. Return their number. """
+        due = self._db.zrangebyscore(self._retry, "-inf", now(), start=0, num=batch)
+        for player_id in due:
+            self._match_player(player_id.decode())
+        return len(due)
+
+    def _match_player(self, player_id):
+        self.attempts += 1
+        info = self._db.hget(self._players, player_id)
+        if info is None:  # matched or cancelled meanwhile
+            self._db.zrem(self._retry, player_id)
+            return
+        info   = json.loads(info)
+        waited = now() - info["since"]
+        window = self.window(waited)
+        rating = info["rating"]
+
+        opponent = self._closest(player_id, self.cd_key(info["cd"]), rating, window)
+        if opponent is not None and self._pair(player_id, opponent, info["cd"]):
+            return
+        # look again when the window widens
+        retry = info["since"] + (waited // self._interval + 1) * self._interval
+        self._db.zadd(self._retry, {player_id: retry}, xx=True)
+
+    def _closest(self, player_id, cd_key, rating, window):
+        """ Return the player closest to rating in cd_key, within window, other than player_id. """
+        pipe = self._db.pipeline(transaction=False)
+        pipe.zrevrangebyscore(cd_key, rating, rating - window, start=0, num=2, withscores=True)
+        pipe.zrangebyscore(cd_key, rating, rating + window, start=0, num=2, withscores=True)
+        below, above = pipe.execute()
+        candidates = [(abs(score - rating), other.decode()) for other, score in below + above
+                      if other.decode() != player_id]
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+    def _pair(self, player_id, opponent, cd):
+        """ Create a game for two waiting players, return False if one of them is gone. """
+        game_id = self._db.incr(self._game_id)
+        white, black = random.sample([player_id, opponent], 2)
+        meta = {"t": now()}
+        args = [player_id, opponent,
+                json.dumps([game_id, white, "game-req", {"cd": cd, "exp": self._game_exp}, meta]),
+                json.dumps([game_id, black, "join-req", None, meta]),
+                json.dumps([game_id, white, "match-ind", {"game_id": game_id, "color": "w"}]),
+                json.dumps([game_id, black, "match-ind", {"game_id": game_id, "color": "b"}])]
+        keys = [self._players, self._retry, self.cd_key(cd), self._in, self._cnfs]
+        if not self._match(keys=keys, args=args):
+            return False
+        self.matches += 1
+        return True
+
+    def waiting(self):
+        """ Number of players waiting for a game. """
+        return self._db.hlen(self._players)
+
+if __name__ == "__main__":
+    import os
+    import redis
+    from flask import Config
+
+    from web.game import matchmaker_from_config
+
+    config = Config(os.getcwd())
+    config.from_object("web.defaultconfig")
+    if "KFCHESS_CONFIG" in os.environ:
+        config.from_envvar("KFCHESS_CONFIG")
+
+    db = redis.StrictRedis(host=config["REDIS_HOSTNAME"], port=config["REDIS_PORT"])
+    matchmaker_from_config(db, config).run()
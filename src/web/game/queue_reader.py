@@ -3,63 +3,257 @@ queue_reader.py
 
 Module which handles reading a redis queue for game moves
 and emitting them to room based game_id
+
+Confirmations concerning the lobby (game-cnf, join-cnf, error-ind) are read from a list shared
+by all web workers. Confirmations for a game (move-cnf, sync-cnf) may also be published on a
+channel per game, in which case each worker subscribes only to the games its sockets are in
+(see GameChannels) and emits them locally.
+
+Confirmations are consumed in batches and handled by several reader greenlets, each coalescing
+the moves of a game that arrive within a short window into a single emit. Traced confirmations
+(see tracing.py) are recorded once emitted.
 """
 import json
+import queue
+import time
+from uuid import uuid4
 
 import redis
 
+from kfchess.redis_games_manager import game_channel
+from kfchess.game import now
+from kfchess import logs
+
+from web.game.tracing import traced
+
+log = logs.get_log("cnfs")
+
 FAIL = 'fail'
 SUCCESS = 'success'
 
-def poll_game_cnfs(db, redis_game_store, game_cnfs_queue, socketio):
+def poll_game_cnfs(db, redis_game_store, game_cnfs_queue, socketio, readers=1, batch_size=64, window=10,
+                   tracer=None):
     """ Poll a given response queue in redis object for new responses,
-    emitting them to players as necessary."""
+    emitting them to players as necessary.
+
+    Confirmations are popped in batches of up to batch_size and handed to reader greenlets
+    (see read_cnfs), sharded by game so the order within a game is kept. """
+    shards = start_cnf_readers(db, redis_game_store, socketio, readers, batch_size, window, tracer=tracer)
     while True:
-        _, cnf = db.blpop(game_cnfs_queue)
-        game_id, player_id, cmd, data = json.loads(cnf)
+        for cnf in pop_cnfs(db, game_cnfs_queue, batch_size):
+            dispatch_cnf(shards, cnf)
+
+def poll_game_channels(channels, db, redis_game_store, socketio, readers=1, batch_size=64, window=10,
+                       tracer=None):
+    """ Read the confirmations published on the game channels this worker subscribed to,
+    emitting them to the local sockets only (every worker with sockets in the game gets its copy). """
+    shards = start_cnf_readers(db, redis_game_store, socketio, readers, batch_size, window, local=True,
+                               tracer=tracer)
+    for message in channels.listen():
+        if message["type"] == "message":
+            dispatch_cnf(shards, message["data"])
+
+def pop_cnfs(db, game_cnfs_queue, batch_size):
+    """ Block until confirmations are available and pop up to batch_size of them. """
+    _, first = db.blpop(game_cnfs_queue)
+    if batch_size <= 1:
+        return [first]
+    pipe = db.pipeline()
+    pipe.lrange(game_cnfs_queue, 0, batch_size - 2)
+    pipe.ltrim(game_cnfs_queue, batch_size - 1, -1)
+    rest, _ = pipe.execute()
+    return [first] + rest
+
+def start_cnf_readers(db, redis_game_store, socketio, readers, batch_size, window, local=False, tracer=None):
+    """ Start reader greenlets, returning the queues feeding them. """
+    shards = [queue.Queue() for _ in range(max(1, readers))]
+    for shard in shards:
+        socketio.start_background_task(read_cnfs, shard, db, redis_game_store, socketio,
+                                       batch_size, window, local, tracer)
+    return shards
+
+def dispatch_cnf(shards, cnf):
+    """ Hand a raw confirmation to the reader of its game, dropping it if it can't be parsed. """
+    try:
+        cnf = traced(json.loads(cnf))
+        shard = shards[hash(str(cnf[0])) % len(shards)]
+    except Exception:
+        log.exception("bad cnf", cnf=cnf)
+        return
+    shard.put(cnf)
+
+def read_cnfs(shard, db, redis_game_store, socketio, batch_size, window, local=False, tracer=None):
+    """ Handle the confirmations of a shard. Confirmations arriving within window milliseconds
+    of the first one (up to batch_size) are handled together, see CnfBatch. """
+    while True:
+        batch = CnfBatch(db, redis_game_store, socketio, local, tracer)
+        add_cnf(batch, shard.get())
+        deadline = time.time() + window / 1000
+        while len(batch) < batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    add_cnf(batch, shard.get(timeout=remaining))
+                else:
+                    add_cnf(batch, shard.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            batch.flush()
+        except Exception:
+            log.exception("flush failed", cnfs=len(batch))
+
+def add_cnf(batch, cnf):
+    """ Add a confirmation to batch, logging and skipping it if it's malformed, so that one bad
+    confirmation doesn't stop the reader of its shard. """
+    try:
+        batch.add(*cnf)
+    except Exception:
+        log.exception("bad cnf", cnf=cnf)
+
+def prepare_sync_payload(player_id, data):
+    """ Prepare the sync-cnf sent to a player from the data of a sync confirmation (or snapshot). """
+    color = "o"
+    if player_id == data["white"]:
+        color = "w"
+    elif player_id == data["black"]:
+        color = "b"
+    return {'color': color,
+            'board': data['board']}
+
+class CnfBatch():
+    """ Confirmations handled together.
+
+    Successful moves of a game are coalesced into a single move-cnf-batch event (a lone move is
+    still sent as a move-cnf), and lobby set updates are sent in one pipeline. Any other event
+    of a game closes its group of moves, so clients see events of a game in order. """
+
+    def __init__(self, db, redis_game_store, socketio, local=False, tracer=None):
+        self._store   = redis_game_store
+        self._tracer  = tracer
+        self._traces  = []  # (cmd, meta) of traced confirmations
+        self._socketio = socketio
+        self._local   = local
+        self._pipe    = db.pipeline(transaction=False)
+        self._lobby   = 0
+        self._events  = []  # (event, payload, room), move groups hold a list of moves as payload
+        self._open    = {}  # game_id -> index of its open group of moves in _events
+        self._count   = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, game_id, player_id, cmd, data, meta=None):
+        self._count += 1
+        log.debug("cnf", game=game_id, player=player_id, cmd=cmd)
+        if meta is not None and "recv" in meta:
+            self._traces.append((cmd, meta))
         if cmd == "sync-cnf":
             if data is None:
-                socketio.emit('sync-cnf', 
-                              {"result": FAIL},
-                              room=player_id,
-                              namespace="/game")
+                self._emit(game_id, 'sync-cnf',
+                           {"result": FAIL},
+                           room=player_id)
             else:
-                print("Dealing with conf", player_id, data)
-                color = "o"
-                if player_id == data["white"]:
-                    color = "w"
-                elif player_id == data["black"]:
-                    color = "b"
-                socketio.emit('sync-cnf',
-                            {'color': color,
-                            'board': data['board']},
-                        room=player_id,
-                        namespace="/game")
+                self._emit(game_id, 'sync-cnf',
+                           prepare_sync_payload(player_id, data),
+                           room=player_id)
         elif cmd == "move-cnf":
             if data is None:
-                socketio.emit('move-cnf',
-                {'result': FAIL, 'reason': 'illegal move'},
-                room=player_id,
-                namespace="/game")
+                self._emit(game_id, 'move-cnf',
+                           {'result': FAIL, 'reason': 'illegal move'},
+                           room=player_id)
             else:
-                print(data)
-                socketio.emit('move-cnf',
-                {'result': SUCCESS, 'move': data["move"]},
-                 room=game_id,
-                 namespace="/game")
+                if game_id not in self._open:
+                    self._open[game_id] = len(self._events)
+                    self._events.append(('move-cnf', [], game_id))
+                self._events[self._open[game_id]][1].append(data["move"])
                 if data["state"] != "playing":
-                    #TODO store in permanent db
-                    db.srem("{}:playing".format(redis_game_store), game_id)
+                    # the manager queues finished games for archival, see web.game.archive
+                    self._lobby_update("srem", "{}:playing".format(self._store), game_id)
+        elif cmd == "ready-ind":
+            self._emit(game_id, 'ready-ind', data, room=game_id)
         elif cmd == "game-cnf":
             if data != None:
-                print("Setting game waiting: {} {}".format(game_id, game_id), data)
-                db.sadd("{}:{}".format(redis_game_store, data["state"]), game_id)
+                self._lobby_update("sadd", "{}:{}".format(self._store, data["state"]), game_id)
         elif cmd == "join-cnf":
-            if data != None and db.sismember("{}:waiting".format(redis_game_store), game_id):
-                print("Setting game active: {} {}".format(game_id, game_id), data)
-                db.srem("{}:waitig".format(redis_game_store), game_id)
-                db.sadd("{}:{}".format(redis_game_store, data["state"]), game_id)
+            if data != None:
+                # only games still waiting become active
+                self._lobby_update("smove", "{}:waiting".format(self._store),
+                                   "{}:{}".format(self._store, data["state"]), game_id)
+        elif cmd == "match-ind":
+            self._emit(game_id, 'match-ind', data, room=player_id)
+        elif cmd == "expire-ind":
+            # the game may have expired in any state, drop it from both lobby sets
+            self._lobby_update("srem", "{}:playing".format(self._store), game_id)
+            self._lobby_update("srem", "{}:waiting".format(self._store), game_id)
         elif cmd == "error-ind":
-            #TODO: Add proper logging instead of total collapse 
-            print("Error ind recieved!! {}".format(data))
+            log.error("error-ind", game=game_id, player=player_id, data=data)
+
+    def flush(self):
+        """ Emit the events of the batch and apply the lobby updates. """
+        for event, payload, room in self._events:
+            if event == 'move-cnf' and isinstance(payload, list):
+                if len(payload) == 1:
+                    payload = {'result': SUCCESS, 'move': payload[0]}
+                else:
+                    event, payload = 'move-cnf-batch', {'result': SUCCESS, 'moves': payload}
+            self._socketio.emit(event, payload, room=room, namespace="/game", ignore_queue=self._local)
+        if self._lobby:
+            self._pipe.execute()
+        if self._traces and self._tracer is not None:
+            emitted = now()
+            for cmd, meta in self._traces:
+                self._tracer.record(cmd, meta, emitted)
+        self._traces = []
+        self._events = []
+        self._open   = {}
+        self._lobby  = 0
+        self._count  = 0
+
+    def _emit(self, game_id, event, payload, room):
+        self._open.pop(game_id, None)
+        self._events.append((event, payload, room))
+
+    def _lobby_update(self, cmd, *args):
+        getattr(self._pipe, cmd)(*args)
+        self._lobby += 1
+
+class GameChannels():
+    """ Subscriptions of a single web worker to the confirmation channels of games.
+
+    A game channel is subscribed while at least one local socket is in the game. The worker is
+    always subscribed to its own node channel, so listen() never runs out of subscriptions. """
+
+    def __init__(self, db, game_cnfs_queue, node_id=None):
+        if node_id is None:
+            node_id = str(uuid4())
+        self._cnfs    = game_cnfs_queue
+        self._pubsub  = db.pubsub(ignore_subscribe_messages=True)
+        self._games   = {}  # game_id -> set of local sids
+        self._sids    = {}  # sid -> set of game_ids
+        self.node_channel = "{}:node:{}".format(game_cnfs_queue, node_id)
+        self._pubsub.subscribe(self.node_channel)
+
+    def subscribe(self, game_id, sid):
+        """ Subscribe to game_id on behalf of the local socket sid. """
+        self._sids.setdefault(sid, set()).add(game_id)
+        sids = self._games.setdefault(game_id, set())
+        if not sids:
+            self._pubsub.subscribe(game_channel(self._cnfs, game_id))
+        sids.add(sid)
+
+    def unsubscribe(self, sid):
+        """ Drop all subscriptions held on behalf of the socket sid. """
+        for game_id in self._sids.pop(sid, ()):
+            sids = self._games.get(game_id, set())
+            sids.discard(sid)
+            if not sids:
+                self._games.pop(game_id, None)
+                self._pubsub.unsubscribe(game_channel(self._cnfs, game_id))
+
+    @property
+    def games(self):
+        return set(self._games)
 
+    def listen(self):
+        return self._pubsub.listen()
@@ -0,0 +1,119 @@
+"""
+ratelimit.py
+
+Token bucket rate limiting of game commands, per player and command.
+
+Each command has a bucket of up to `burst` tokens per player, refilled at `rate` tokens per
+second, and a request takes a token or is throttled. LocalRateLimiter keeps the buckets in the
+web process, which only limits a player on the sockets of one process. RedisRateLimiter keeps
+them in redis and updates them with a single script, so a player is limited across all web
+processes, which is what actually protects the game manager.
+"""
+from abc import ABC, abstractmethod
+from collections import Counter
+
+from kfchess.game import now
+
+TAKE_TOKEN_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts     = tonumber(bucket[2]) or now
+if now > ts then
+    tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+    ts     = now
+end
+local allowed = 0
+if tokens >= 1 then
+    tokens  = tokens - 1
+    allowed = 1
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[4], 1)
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(ts))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return allowed
+"""
+
+class RateLimiter(ABC):
+    """ Base of the rate limiters, counting allowed and throttled requests (by command).
+
+    limits maps a command to (rate, burst), commands not in limits are never throttled. """
+
+    def __init__(self, limits):
+        self._limits   = dict(limits)
+        self.allowed   = 0
+        self.throttled = Counter()
+
+    def allow(self, player_id, cmd):
+        """ Take a token of player_id for cmd, return False if the request should be throttled. """
+        if cmd not in self._limits:
+            return True
+        rate, burst = self._limits[cmd]
+        if self._take(player_id, cmd, rate, burst, now()):
+            self.allowed += 1
+            return True
+        self.throttled[cmd] += 1
+        return False
+
+    def stats(self):
+        """ Return the requests allowed and throttled (by command) by this process. """
+        return {"allowed": self.allowed, "throttled": dict(self.throttled)}
+
+    @abstractmethod
+    def _take(self, player_id, cmd, rate, burst, time):
+        """ Take a token from the bucket of player_id for cmd at time (ms), return False if empty. """
+
+class LocalRateLimiter(RateLimiter):
+    """ Rate limiter keeping the buckets in this process. """
+
+    def __init__(self, limits, prune_every=1024):
+        """ Every prune_every requests, buckets that are full again are forgotten. """
+        super().__init__(limits)
+        self._buckets     = {}  # (player_id, cmd) -> [tokens, time]
+        self._prune_every = prune_every
+        self._requests    = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _take(self, player_id, cmd, rate, burst, time):
+        self._requests += 1
+        if self._requests % self._prune_every == 0:
+            self._prune(time)
+
+        bucket = self._buckets.setdefault((player_id, cmd), [burst, time])
+        if time > bucket[1]:
+            bucket[0] = min(burst, bucket[0] + (time - bucket[1]) * rate / 1000)
+            bucket[1] = time
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def _prune(self, time):
+        for key, (tokens, last) in list(self._buckets.items()):
+            rate, burst = self._limits[key[1]]
+            if tokens + (time - last) * rate / 1000 >= burst:
+                del self._buckets[key]
+
+class RedisRateLimiter(RateLimiter):
+    """ Rate limiter keeping the buckets in redis, shared by all web processes.
+
+    Throttled requests are also counted by command in the "{prefix}:stats:throttled" hash. """
+
+    def __init__(self, limits, db, prefix):
+        super().__init__(limits)
+        self._prefix = prefix
+        self._script = db.register_script(TAKE_TOKEN_SCRIPT)
+
+    def _take(self, player_id, cmd, rate, burst, time):
+        keys = ["{}:ratelimit:{}:{}".format(self._prefix, cmd, player_id),
+                "{}:stats:throttled".format(self._prefix)]
+        return bool(self._script(keys=keys, args=[rate, burst, time, cmd]))
+
+def create_limiter(limits, shared=False, db=None, prefix=None):
+    """ Create a rate limiter of the given limits, shared through redis db if shared is True. """
+    if shared:
+        return RedisRateLimiter(limits, db, prefix)
+    return LocalRateLimiter(limits)
@@ -1,10 +1,23 @@
+import hmac
+
 import flask
 from flask_login import login_required, current_user
 
-from web.game import game_bp, next_game_id, push_req
+from kfchess.bot.engine import LEVELS
+from kfchess.bot.runner import request_bot
+from kfchess.profiler import DEFAULT_DURATION, DEFAULT_INTERVAL
+from web.game import game_bp, next_game_id, push_req, get_app, start_profile, get_tracer, get_rate_limiter, \
+    get_move_gate
+from web.hubwatch import get_hub_watch
+from web.main.user import get_password_hasher, get_user_cache
+
+# longest profile of a web worker, in milliseconds
+MAX_PROFILE_DURATION = 5 * 60 * 1000
 
 def send_new_game_req(game_id, player_id, cd=10000):
-    push_req("game-req", {"cd": cd}, game_id, player_id)
+    """ Ask for a new game, expiring after GAME_MAX_LENGTH seconds without a move. """
+    exp = get_app().config["GAME_MAX_LENGTH"] * 1000
+    push_req("game-req", {"cd": cd, "exp": exp}, game_id, player_id)
 
 @game_bp.route('/')
 @login_required
@@ -14,6 +27,54 @@ def index():
     send_new_game_req(game_id, sid)
     return flask.redirect("./{}".format(game_id))
 
+@game_bp.route('/bot/<int:level>')
+@login_required
+def against_bot(level):
+    """ Start a game against a bot of the given level (see kfchess.bot.engine.LEVELS). """
+    if level not in LEVELS:
+        flask.abort(404)
+    game_id = next_game_id()
+    send_new_game_req(game_id, current_user.get_id())
+    request_bot(get_app().redis, get_app().config["REDIS_BOTS_QUEUE"], game_id, level)
+    return flask.redirect("../{}".format(game_id))
+
+def check_admin_token():
+    """ Hide admin endpoints from requests without ADMIN_TOKEN. """
+    token = get_app().config["ADMIN_TOKEN"]
+    if not token or not hmac.compare_digest(flask.request.values.get("token", ""), token):
+        flask.abort(404)
+
+@game_bp.route('/admin/profile', methods=['POST'])
+def profile():
+    """ Profile the web worker serving the request (see kfchess.profiler).
+
+    Takes duration and interval (ms), returns where the profile will be written on the worker's host. """
+    check_admin_token()
+    duration = min(int(flask.request.form.get("duration", DEFAULT_DURATION)), MAX_PROFILE_DURATION)
+    profiler = start_profile(duration, int(flask.request.form.get("interval", DEFAULT_INTERVAL)))
+    if profiler is None:
+        flask.abort(409)
+    return flask.jsonify({"path": profiler.path, "duration": duration})
+
+@game_bp.route('/admin/hub')
+def hub():
+    """ Report hub lag and slow greenlets of the web worker serving the request (see web.hubwatch). """
+    check_admin_token()
+    watch = get_hub_watch()
+    if watch is None:
+        flask.abort(404)
+    return flask.jsonify(watch.report())
+
+@game_bp.route('/admin/stats')
+def stats():
+    """ Report the metrics of the web worker serving the request. """
+    check_admin_token()
+    return flask.jsonify({"passwords":   get_password_hasher().stats(),
+                          "users":       get_user_cache().stats(),
+                          "traces":      get_tracer().summary(),
+                          "rate_limits": get_rate_limiter().stats(),
+                          "move_gate":   get_move_gate().stats()})
+
 @game_bp.route('/<game_id>')
 def view(game_id):
     return flask.render_template("game/game_page.html", game_id=game_id)
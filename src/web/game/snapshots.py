@@ -0,0 +1,55 @@
+"""
+snapshots.py
+
+Game snapshots published by the game manager (see RedisGamesManager snapshots), read directly
+by the web tier so that spectators can be synced without going through the manager queue.
+
+A local LRU of parsed snapshots sits in front of redis: only the small version field is read
+while a game doesn't change, however many spectators ask for it.
+"""
+import json
+from collections import OrderedDict
+
+from kfchess.redis_games_manager import snapshot_key
+
+class SnapshotCache():
+    """ Versioned game snapshots, cached in process """
+
+    def __init__(self, db, game_cnfs_queue, size=1024):
+        self._db    = db
+        self._cnfs  = game_cnfs_queue
+        self._size  = size
+        self._lru   = OrderedDict()  # game_id -> (version, data)
+        self.hits   = 0
+        self.misses = 0
+
+    def get(self, game_id):
+        """ Return the latest snapshot data of a game, or None if there is none. """
+        return self.get_versioned(game_id)[1]
+
+    def get_versioned(self, game_id):
+        """ Return the version (an int) and data of the latest snapshot of a game, or (None, None)
+        if there is none. Versions of a game only grow, with every change the manager publishes. """
+        key = snapshot_key(self._cnfs, game_id)
+        version = self._db.hget(key, "version")
+        if version is None:
+            return None, None
+
+        cached = self._lru.get(game_id)
+        if cached is not None and cached[0] == int(version):
+            self._lru.move_to_end(game_id)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        version, data = self._db.hmget(key, "version", "data")
+        if data is None:
+            return None, None
+        cached = self._lru[game_id] = (int(version), json.loads(data))
+        self._lru.move_to_end(game_id)
+        if len(self._lru) > self._size:
+            self._lru.popitem(last=False)
+        return cached
+
+    def __len__(self):
+        return len(self._lru)
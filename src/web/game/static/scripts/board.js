@@ -19,6 +19,8 @@ $(window).ready(function() {
     var cd = 4000;    // testing TODO: Get from server on game start
     var start_time;
     var time_offset;
+    var server_start_time;
+    var offset_estimated = false;  // time_offset comes from the server estimate (see ping-cnf)
 
     /*
      * Disable the square for given duration.
@@ -29,6 +31,7 @@ $(window).ready(function() {
         start = Date.now();
       }
       disabledSquares[sq] = true;
+      disabledTimes[sq] = start;
       var squareEl = $('#board .square-' + sq);
       squareEl.wrapInner("<div class='sq" + sq + "-inner'></div>");
       var innerEl = $('#board .square-' + sq + " > .sq" + sq + "-inner");
@@ -76,8 +79,15 @@ $(window).ready(function() {
       }
       console.log("received sync");
       console.log(sync_desc);
-      time_offset = now - sync_desc.board.current_time;
-      start_time  = sync_desc.board.start_time + time_offset;
+      if (sync_desc.clock_offset !== undefined && sync_desc.clock_offset !== null) {
+        offset_estimated = true;  // server estimate, see ping-cnf
+        time_offset = -sync_desc.clock_offset;
+      }
+      else if (!offset_estimated) {
+        time_offset = now - sync_desc.board.current_time;
+      }
+      server_start_time = sync_desc.board.start_time;
+      start_time  = server_start_time + time_offset;
       cd = sync_desc.board.cd;
       color = sync_desc.color;
       if (color == 'w') {
@@ -102,17 +112,43 @@ $(window).ready(function() {
     });
 
 
-    socket.on('move-cnf', function(move_desc) {
+    /*
+     * Make the local game agree with the square changes of a confirmed move, returning true
+     * if anything had to be patched (e.g. our game couldn't make the move).
+     */
+    function applyChanges(move) {
+      var patched = false;
+      for (var [sq, piece] of Object.entries(move.changes)) {
+        var current = game.get(sq);
+        if (piece.type == '.') {
+          if (current !== null) {
+            game.remove(sq);
+            patched = true;
+          }
+        }
+        else if (current === null || current.type != piece.type || current.color != piece.color) {
+          game.remove(sq);
+          game.put({type: piece.type, color: piece.color}, sq);
+          patched = true;
+        }
+      }
+      var tokens = game.nfen().split(' ');
+      var castles = move.castles || '-';
+      if (tokens[1] != castles) {
+        game.load([tokens[0], castles, move.move_number].join(' '));
+        patched = true;
+      }
+      return patched;
+    }
 
-      if (move_desc['result'] == 'fail') { // move was illegal, update board and ask for resync
+    var onMoveCnf = function(move_desc) {
+
+      if (move_desc['result'] == 'fail') { // move was illegal, nothing changed on the server
         console.log('illegal move response received');
-        socket.emit("sync-req", game_id);
         board.position(game.nfen());
         return;
       }
 
-      console.log("received move");
-      console.log(move_desc);
       var move = move_desc.move;
       var res  = game.move(move, {
         ignore_color: true,
@@ -120,24 +156,71 @@ $(window).ready(function() {
         time: move_desc.time
       });
 
-      if (res === null)
+      if (move.changes !== undefined) {
+        // the move describes everything it changed (castles, captures, promotions), no need to sync
+        if (applyChanges(move)) {
+          console.log("Patched local game from move", move);
+        }
+      }
+      else if (res === null)
       {
         console.log("Invalid move received, requesting sync");
         socket.emit("sync-req", game_id);
         return;
       }
 
-      if (game.game_over()) {
-        alert("Game over! "+ game.winner() +" wins!");
+      if (game.game_over() || (move.state !== undefined && move.state != 'playing')) {
+        alert("Game over! "+ (move.state == 'w_wins' ? 'w' : move.state == 'b_wins' ? 'b' : game.winner()) +" wins!");
         window.location = "/";
       }
 
-     console.log(res)
       var changes = board.position(game.nfen());
       for (var i = 0; i < changes.length; i++) {
         disableSquare(changes[i].destination, cd, move.time);
       }
       disableSquare(move.to, cd, move.time);
+    };
+
+    socket.on('move-cnf', onMoveCnf);
+
+    // server tells us pieces moved at given time can move again
+    socket.on('ready-ind', function(ready_desc) {
+      for (var i = 0; i < ready_desc.sqs.length; i++) {
+        var sq = ready_desc.sqs[i];
+        if (disabledTimes[sq] === ready_desc.time) {
+          disabledSquares[sq] = false;
+        }
+      }
+    });
+
+    // moves of the same game confirmed together
+    socket.on('move-cnf-batch', function(batch_desc) {
+      for (var i = 0; i < batch_desc.moves.length; i++) {
+        onMoveCnf({result: batch_desc.result, move: batch_desc.moves[i]});
+      }
+    });
+
+    //------------------------------------------------------------------------------
+    // clock synchronization, the server keeps an NTP-style estimate of our clock offset
+    //------------------------------------------------------------------------------
+    var last_ping = null;
+    var pings = 0;
+
+    function sendPing() {
+      socket.emit('ping-req', {t0: Date.now(), prev: last_ping});
+      pings += 1;
+      window.setTimeout(sendPing, pings < 5 ? 500 : 10000);  // converge fast, then keep up with drift
+    }
+
+    socket.on('ping-cnf', function(ping) {
+      last_ping = [ping.t0, ping.t1, ping.t2, Date.now()];
+      if (ping.offset !== null) {
+        offset_estimated = true;
+        time_offset = -ping.offset;
+        if (server_start_time !== undefined) {
+          start_time = server_start_time + time_offset;
+        }
+      }
     });
 
     //------------------------------------------------------------------------------
@@ -160,8 +243,8 @@ $(window).ready(function() {
     var onDragStart = function (source, piece) {
       // do not pick up pieces if the game is over
       // or if it's still disabled
+      // pieces still on cooldown may be dragged, the move is then held by the server (premove)
       if (game.game_over() === true ||
-          (source in disabledSquares && disabledSquares[source] == true) ||
           game.get(source).color != color) {
         return false;
       }
@@ -170,12 +253,14 @@ $(window).ready(function() {
     var onDrop = function (source, target) {
       removeAvailableSquares(); // first unmark squares
 
+      var premove = (source in disabledSquares && disabledSquares[source] == true);
+
       // get all legal moves from source
       // see if move to target is there
       var piece_moves = game.moves({
         square: source,
         ignore_color: true,
-        cooldown_time: cd
+        cooldown_time: premove ? 0 : cd
       });
       var move = null;
 
@@ -188,6 +273,10 @@ $(window).ready(function() {
 
       if (move !== null) { // client decided move is legal
         // now verify on server
+        if (premove) {
+          socket.emit('premove-req', game_id, move);
+          return 'snapback';  // shown once the server makes the move
+        }
         socket.emit('move-req', game_id, move);
       }
       else {
@@ -232,9 +321,11 @@ $(window).ready(function() {
     // Finally do something
     //------------------------------------------------------------------------------
     socket.emit("join-req", game_id);
+    sendPing();
 
     var game;
     var disabledSquares = {};
+    var disabledTimes = {};
 
     var cfg = {
       draggable: true,
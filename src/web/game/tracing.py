@@ -0,0 +1,95 @@
+"""
+tracing.py
+
+Sampled tracing of game requests from the web tier, through the manager, back to the sockets.
+
+push_req gives a sampled request a trace id in its meta, next to its enqueue time "t". The manager
+sends the meta back with the confirmation, adding when it started and finished handling the
+request, and the reader notes when it received the confirmation and when it was emitted. A trace
+is then split into stages:
+
+    queue     - waiting in the manager's queue (start - t)
+    manager   - handled by the manager (end - start)
+    delivery  - on the way back to the reader, through the cnfs queue or a game channel (recv - end)
+    reader    - in the reader, including the coalescing window, until emitted (emitted - recv)
+    total     - all of the above (emitted - t)
+
+Stage durations are kept for percentiles, and written as JSON lines to a local trace log if one is
+configured. Stages across processes compare clocks of different hosts, so they are only as
+accurate as the clocks are in sync.
+"""
+import json
+import random
+from collections import deque
+from uuid import uuid4
+
+from kfchess.game import now
+from kfchess.redis_games_manager import percentile
+
+STAGES = ["queue", "manager", "delivery", "reader", "total"]
+
+def stages(meta, emitted):
+    """ Return the stage durations (ms) of a traced confirmation emitted at emitted. """
+    return {"queue":    meta["start"] - meta["t"],
+            "manager":  meta["end"] - meta["start"],
+            "delivery": meta["recv"] - meta["end"],
+            "reader":   emitted - meta["recv"],
+            "total":    emitted - meta["t"]}
+
+class Tracer():
+    """ Samples requests to trace, and records the stages of their confirmations. """
+
+    def __init__(self, sample_rate=0.01, path=None, samples=1024, flush_every=64):
+        """ Trace sample_rate of the requests (0 to 1), writing traces to path if given,
+        every flush_every traces. The last samples durations of each stage are kept. """
+        self._rate    = sample_rate
+        self._path    = path
+        self._flush   = flush_every
+        self._lines   = []
+        self._samples = {stage: deque(maxlen=samples) for stage in STAGES}
+        self.traced   = 0
+
+    def new_trace(self):
+        """ Return a trace id for a request if it's sampled, else None. """
+        if self._rate <= 0 or random.random() >= self._rate:
+            return None
+        return uuid4().hex[:16]
+
+    def record(self, cmd, meta, emitted):
+        """ Record the trace of a confirmation cmd, emitted at emitted. """
+        try:
+            durations = stages(meta, emitted)
+        except KeyError:  # traced by a manager that doesn't know about traces
+            return
+        self.traced += 1
+        for stage, duration in durations.items():
+            self._samples[stage].append(duration)
+        if self._path:
+            self._lines.append(json.dumps(dict(durations, trace=meta["trace"], cmd=cmd, t=meta["t"])))
+            if len(self._lines) >= self._flush:
+                self.flush()
+
+    def flush(self):
+        """ Write the pending traces to the trace log. """
+        if not self._lines:
+            return
+        with open(self._path, "a") as log:
+            log.write("\n".join(self._lines) + "\n")
+        self._lines = []
+
+    def summary(self):
+        """ Return p50/p95/p99 and max (ms) of each stage over the last traces. """
+        res = {}
+        for stage in STAGES:
+            samples = sorted(self._samples[stage])
+            res[stage] = {"p50": percentile(samples, 50),
+                          "p95": percentile(samples, 95),
+                          "p99": percentile(samples, 99),
+                          "max": samples[-1] if samples else 0}
+        return res
+
+def traced(cnf):
+    """ Note the receive time on the trace of a raw (decoded) confirmation, if it has one. """
+    if len(cnf) > 4 and isinstance(cnf[4], dict) and "trace" in cnf[4]:
+        cnf[4]["recv"] = now()
+    return cnf
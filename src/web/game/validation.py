@@ -0,0 +1,112 @@
+"""
+validation.py
+
+Cheap checks of move requests in the web tier, rejecting obviously invalid ones before they are
+queued to the game manager. Checks use the game snapshots (see snapshots.py) when available, so
+a move is only rejected when the manager would reject it too. Anything else is left to the
+manager, which has the last word.
+
+Snapshots are published before moves are confirmed, but a player can send a move before the
+previous one is applied. The board of a snapshot is only checked if it's newer than the snapshot
+the player's last move was let through on, so it holds that move. Premoves aren't checked
+against the board at all: they are for pieces still moving, or on their way to the square.
+"""
+from collections import Counter, OrderedDict
+
+from kfchess.game import Square, PLAYING, WHITE, BLACK, QUEEN, ROOK, BISHOP, KNIGHT, now
+
+PROMOTIONS = [None, QUEEN, ROOK, BISHOP, KNIGHT]
+
+class MoveGate():
+    """ Pre-validation of move requests, counting rejections by reason """
+
+    def __init__(self, snapshots, slack=50, pending=10000):
+        """ Moves are rejected for cooldown only if it has more than slack milliseconds left,
+        as the manager checks it a little later. The snapshot versions of the last moves of up to
+        pending players are kept. """
+        self._snapshots = snapshots
+        self._slack     = slack
+        self._pending   = pending
+        self._sent      = OrderedDict()  # (game_id, player_id) -> snapshot version of the last move
+        self.passed     = 0
+        self.rejected   = Counter()
+
+    def check(self, game_id, player_id, move, premove=False):
+        """ Return the reason a move should be rejected, or None if it may be queued.
+
+        Premoves are not checked against the board (pieces, cooldowns), since they are for pieces
+        that aren't ready yet. """
+        reason = self._check(game_id, player_id, move, premove)
+        if reason is None:
+            self.passed += 1
+        else:
+            self.rejected[reason] += 1
+        return reason
+
+    def stats(self):
+        """ Return the moves passed and rejected (by reason). """
+        return {"passed": self.passed, "rejected": dict(self.rejected)}
+
+    def _check(self, game_id, player_id, move, premove):
+        try:
+            from_sq = Square.FromSan(move["from"])
+            to_sq   = Square.FromSan(move["to"])
+            promote = move.get("promote")
+        except (TypeError, KeyError, ValueError, AttributeError):
+            return "malformed move"
+        if not from_sq.valid or not to_sq.valid or from_sq == to_sq or promote not in PROMOTIONS:
+            return "malformed move"
+
+        version, data = self._snapshots.get_versioned(game_id)
+        if data is None:
+            return None  # nothing to check against
+
+        board = data["board"]
+        if board["state"] != PLAYING:
+            return "game not playing"
+        if player_id == data["white"]:
+            color = WHITE
+        elif player_id == data["black"]:
+            color = BLACK
+        else:
+            return "not a player"
+
+        if not premove and self._applied(game_id, player_id, version):
+            piece = nfen_piece(board["nfen"], from_sq)
+            if piece is None or (piece.isupper() != (color == WHITE)):
+                return "not your piece"
+
+            last_move = board["times"].get(from_sq.san)
+            if last_move is not None and board["start_time"] + last_move + board["cd"] - now() > self._slack:
+                return "cooldown"
+
+        self._sent_on(game_id, player_id, version)
+        return None
+
+    def _applied(self, game_id, player_id, version):
+        """ Whether the snapshot version holds the player's last move let through. """
+        sent = self._sent.get((game_id, player_id))
+        return sent is None or version > sent
+
+    def _sent_on(self, game_id, player_id, version):
+        """ Remember that a move of the player was let through on the snapshot version. """
+        key = (game_id, player_id)
+        sent = self._sent.pop(key, None)
+        self._sent[key] = max(version, sent) if sent is not None else version
+        if len(self._sent) > self._pending:
+            self._sent.popitem(last=False)
+
+def nfen_piece(nfen, sq):
+    """ Return the san letter of the piece on sq in the board part of nfen, or None if empty """
+    rows = nfen.split(" ")[0].split("/")
+    file = 1
+    for l in rows[8 - sq.rank]:
+        if l.isdigit():
+            file += int(l)
+        else:
+            if file == sq.file:
+                return l
+            file += 1
+        if file > sq.file:
+            return None
+    return None
@@ -0,0 +1,181 @@
+"""
+hubwatch.py
+
+Finds what blocks the eventlet hub of a web worker.
+
+All the greenlets of a worker run in one thread, each until it yields to the hub, so anything
+that blocks without yielding (MySQLdb, bcrypt, a long batch of confirmations) freezes every socket
+of the worker. Two things are measured:
+
+    - hub lag: a greenlet asks to be woken up every interval ms, and how late it's woken up is
+      kept in a histogram. It's the delay every socket of the worker suffers on top of its own work.
+    - slow greenlets: greenlet switches are traced (greenlet.settrace) to time how long each
+      greenlet runs before yielding. A native watchdog thread takes the stack of a greenlet that
+      has run for more than threshold ms while it's still running, so the stack shows what blocks
+      rather than where it eventually yielded. Slow runs are grouped by stack, worst first.
+
+The report is served by /game/admin/hub (see web.game.routes), and slow runs are logged to the
+"hub" category (see kfchess.logs).
+"""
+import bisect
+import sys
+import time
+import traceback
+
+import eventlet
+import greenlet
+
+from kfchess import logs
+
+log = logs.get_log("hub")
+
+# upper bounds (ms) of the buckets of the histograms, the last bucket holds the rest
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# deepest stack kept for a slow run, from the innermost frame
+STACK_DEPTH = 20
+
+class Histogram():
+    """ Counts of values (ms) in fixed buckets. """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1)
+        self.count   = 0
+        self.total   = 0
+        self.max     = 0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max    = max(self.max, value)
+
+    def percentile(self, p):
+        """ Return the upper bound of the bucket holding the p-th percentile (max for the last one). """
+        if not self.count:
+            return 0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen * 100 >= self.count * p:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        labels = ["<={}".format(b) for b in self.buckets] + [">{}".format(self.buckets[-1])]
+        return {"count":   self.count,
+                "mean":    self.total / self.count if self.count else 0,
+                "max":     self.max,
+                "p50":     self.percentile(50),
+                "p99":     self.percentile(99),
+                "buckets": dict(zip(labels, self.counts))}
+
+def greenlet_name(gr):
+    """ Name of a greenlet, from the function it runs. """
+    run = getattr(gr, "run", None)
+    return getattr(run, "__qualname__", None) or type(gr).__name__
+
+class HubWatch():
+    """ Measures hub lag and slow greenlets of the thread it's started from. """
+
+    def __init__(self, threshold=100, interval=100, top=20):
+        """ Report greenlets running for threshold ms or more without yielding (up to top distinct
+        stacks), and measure the hub lag every interval ms. """
+        self._threshold = threshold / 1000
+        self._interval  = interval / 1000
+        self._top       = top
+        self.lag        = Histogram()
+        self.runs       = Histogram()  # run times of greenlets between switches
+        self.slow       = {}           # stack -> report of slow runs
+        self._switched  = time.perf_counter()
+        self._caught    = None         # (time of the switch, stack) taken by the watchdog
+        self._running   = False
+        self._previous  = None
+
+    def start(self):
+        _, threading = logs.native_modules()
+        self._thread_id = threading.get_ident()
+        self._running   = True
+        self._stopped   = threading.Event()
+        self._previous  = greenlet.settrace(self._trace)
+        threading.Thread(target=self._watchdog, name="hubwatch", daemon=True).start()
+        eventlet.spawn(self._measure_lag)
+
+    def stop(self):
+        self._running = False
+        self._stopped.set()
+        greenlet.settrace(self._previous)
+
+    def report(self):
+        """ Return the lag and run time histograms, and the slowest runs with their stacks. """
+        slow = sorted(self.slow.values(), key=lambda report: -report["max"])
+        return {"lag": self.lag.to_dict(), "runs": self.runs.to_dict(), "slow": slow}
+
+    def _trace(self, event, args):
+        if event in ("switch", "throw"):
+            now = time.perf_counter()
+            ran = now - self._switched
+            caught, self._caught = self._caught, None
+            started, self._switched = self._switched, now
+            self.runs.record(ran * 1000)
+            if ran >= self._threshold:
+                # the watchdog's stack if it caught this run, else where it yields
+                if caught is not None and caught[0] == started:
+                    self._record(args[0], ran, caught[1], True)
+                else:
+                    self._record(args[0], ran, format_stack(sys._getframe(1)), False)
+        if self._previous is not None:
+            self._previous(event, args)
+
+    def _record(self, origin, ran, stack, blocked):
+        ran *= 1000
+        key = tuple(stack)
+        report = self.slow.get(key)
+        if report is None:
+            if len(self.slow) >= self._top:
+                # forget the least slow stack, unless this one is even less slow
+                least = min(self.slow, key=lambda k: self.slow[k]["max"])
+                if self.slow[least]["max"] >= ran:
+                    return
+                del self.slow[least]
+            report = self.slow[key] = {"greenlet": greenlet_name(origin), "count": 0, "total": 0,
+                                       "max": 0, "blocked": blocked, "stack": stack}
+        report["count"] += 1
+        report["total"] += ran
+        report["max"]    = max(report["max"], ran)
+        log.warning("slow greenlet", ms=round(ran, 1), greenlet=report["greenlet"],
+                    where=stack[-1] if stack else None)
+
+    def _watchdog(self):
+        while not self._stopped.wait(self._threshold / 2):
+            switched = self._switched
+            if self._caught is None and time.perf_counter() - switched >= self._threshold:
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None and self._switched == switched:
+                    self._caught = (switched, format_stack(frame))
+
+    def _measure_lag(self):
+        while self._running:
+            start = time.perf_counter()
+            eventlet.sleep(self._interval)
+            self.lag.record(max(0, time.perf_counter() - start - self._interval) * 1000)
+
+def format_stack(frame):
+    """ Return the innermost STACK_DEPTH frames from frame, outermost first. """
+    return ["{}:{} in {}".format(f.filename, f.lineno, f.name)
+            for f in traceback.extract_stack(frame, limit=STACK_DEPTH)]
+
+_watch = None
+
+def start_hub_watch(threshold, interval):
+    """ Watch the hub of this worker, from the thread running it. """
+    global _watch
+    if _watch is None:
+        _watch = HubWatch(threshold, interval)
+        _watch.start()
+    return _watch
+
+def get_hub_watch():
+    """ Get the hub watch of this worker, None if not watching. """
+    return _watch
@@ -0,0 +1,70 @@
+"""
+passwords.py
+
+Password hashing and checking off the eventlet hub.
+
+bcrypt is slow on purpose, tens of milliseconds per call, and running it inline stalls every
+socket of the web process. Hashes are computed on eventlet's pool of OS threads (tpool) instead,
+with at most `threads` of them at a time and at most `queue` more waiting, so a burst of logins
+is turned away rather than piling up without bound.
+"""
+import time
+
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+
+class PasswordsBusy(Exception):
+    """ Too many password hashes are already waiting. """
+
+class PasswordHasher():
+    """ Run bcrypt (a flask_bcrypt Bcrypt) in a thread pool, keeping metrics of it. """
+
+    def __init__(self, bcrypt, threads=4, queue=64, execute=tpool.execute):
+        self._bcrypt   = bcrypt
+        self._slots    = Semaphore(threads)
+        self._queue    = queue
+        self._execute  = execute
+        self.waiting   = 0
+        self.running   = 0
+        self.done      = 0
+        self.rejected  = 0
+        self.total_time = 0
+        self.max_time   = 0
+
+    def generate(self, password):
+        """ Return the hash of password. """
+        return self._run(self._bcrypt.generate_password_hash, password)
+
+    def check(self, pw_hash, password):
+        """ Return True if password matches pw_hash. """
+        return self._run(self._bcrypt.check_password_hash, pw_hash, password)
+
+    def _run(self, func, *args):
+        if self.waiting >= self._queue:
+            self.rejected += 1
+            raise PasswordsBusy("{} password hashes waiting".format(self.waiting))
+        start = time.time()
+        self.waiting += 1
+        try:
+            self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            return self._execute(func, *args)
+        finally:
+            self.running -= 1
+            self._slots.release()
+            elapsed = (time.time() - start) * 1000
+            self.done       += 1
+            self.total_time += elapsed
+            self.max_time    = max(self.max_time, elapsed)
+
+    def stats(self):
+        """ Return a dictionary of the hasher metrics, times (including waits) in milliseconds. """
+        return {"waiting":   self.waiting,
+                "running":   self.running,
+                "done":      self.done,
+                "rejected":  self.rejected,
+                "mean_time": self.total_time / self.done if self.done else 0,
+                "max_time":  self.max_time}
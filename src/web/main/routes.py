@@ -6,6 +6,8 @@ from flask_login import login_user, current_user, login_required, logout_user
 
 from web.main import main
 from web.main.user import User
+from web.main.passwords import PasswordsBusy
+from web.ratings import Leaderboard, leaderboard_key
 from web.game import get_active_game_set, get_waiting_game_set
 
 
@@ -19,6 +21,25 @@ def index():
     return flask.render_template("main/main_page.html", a_games=map(json.loads, active_games)
                                                  , w_games=map(json.loads, waiting_games))
 
+# most players listed by /leaderboard
+MAX_LEADERBOARD = 100
+
+@main.route('/leaderboard')
+def leaderboard():
+    board = Leaderboard(flask.current_app.redis, leaderboard_key(flask.current_app.config["REDIS_STORE_KEY"]))
+    try:
+        n = min(max(int(request.args.get("n", 20)), 1), MAX_LEADERBOARD)
+    except ValueError:
+        flask.abort(400)
+    ranked = board.top(n)
+    users = User.get_many([user_id for user_id, _ in ranked])
+    top = []
+    for user_id, rating in ranked:
+        user = users.get(user_id)
+        top.append({"user_id": user_id, "username": user.username if user else None, "rating": rating})
+    rank = board.rank(current_user.get_id()) if current_user.is_authenticated else None
+    return flask.jsonify({"top": top, "rank": rank})
+
 @main.route('/user/<user_id>')
 def user(user_id):
     return "You are searching for the user page. It does not exist yet"
@@ -32,10 +53,13 @@ def register():
         email = request.form.get('email')
         if not username or not password:
             err = "Empty username or password given!"
-        elif User.create(username, password, email):
-            return flask.redirect("./login")
         else:
-            err = "Username already in use"
+            try:
+                if User.create(username, password, email):
+                    return flask.redirect("./login")
+                err = "Username already in use"
+            except PasswordsBusy:
+                err = "Too many requests, please try again in a moment"
     return flask.render_template("main/register.html", err=err)
 
 @main.route('/logout')
@@ -50,7 +74,10 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user = User.authenticate(username, password)
+        try:
+            user = User.authenticate(username, password)
+        except PasswordsBusy:
+            return flask.render_template("main/login.html", err="Too many requests, please try again in a moment")
         if user:
             print("succesfully connected {}".format(user.username))
             login_user(user)
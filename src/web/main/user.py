@@ -1,38 +1,124 @@
+import time
 import uuid
+from collections import OrderedDict
 
 from flask_login import UserMixin
 import MySQLdb
 from MySQLdb.cursors import DictCursor
 
 from web import login_manager, mysql, bcrypt
+from web.main.passwords import PasswordHasher
 
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.get(user_id)
 
+def init_users(app):
+    global _users, _passwords
+    _users = UserCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+    _passwords = PasswordHasher(bcrypt, app.config["PASSWORD_HASH_THREADS"], app.config["PASSWORD_HASH_QUEUE"])
+
+def get_user_cache():
+    return _users
+
+def get_password_hasher():
+    return _passwords
+
+class UserCache():
+    """ LRU cache of users by id, whose entries expire after ttl seconds.
+
+    Flask-Login loads the user on every request and socket event, which mostly hit this cache. """
+
+    def __init__(self, size=4096, ttl=300):
+        self._size  = size
+        self._ttl   = ttl
+        self._users = OrderedDict()  # user_id -> (user, expiry time)
+        self.hits   = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """ Return the cached user, or None if missing or expired. """
+        entry = self._users.get(str(user_id))
+        if entry is None or entry[1] <= time.time():
+            self.misses += 1
+            return None
+        self._users.move_to_end(str(user_id))
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user):
+        self._users[str(user.id)] = (user, time.time() + self._ttl)
+        self._users.move_to_end(str(user.id))
+        while len(self._users) > self._size:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._users.pop(str(user_id), None)
+
+    def __len__(self):
+        return len(self._users)
+
+    def stats(self):
+        """ Return the size of the cache and its hits and misses. """
+        return {"size": len(self._users), "hits": self.hits, "misses": self.misses}
+
+_users = UserCache()
+_passwords = PasswordHasher(bcrypt)
 
 class User(UserMixin):
 
     @classmethod
     def get(cls, uid):
-        cur = mysql.connection.cursor(DictCursor)
-        cur.execute('''SELECT `username`, `user_id`, `rating`, `player_token` FROM `user` WHERE `user_id` = %s''', (uid, ))
-        rv = cur.fetchall()
+        user = _users.get(uid)
+        if user is not None:
+            return user
+
+        with mysql.connection() as conn:
+            cur = conn.cursor(DictCursor)
+            cur.execute('''SELECT `username`, `user_id`, `rating`, `player_token` FROM `user` WHERE `user_id` = %s''', (uid, ))
+            rv = cur.fetchall()
         if len(rv) != 1:
             return None
 
         user_data = rv[0]
-        return cls(user_data["user_id"], user_data["player_token"], user_data["username"], user_data["rating"])
+        user = cls(user_data["user_id"], user_data["player_token"], user_data["username"], user_data["rating"])
+        _users.put(user)
+        return user
+
+    @classmethod
+    def get_many(cls, uids):
+        """ Return the users of uids by (string) id, with a single query for the ones not cached.
+        Missing users are left out. """
+        users = {}
+        for uid in uids:
+            user = _users.get(uid)
+            if user is not None:
+                users[str(uid)] = user
+        missing = [uid for uid in uids if str(uid) not in users]
+        if not missing:
+            return users
+
+        with mysql.connection() as conn:
+            cur = conn.cursor(DictCursor)
+            cur.execute("SELECT `username`, `user_id`, `rating`, `player_token` FROM `user` "
+                        "WHERE `user_id` IN ({})".format(", ".join(["%s"] * len(missing))), missing)
+            rv = cur.fetchall()
+        for user_data in rv:
+            user = cls(user_data["user_id"], user_data["player_token"], user_data["username"], user_data["rating"])
+            _users.put(user)
+            users[str(user.id)] = user
+        return users
 
     @classmethod
     def create(cls, username, password, email=None):
         insert_query = "INSERT INTO `user` (`username`, `password`, `email`) VALUES (%s, %s, %s)"
-        pw_hash = bcrypt.generate_password_hash(password)
+        pw_hash = _passwords.generate(password)
         try:
-            cur = mysql.connection.cursor()
-            cur.execute(insert_query, (username, pw_hash, email))
-            mysql.connection.commit()
+            with mysql.connection() as conn:
+                cur = conn.cursor()
+                cur.execute(insert_query, (username, pw_hash, email))
+                conn.commit()
         except MySQLdb._exceptions.IntegrityError:
             return False
         return True
@@ -42,9 +128,10 @@ class User(UserMixin):
         select_query = "SELECT `username`, `user_id`, `rating`, `password` from `user` WHERE `username` = %s"
         update_token_query = "UPDATE `user` SET `player_token` = %s WHERE `username` = %s"
 
-        cur = mysql.connection.cursor(DictCursor)
-        cur.execute(select_query, (username))
-        rv = cur.fetchall()
+        with mysql.connection() as conn:
+            cur = conn.cursor(DictCursor)
+            cur.execute(select_query, (username))
+            rv = cur.fetchall()
 
         # check username exists
         if len(rv) != 1:
@@ -52,15 +139,19 @@ class User(UserMixin):
         user_data = rv[0]
 
         # check password
-        pw_correct = bcrypt.check_password_hash(user_data["password"], password)
+        pw_correct = _passwords.check(user_data["password"], password)
         if not pw_correct:
             return None
 
         # Generate new player-token for sessions
         new_player_token = uuid.uuid4()
-        cur.execute(update_token_query, (new_player_token, username))
+        with mysql.connection() as conn:
+            conn.cursor().execute(update_token_query, (new_player_token, username))
+            conn.commit()
 
-        return User(user_data["user_id"], new_player_token, user_data["username"], user_data["rating"])
+        user = User(user_data["user_id"], new_player_token, user_data["username"], user_data["rating"])
+        _users.put(user)  # replacing the cached user with the old token
+        return user
 
     def __init__(self, user_id, player_token, username, rating):
         self.id = user_id
@@ -0,0 +1,105 @@
+"""
+mysql_pool.py
+
+A bounded pool of MySQL connections, replacing flask_mysqldb (which opens a connection per
+request and per socket event).
+
+Up to MYSQL_POOL_SIZE connections are opened as needed and reused. Greenlets wait for a free
+connection for up to MYSQL_POOL_TIMEOUT seconds, on eventlet primitives, so waiting never
+blocks the hub. Connections are rolled back when returned, so no transaction (or the snapshot
+of one) outlives its use, and connections idle for long are pinged before they are reused.
+"""
+import time
+from contextlib import contextmanager
+
+import MySQLdb
+from eventlet.queue import LifoQueue, Empty
+from eventlet.semaphore import Semaphore
+
+class PoolTimeout(Exception):
+    """ No connection became free in time. """
+
+class MySQLPool():
+    """ Pool of MySQL connections, configured from the app like flask_mysqldb. """
+
+    def __init__(self, app=None):
+        self._connect   = None
+        self._timeout   = None
+        self._ping_idle = None
+        self._slots     = None
+        self._idle      = None
+        self.opened     = 0
+        self.timeouts   = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.configure(lambda: MySQLdb.connect(host=config["MYSQL_HOST"],
+                                               user=config["MYSQL_USER"],
+                                               passwd=config["MYSQL_PASSWORD"],
+                                               db=config["MYSQL_DB"]),
+                       config["MYSQL_POOL_SIZE"], config["MYSQL_POOL_TIMEOUT"])
+
+    def configure(self, connect, size=8, timeout=5, ping_idle=60):
+        """ Pool up to size connections made by connect(). Connections idle for more than
+        ping_idle seconds are checked before they are reused. """
+        self._connect   = connect
+        self._timeout   = timeout
+        self._ping_idle = ping_idle
+        self._slots     = Semaphore(size)
+        self._idle      = LifoQueue()  # (connection, time returned), most recent first
+
+    @contextmanager
+    def connection(self):
+        """ Borrow a connection for the duration of a with block. """
+        if not self._slots.acquire(timeout=self._timeout):
+            self.timeouts += 1
+            raise PoolTimeout("No MySQL connection available after {}s".format(self._timeout))
+        conn = None
+        try:
+            conn = self._get()
+            yield conn
+        except MySQLdb.OperationalError:
+            self._close(conn)  # likely broken, don't reuse it
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._put(conn)
+            self._slots.release()
+
+    def _get(self):
+        while True:
+            try:
+                conn, returned = self._idle.get_nowait()
+            except Empty:
+                self.opened += 1
+                return self._connect()
+            if time.time() - returned < self._ping_idle:
+                return conn
+            try:
+                conn.ping()
+                return conn
+            except MySQLdb.Error:
+                self._close(conn)
+
+    def _put(self, conn):
+        try:
+            conn.rollback()
+        except MySQLdb.Error:
+            self._close(conn)
+            return
+        self._idle.put((conn, time.time()))
+
+    def _close(self, conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def __len__(self):
+        """ Number of idle connections. """
+        return self._idle.qsize()
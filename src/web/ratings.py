@@ -0,0 +1,133 @@
+"""
+ratings.py
+
+Elo ratings of players, and a leaderboard of them in redis.
+
+Ratings are updated by the archiver (see web.game.archive) in the transaction archiving the
+game, and the leaderboard is updated once it commits. When the rating parameters change, all
+archived results can be replayed with `python -m web.ratings [--k=<k>] [--initial=<rating>]`,
+which streams the games in the order they ended and keeps ratings in a flat list indexed by
+player, then rewrites the ratings of all users and swaps in a new leaderboard.
+"""
+DEFAULT_K       = 32
+DEFAULT_RATING  = 1500
+
+SCORES = {"WHITE": 1.0, "BLACK": 0.0}
+
+def expected_score(rating, opponent):
+    """ Return the expected score (0 to 1) of a player against an opponent. """
+    return 1 / (1 + 10 ** ((opponent - rating) / 400))
+
+def rate(white, black, score, k=DEFAULT_K):
+    """ Return the new ratings of white and black after a game in which white scored score
+    (1 for a win, 0.5 for a draw, 0 for a loss). """
+    delta = k * (score - expected_score(white, black))
+    return white + delta, black - delta
+
+def replay(games, k=DEFAULT_K, initial=DEFAULT_RATING):
+    """ Return the ratings of all players after the given (white, black, score) games, in order. """
+    index   = {}
+    ratings = []
+    for white, black, score in games:
+        w = index.get(white)
+        if w is None:
+            w = index[white] = len(ratings)
+            ratings.append(initial)
+        b = index.get(black)
+        if b is None:
+            b = index[black] = len(ratings)
+            ratings.append(initial)
+        ratings[w], ratings[b] = rate(ratings[w], ratings[b], score, k)
+    return {player: ratings[i] for player, i in index.items()}
+
+def update_ratings_query(count):
+    """ Return a query setting the rating of count users, with args (user_id, rating) * count
+    followed by the user_ids. """
+    return "UPDATE `user` SET `rating` = CASE `user_id` {} END WHERE `user_id` IN ({})".format(
+            " ".join(["WHEN %s THEN %s"] * count), ", ".join(["%s"] * count))
+
+def update_ratings(cur, ratings):
+    """ Store ratings (user_id -> rating) of users with cursor cur. """
+    if not ratings:
+        return
+    items = [(user_id, int(round(rating))) for user_id, rating in ratings.items()]
+    cur.execute(update_ratings_query(len(items)),
+                [v for item in items for v in item] + [user_id for user_id, _ in items])
+
+class Leaderboard():
+    """ Players by rating, in a redis sorted set. """
+
+    def __init__(self, db, key):
+        self._db  = db
+        self._key = key
+
+    def update(self, ratings):
+        """ Set the ratings (user_id -> rating) of players. """
+        if ratings:
+            self._db.zadd(self._key, {str(user_id): round(rating) for user_id, rating in ratings.items()})
+
+    def replace(self, ratings, chunk=10000):
+        """ Replace the whole leaderboard with ratings, atomically for readers. """
+        tmp = "{}:new".format(self._key)
+        self._db.delete(tmp)
+        items = [(str(user_id), round(rating)) for user_id, rating in ratings.items()]
+        for i in range(0, len(items), chunk):
+            self._db.zadd(tmp, dict(items[i:i + chunk]))
+        if items:
+            self._db.rename(tmp, self._key)
+        else:
+            self._db.delete(self._key)
+
+    def top(self, n=10):
+        """ Return the n best (user_id, rating) pairs. """
+        return [(user_id.decode(), int(rating))
+                for user_id, rating in self._db.zrevrange(self._key, 0, n - 1, withscores=True)]
+
+    def rank(self, user_id):
+        """ Return the rank (1 is best) of a player, or None if they aren't rated. """
+        rank = self._db.zrevrank(self._key, str(user_id))
+        return None if rank is None else rank + 1
+
+def leaderboard_key(store_key):
+    return "{}:leaderboard".format(store_key)
+
+def recompute(conn, leaderboard, k=DEFAULT_K, initial=DEFAULT_RATING, chunk=1000):
+    """ Replay all archived results, storing the new ratings of users and the leaderboard. """
+    from MySQLdb.cursors import SSCursor
+
+    cur = conn.cursor(SSCursor)  # stream, the games don't have to fit in memory
+    cur.execute("SELECT `white_user_id`, `black_user_id`, `winner` FROM `game` "
+                "WHERE `winner` IS NOT NULL AND `white_user_id` IS NOT NULL AND `black_user_id` IS NOT NULL "
+                "ORDER BY TIMESTAMPADD(MICROSECOND, `duration` * 1000, `started_on`), `game_id`")
+    ratings = replay(((w, b, SCORES[winner]) for w, b, winner in cur), k, initial)
+    cur.close()
+
+    cur = conn.cursor()
+    cur.execute("UPDATE `user` SET `rating` = %s", (initial, ))
+    items = list(ratings.items())
+    for i in range(0, len(items), chunk):
+        update_ratings(cur, dict(items[i:i + chunk]))
+    conn.commit()
+    leaderboard.replace(ratings)
+    return ratings
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import redis
+    import MySQLdb
+    from flask import Config
+
+    config = Config(os.getcwd())
+    config.from_object("web.defaultconfig")
+    if "KFCHESS_CONFIG" in os.environ:
+        config.from_envvar("KFCHESS_CONFIG")
+    options = dict(flag.split("=", 1) for flag in sys.argv[1:] if "=" in flag)
+
+    db = redis.StrictRedis(host=config["REDIS_HOSTNAME"], port=config["REDIS_PORT"])
+    conn = MySQLdb.connect(host=config["MYSQL_HOST"], user=config["MYSQL_USER"],
+                           passwd=config["MYSQL_PASSWORD"], db=config["MYSQL_DB"])
+    ratings = recompute(conn, Leaderboard(db, leaderboard_key(config["REDIS_STORE_KEY"])),
+                        k=float(options.get("--k", config["RATING_K"])),
+                        initial=int(options.get("--initial", config["RATING_INITIAL"])))
+    print("Recomputed ratings of {} players".format(len(ratings)))
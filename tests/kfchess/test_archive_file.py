@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import kfchess.game as kfc
+from kfchess.archive_file import ArchiveWriter, ArchiveReader, encode_game, pack_move, MOVE, INDEX, MAX_STRING
+
+def record(game_id, state=kfc.W_WINS, history=("e2e4@100", "d7d5@250", "e7e8q@10000"), **kwargs):
+    return dict({"game_id": game_id, "white": 1, "black": "bot:2:abc", "cd": 1000, "state": state,
+                 "nfen": "8/8/8/8/8/8/8/K7 - 12", "start_nfen": None, "history": list(history),
+                 "start_time": 1500000000000, "end_time": 1500000060000}, **kwargs)
+
+def test_pack_move():
+    assert len(pack_move("a1h8@0")) == MOVE.size
+    squares, at = MOVE.unpack(pack_move("h7h8n@70000"))
+    assert squares & 63 == 55 and squares >> 6 & 63 == 63 and at == 70000
+
+def test_archive_round_trip(tmpdir):
+    path = str(tmpdir.join("games"))
+    with ArchiveWriter(path, batch_size=2) as writer:
+        for game_id in range(5):
+            writer.append(record(game_id, state=kfc.B_WINS if game_id % 2 else kfc.W_WINS))
+        assert os.path.getsize(path + ".idx") == 4 * INDEX.size  # two full batches
+    assert writer.written == 5
+
+    with ArchiveReader(path) as archive:
+        assert len(archive) == 5
+        assert list(archive.ids()) == [0, 1, 2, 3, 4]
+        game = archive.get(3)
+        assert (game.game_id, game.white, game.black, game.cd) == (3, "1", "bot:2:abc", 1000)
+        assert game.state == kfc.B_WINS and game.duration == 60000
+        assert game.nfen == kfc.STARTING_NFEN
+        assert game.history == ["e2e4@100", "d7d5@250", "e7e8q@10000"]
+        assert game.moves[2] == ("e7", "e8", kfc.QUEEN, 10000)
+        assert archive.get(7) is None and 4 in archive
+        assert [g.game_id for g in archive.scan()] == [0, 1, 2, 3, 4]
+
+def test_archive_appends_and_recovers(tmpdir):
+    path = str(tmpdir.join("games"))
+    with ArchiveWriter(path) as writer:
+        writer.append(record(1, history=[], white=None, start_nfen="4k3/8/8/8/8/8/8/4K3 - 1"))
+    # a batch interrupted after writing its data, and part of an index record
+    with open(path + ".dat", "ab") as dat:
+        dat.write(encode_game(record(2)))
+    with open(path + ".idx", "ab") as idx:
+        idx.write(b"\x02\x00")
+
+    with ArchiveReader(path) as archive:
+        assert [g.game_id for g in archive.scan()] == [1]
+    with ArchiveWriter(path) as writer:
+        writer.append(record(3))
+        writer.append(record(1, state=kfc.B_WINS))  # archived again
+    with ArchiveReader(path) as archive:
+        assert [g.game_id for g in archive.scan()] == [1, 3, 1]
+        game = archive.get(1)
+        assert game.state == kfc.B_WINS
+        first = next(archive.scan())
+        assert first.white is None and len(first) == 0 and first.nfen == "4k3/8/8/8/8/8/8/4K3 - 1"
+
+def test_archive_long_strings(tmpdir):
+    path = str(tmpdir.join("games"))
+    with ArchiveWriter(path) as writer:
+        writer.append(record(1, white="guest:" + "x" * 500))
+        with pytest.raises(ValueError):
+            writer.append(record(2, black="x" * (MAX_STRING + 1)))
+        writer.append(record(3))
+    with ArchiveReader(path) as archive:
+        assert list(archive.ids()) == [1, 3]
+        assert archive.get(1).white == "guest:" + "x" * 500
+
+def test_empty_archive(tmpdir):
+    path = str(tmpdir.join("games"))
+    ArchiveWriter(path).close()
+    with ArchiveReader(path) as archive:
+        assert len(archive) == 0 and list(archive.scan()) == [] and archive.get(1) is None
@@ -0,0 +1,158 @@
+import json
+import random
+import time
+import uuid
+from multiprocessing import Process
+
+import redis
+import pytest
+
+import kfchess.game as kfc
+from kfchess.game import create_game_from_nfen, to_dict, WHITE, BLACK, PLAYING, W_WINS, B_WINS
+from kfchess.redis_games_manager import RedisGamesManager, queue_for, LOBBY_LANE
+from kfchess.bot.board import FastBoard, idx, san
+from kfchess.bot.engine import Engine, LEVELS
+from kfchess.bot.runner import BotGame, BotWorker, request_bot
+
+@pytest.fixture
+def db():
+    _db = redis.StrictRedis()
+    return _db
+
+@pytest.fixture
+def key():
+    return uuid.uuid4()
+
+def fast_moves(board, sq):
+    return sorted((san(f), san(t), p) for f, t, p in board.moves(sq))
+
+def redis_moves(db, key, sq):
+    return sorted((m.from_sq.san, m.to_sq.san, m.promote) for m in kfc.moves(db, key, san(sq)))
+
+def test_board_from_nfen():
+    nfen = "3b4/NP6/rp2k1B1/2R3P1/3K4/2B2Q2/P1P3P1/4r3 - 1"
+    board = FastBoard(1000, nfen)
+    assert board.nfen == nfen
+    assert board.squares[idx("b7")] == ("p", WHITE, None)
+    assert board.squares[idx("e6")] == ("k", BLACK, None)
+
+def test_board_moves_match_game(db, key):
+    """ Random playouts on both boards agree on moves and positions. """
+    rng = random.Random(7)
+    for nfen in [kfc.STARTING_NFEN, "r3k2r/pPppqppp/1pn2n2/4p3/1bB5/2NPPN2/PPPBQPpP/R3K2R KQkq 8"]:
+        redis_board = create_game_from_nfen(db, 0, key, exp=5000, nfen=nfen)
+        redis_board.set_white("w")
+        redis_board.set_black("b")
+        board = FastBoard(0, nfen)
+        for _ in range(60):
+            if board.state != PLAYING:
+                break
+            for sq, _ in board.pieces():
+                assert fast_moves(board, sq) == redis_moves(db, key, sq)
+            moves = [m for sq, _ in board.pieces() for m in board.moves(sq)]
+            from_sq, to_sq, promote = rng.choice(moves)
+            player = "w" if board.squares[from_sq][1] == WHITE else "b"
+            assert board.move(from_sq, to_sq, promote, 0) is not None
+            assert kfc.move(player, db, key, san(from_sq), san(to_sq), promote) is not None
+            assert board.nfen == to_dict(db, key)["nfen"]
+            assert board.state == redis_board.state
+        db.delete(str(key))
+
+def test_board_cooldown_and_winner():
+    board = FastBoard(1000, "4k3/8/8/8/8/8/8/R3K3 Q 1")
+    assert board.move(idx("a1"), idx("a8"), None, 0) is True
+    assert board.castles == ""
+    assert board.move(idx("a8"), idx("e8"), None, 500) is None  # cooling down
+    assert board.ready_at(idx("a8")) == 1000
+    assert board.move(idx("a8"), idx("e8"), None, 1000, color=BLACK) is None
+    assert board.move(idx("a8"), idx("e8"), None, 1000) == ("k", BLACK, None)
+    assert board.state == W_WINS and board.winner == WHITE
+    assert board.move(idx("e1"), idx("e2"), None, 2000) is None
+
+def test_board_apply_changes():
+    board = FastBoard(1000)
+    board.apply_changes({"e2": {"type": ".", "color": ".", "last_move": None},
+                         "e4": {"type": "p", "color": WHITE, "last_move": 120}}, "KQkq", 2, PLAYING)
+    assert board.squares[idx("e2")] is None
+    assert board.squares[idx("e4")] == ("p", WHITE, 120)
+    assert not board.ready(idx("e4"), 500)
+    assert board.nfen == "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR KQkq 2"
+
+def test_engine_levels_take_free_queen():
+    nfen = "4k3/8/8/3q4/8/8/8/3RK3 - 1"
+    for level in (1, 2, 3):
+        move = Engine(level, random.Random(1)).choose(FastBoard(1000, nfen), WHITE, 0)
+        assert (san(move[0]), san(move[1])) == ("d1", "d5")
+
+def test_engine_avoids_defended_pieces():
+    # the rook on d5 is defended by the pawn on e6 (and attacks the queen), the pawn on a4 is not
+    nfen = "4k3/8/4p3/3r4/p7/8/8/3QK3 - 1"
+    move = Engine(1, random.Random(1)).choose(FastBoard(1000, nfen), WHITE, 0)
+    assert (san(move[0]), san(move[1])) == ("d1", "d5")
+    for level in (2, 3):
+        move = Engine(level, random.Random(1)).choose(FastBoard(1000, nfen), WHITE, 0)
+        assert (san(move[0]), san(move[1])) == ("d1", "a4")
+
+def test_engine_respects_cooldown():
+    board = FastBoard(1000, "4k3/8/8/8/8/8/8/4K3 - 1")
+    board.move(idx("e1"), idx("e2"), None, 0)
+    for level in LEVELS:
+        assert Engine(level).choose(board, WHITE, 500) is None
+        assert Engine(level).choose(board, WHITE, 1000) is not None
+
+def test_engine_budget():
+    engine = Engine(3)
+    board = FastBoard(1000)
+    start = time.perf_counter()
+    assert engine.choose(board, WHITE, 0, budget=5) is not None
+    assert time.perf_counter() - start < 0.5
+
+def test_bot_game_follows_confirmations():
+    bot = BotGame(1, "bot", Engine(0, random.Random(3)))
+    assert bot.decide(50) is None  # not synced yet
+    board = {"cd": 1000, "nfen": kfc.STARTING_NFEN, "start_time": kfc.now(), "current_time": kfc.now(),
+             "state": PLAYING, "times": {}, "white": "w", "black": "bot"}
+    bot.on_sync({"board": board, "white": "w", "black": "bot"})
+    assert bot.color == BLACK
+    move = bot.decide(50)
+    assert move is not None and move["from"][1] in "78"
+    assert bot.decide(50) is None  # one move in flight
+    assert bot.on_move("bot", None)  # failed, sync again
+    assert bot.pending is None
+
+    changes = {"e7": {"type": ".", "color": ".", "last_move": None},
+               "e1": {"type": "q", "color": BLACK, "last_move": 10}}
+    assert not bot.on_move("w", {"state": B_WINS, "move": {"changes": changes, "castles": "",
+                                                            "move_number": 2, "state": B_WINS}})
+    assert bot.done
+
+def test_bot_worker_assign(db):
+    in_q, out_q, bots_q = ["{}:{}".format(q, uuid.uuid4()) for q in ("in", "out", "bots")]
+    request_bot(db, bots_q, 12, 1, cd=1000, vs=2)
+    worker = BotWorker(db, in_q, out_q, bots_q)
+    worker.step()
+    white, black = worker.games["12"]
+    assert white.engine.level == 1 and black.engine.level == 2
+    reqs = [json.loads(r) for r in db.lrange(queue_for(in_q, LOBBY_LANE), 0, -1)]
+    assert [(r[1], r[2]) for r in reqs] == [(white.player_id, "game-req"), (white.player_id, "sync-req"),
+                                            (black.player_id, "join-req"), (black.player_id, "sync-req")]
+
+def test_bot_worker_plays(db):
+    """ Two bots play a game through the manager. """
+    in_q, out_q, bots_q = ["{}:{}".format(q, uuid.uuid4()) for q in ("in", "out", "bots")]
+    rgm = RedisGamesManager(db, in_q, out_q, fanout=True)
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    game_id = random.randint(1, 999999999)
+    worker = BotWorker(db, in_q, out_q, bots_q)
+    request_bot(db, bots_q, game_id, 3, cd=100, vs=3)
+    end = time.time() + 5
+    while time.time() < end and worker.moves < 4:
+        worker.step()
+    assert worker.moves >= 4
+    assert all(bot.board is not None for bot in worker.games[str(game_id)])
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
@@ -400,6 +400,41 @@ def test_move_time_delay(db, key):
                                "PPPP.PPP\n" \
                                "RNBQKBNR\n"
 
+def test_ready_time(db, key):
+    board = create_game_from_nfen(db, 100, key, exp=5000)
+    assert ready_time("w", db, key, 'e2') is None  # not playing yet
+    board.set_white("w")
+    board.set_black("b")
+    assert ready_time("w", db, key, 'e2') == board.start_time
+    assert ready_time("b", db, key, 'e2') is None
+    assert ready_time("w", db, key, 'e3') is None
+    assert ready_time("w", db, key, 'z9') is None
+
+    m, _ = move("w", db, key, 'e2', 'e4')
+    assert ready_time("w", db, key, 'e4') == board.start_time + m.time + 100
+    assert m.ready_time == ready_time("w", db, key, 'e4')
+    assert m.moved_squares == [Square.FromSan('e4')]
+
+def test_move_changes(db, key):
+    board = create_game_from_nfen(db, 0, key, exp=5000, nfen="r3k2r/pbppqppp/1pn2n2/4p3/1bB5/2NPPN2/PPPBQPPP/R3K2R KQkq 8")
+    board.set_white("w")
+    board.set_black("b")
+
+    m, _ = move("w", db, key, 'e1', 'g1')
+    assert m.changes == {'e1': {'type': EMPTY, 'color': EMPTY, 'last_move': None},
+                         'g1': {'type': KING, 'color': WHITE, 'last_move': m.time},
+                         'h1': {'type': EMPTY, 'color': EMPTY, 'last_move': None},
+                         'f1': {'type': ROOK, 'color': WHITE, 'last_move': m.time}}
+    assert m.castles == "kq"
+    assert m.move_number == 10
+    assert m.moved_squares == [Square.FromSan('g1'), Square.FromSan('f1')]
+
+    m, _ = move("b", db, key, 'b4', 'c3')  # capture
+    assert m.changes == {'b4': {'type': EMPTY, 'color': EMPTY, 'last_move': None},
+                         'c3': {'type': BISHOP, 'color': BLACK, 'last_move': m.time}}
+    assert m.castles == "kq"
+    assert m.move_number == 11
+
 def test_move_castle_rook_delayed(db, key):
     board = create_game_from_nfen(db, 100, key, exp=5000, nfen="r3k2r/pbppqppp/1pn2n2/4p3/1bB5/2NPPN2/PPPBQPPP/R3K2R KQkq 8")
     board.set_white("w")
@@ -533,4 +568,15 @@ def test_board_to_dict(db, key):
     d = to_dict(db, key)
     assert 'e4' in d["times"]
     assert len(d['times'].keys()) == 1
+    assert [m.split("@")[0] for m in d["history"]] == ["e2e4"]
 
+
+def test_board_history(db, key):
+    create_game_from_nfen(db, 0, key)
+    board = get_board(db, key)
+    board.set_white("w")
+    board.set_black("b")
+    move("w", db, key, "e2", "e4")
+    move("b", db, key, "e7", "e5")
+    move("b", db, key, "e7", "e5")  # illegal, not recorded
+    assert [m.split("@")[0] for m in board.history] == ["e2e4", "e7e5"]
@@ -0,0 +1,59 @@
+import json
+import time
+import uuid
+from multiprocessing import Process
+
+import redis
+import pytest
+
+from kfchess.redis_games_manager import RedisGamesManager
+from kfchess.loadtest import LatencyStats, LoadTest, RedisTransport, format_report
+
+@pytest.fixture
+def db():
+    _db = redis.StrictRedis()
+    return _db
+
+def test_latency_stats():
+    stats = LatencyStats()
+    stats.request(1, "a", "move")
+    stats.request(1, "a", "move")
+    stats.request(2, "a", "move")
+    stats.confirm(1, "a", "move")
+    stats.confirm(1, "b", "move")  # nothing pending
+    assert stats.pending == 2
+    stats.expire(0)
+    report = stats.report(1)
+    assert report["move"]["sent"] == 3
+    assert report["move"]["confirmed"] == 1
+    assert report["move"]["lost"] == 2
+    assert "move" in format_report(report)
+
+def test_latency_stats_merge():
+    a, b = LatencyStats(), LatencyStats()
+    a.request(1, "a", "sync")
+    a.confirm(1, "a", "sync")
+    b.request(1, "b", "sync")
+    b.confirm(1, "b", "sync")
+    b.errors = 1
+    a.merge(b)
+    assert a.report(2)["sync"]["confirmed"] == 2 and a.report(2)["errors"] == 1
+
+@pytest.mark.parametrize("fanout,adversarial", [(False, False), (True, True)])
+def test_load_test_against_manager(db, fanout, adversarial):
+    in_q, out_q = "in:{}".format(uuid.uuid4()), "out:{}".format(uuid.uuid4())
+    rgm = RedisGamesManager(db, in_q, out_q, fanout=fanout)
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    load = LoadTest(RedisTransport(db, in_q, out_q, fanout), players=4, duration=1.5, rate=10,
+                    sync_rate=2, cd=100, adversarial=adversarial, seed=1)
+    stats = load.run(drain=2000)
+    report = stats.report(1.5)
+    assert report["game"]["confirmed"] >= 2 and report["join"]["confirmed"] >= 2
+    assert report["move"]["confirmed"] > 0 and report["sync"]["confirmed"] > 0
+    assert sum(res["lost"] for kind, res in report.items() if kind != "errors") == 0
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
@@ -0,0 +1,56 @@
+import io
+import json
+import logging
+
+import pytest
+
+from kfchess import logs
+
+@pytest.fixture
+def stream():
+    stream = io.StringIO()
+    yield stream
+    logs.shutdown()
+
+def lines(stream):
+    logs.shutdown()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+def test_logs_levels_per_category(stream):
+    logs.configure(levels={"test-a": "debug", "test-b": "warning"}, stream=stream)
+    logs.get_log("test-a").debug("shown", x=1)
+    logs.get_log("test-b").info("hidden")
+    logs.get_log("test-b").warning("shown", game=3)
+    assert [(l["cat"], l["level"], l["event"]) for l in lines(stream)] == \
+        [("test-a", "DEBUG", "shown"), ("test-b", "WARNING", "shown")]
+
+def test_logs_structured_fields(stream):
+    logs.configure(stream=stream)
+    log = logs.get_log("manager")
+    assert not log.enabled(logging.DEBUG) and log.enabled(logging.INFO)
+    log.info("expire", game=1, state=b"playing")
+    try:
+        raise ValueError("bad")
+    except ValueError:
+        log.exception("request failed", request="[1]")
+    expire, failed = lines(stream)
+    assert expire["game"] == 1 and expire["state"] == "b'playing'" and expire["ts"] > 0
+    assert failed["request"] == "[1]" and "ValueError: bad" in failed["exc"]
+
+def test_logs_sampling(stream):
+    logs.configure(levels={"test-c": "debug"}, samples={"test-c": 0.1}, stream=stream)
+    log = logs.get_log("test-c")
+    for i in range(1000):
+        log.debug("sampled", i=i)
+    log.error("not sampled")
+    events = [l["event"] for l in lines(stream)]
+    assert 30 < events.count("sampled") < 200
+    assert events[-1] == "not sampled"
+
+def test_logs_drop_when_full(stream):
+    logs.configure(levels={"test-d": "info"}, stream=stream, queue_size=10)
+    logs._writer._queue.put(None)  # stop the writer, so the queue fills up
+    logs._writer._thread.join()
+    for i in range(20):
+        logs.get_log("test-d").info("event", i=i)
+    assert logs.dropped() == 10
@@ -0,0 +1,40 @@
+import time
+
+from kfchess.profiler import SamplingProfiler, profile_path
+from kfchess.logs import native_modules
+
+def busy_loop(profiler, until):
+    while time.monotonic() < until:
+        profiler.tag = "even" if int(time.monotonic() * 100) % 2 else "odd"
+        sum(range(1000))
+
+def test_profiler_samples_tagged_stacks(tmpdir):
+    done = []
+    profiler = SamplingProfiler(str(tmpdir.join("p.folded")), interval=1, on_done=done.append, tag="odd")
+    profiler.start(200)
+    busy_loop(profiler, time.monotonic() + 0.3)
+    assert not profiler.running and done == [profiler]
+
+    lines = tmpdir.join("p.folded").read().splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profiler.samples > 20
+    roots = {line.split(";", 1)[0] for line in lines}
+    assert roots <= {"even", "odd"}
+    busy = sum(int(line.rsplit(" ", 1)[1]) for line in lines if "test_profiler.py:busy_loop" in line)
+    assert busy > profiler.samples * 0.8
+
+def test_profiler_other_thread(tmpdir):
+    profiler = SamplingProfiler(str(tmpdir.join("p.folded")), interval=1)
+    _, threading = native_modules()  # tests of the web tier patch threading
+    worker = threading.Thread(target=busy_loop, args=(profiler, time.monotonic() + 0.2))
+    worker.start()
+    profiler._target = worker.ident
+    profiler.start(10000)
+    time.sleep(0.1)
+    profiler.stop()
+    worker.join()
+    assert profiler.samples > 0
+    assert "test_profiler.py:busy_loop" in tmpdir.join("p.folded").read()
+
+def test_profile_path(tmpdir):
+    path = profile_path(str(tmpdir), "manager")
+    assert path.startswith(str(tmpdir)) and path.endswith(".folded")
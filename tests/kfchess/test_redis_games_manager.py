@@ -10,7 +10,10 @@ from multiprocessing import Process
 import pytest
 
 from kfchess.game import *
-from kfchess.redis_games_manager import RedisGamesManager
+from kfchess.redis_games_manager import RedisGamesManager, WeightedLanes, QueueWaitStats, queue_for, lane_for
+from kfchess.redis_games_manager import MOVE_LANE, SYNC_LANE, LOBBY_LANE, game_channel, snapshot_key
+from kfchess.redis_games_manager import ManagerStats
+from kfchess.stats import query_stats, query_profile, format_stats
 
 #Todo: get this from config to be setup dependant
 @pytest.fixture
@@ -129,6 +132,24 @@ def test_manage_game_make_move(rgm, game_id):
     assert res[0] == game_id
     assert res[2] == "move-cnf"
 
+def test_manage_game_traced_requests(rgm, game_id):
+    db, in_q, out_q, prefix = rgm
+
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 1000}, {"t": now(), "trace": "a"}]))
+    _, res = db.blpop(out_q, 1)
+    i, p, r, d, trace = json.loads(res)
+    assert r == "game-cnf" and trace["trace"] == "a"
+    assert trace["t"] <= trace["start"] <= trace["end"]
+
+    db.rpush(in_q, json.dumps([game_id, 1, "join-req", None, {"t": now()}]))
+    _, res = db.blpop(out_q, 1)
+    assert len(json.loads(res)) == 4
+
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "e2", "to": "e4"}, {"t": now(), "trace": "b"}]))
+    _, res = db.blpop(out_q, 1)
+    i, p, r, d, trace = json.loads(res)
+    assert r == "move-cnf" and d is not None and trace["trace"] == "b"
+
 def test_manage_game_make_move_illegal(rgm, game_id):
     db, in_q, out_q, prefix = rgm
 
@@ -224,12 +245,17 @@ def test_manage_game_correct_response_to_move(game_id, rgm):
         assert state == PLAYING
         assert "from" in move and "to" in move and "time" in move and "promote" in move
         assert move["from"] == fr and move["to"] == to
+        assert move["changes"][fr]["type"] == EMPTY
+        assert move["changes"][to]["type"] == piece
+        assert move["state"] == PLAYING
         print(fr, to)
         print(kfc.ascii)
         assert kfc[Square.FromSan(fr)].type == EMPTY
         assert kfc[Square.FromSan(to)].type == piece
         assert kfc[Square.FromSan(to)].color == WHITE if player == 0 else BLACK
     assert db.llen(out_q) == 0
+    assert move["changes"]["f1"] == {"type": ROOK, "color": WHITE, "last_move": move["time"]}  # castle moved the rook
+    assert move["castles"] == "kq"
 
     # Test illegal moves
     moves = [(0, 'e4', 'e3', PAWN, EMPTY), (1, 'e5', 'e4', PAWN, PAWN), (1,'c4', 'c5', BISHOP, EMPTY), (1, 'f3', 'g1', KNIGHT, KING), (0, 'f3', 'g1', KNIGHT, KING), (1, 'f3', 'h4', KNIGHT, EMPTY), (1, 'e4', 'e5', PAWN, PAWN)]
@@ -262,3 +288,293 @@ def test_manage_game_correct_response_to_move(game_id, rgm):
         assert data is None
 
     assert db.llen(out_q) == 0
+
+def test_lane_for_commands():
+    assert lane_for("move-req") == MOVE_LANE
+    assert lane_for("sync-req") == SYNC_LANE
+    assert lane_for("game-req") == LOBBY_LANE
+    assert lane_for("join-req") == LOBBY_LANE
+    assert lane_for("whatever") == LOBBY_LANE
+    assert queue_for("reqs", LOBBY_LANE) == "reqs"
+    assert queue_for("reqs", MOVE_LANE) == "reqs:move"
+
+def test_weighted_lanes_share():
+    lanes = WeightedLanes("reqs", {MOVE_LANE: 8, SYNC_LANE: 3, LOBBY_LANE: 1})
+    served = {MOVE_LANE: 0, SYNC_LANE: 0, LOBBY_LANE: 0}
+    for _ in range(1200):  # all lanes backlogged, first lane in order is always served
+        lane = lanes.lane_of(lanes.order()[0].encode())
+        lanes.charge(lane)
+        served[lane] += 1
+    assert served == {MOVE_LANE: 800, SYNC_LANE: 300, LOBBY_LANE: 100}
+
+def test_weighted_lanes_priority_when_idle():
+    lanes = WeightedLanes("reqs")
+    assert lanes.order() == ["reqs:move", "reqs:sync", "reqs"]
+    for _ in range(100):  # only moves were served for a long time
+        lanes.charge(MOVE_LANE)
+    assert lanes.order()[0] != "reqs:move"
+    others = 0
+    while lanes.order()[0] != "reqs:move":
+        lanes.charge(lanes.lane_of(lanes.order()[0]))
+        others += 1
+    assert others <= 3  # credits are clamped, moves are back on top quickly
+
+def test_queue_wait_stats():
+    stats = QueueWaitStats()
+    for wait in range(1, 101):
+        stats.record(MOVE_LANE, wait)
+    summary = stats.summary()
+    assert summary[MOVE_LANE]["count"] == 100
+    assert summary[MOVE_LANE]["max"] == 100
+    assert summary[MOVE_LANE]["p50"] == 51
+    assert summary[MOVE_LANE]["p99"] == 100
+    assert summary[SYNC_LANE]["count"] == 0
+
+def test_manager_stats_summary():
+    stats = ManagerStats()
+    for elapsed in [1, 2, 3, 10]:
+        stats.record("move-req", elapsed)
+    stats.record("sync-req", 4)
+    summary = stats.summary()
+    assert summary["requests"]["move-req"] == {"count": 4, "mean": 4}
+    assert summary["processing"]["count"] == 5 and summary["processing"]["max"] == 10
+    assert summary["processing"]["p50"] == 3
+
+def test_manage_game_stats_req(rgm, game_id):
+    db, in_q, out_q, prefix = rgm
+
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 1000}]))
+    db.rpush(in_q, json.dumps([game_id, 0, "bad-req", None]))
+    db.blpop(out_q, 1)
+    db.blpop(out_q, 1)
+
+    stats = query_stats(db, in_q, timeout=2, tracemalloc=True)
+    assert stats["requests"]["game-req"]["count"] == 1
+    assert stats["errors"] == {"unknown command": 1}
+    assert stats["games"]["created"] == 1 and stats["games"]["active"] == 1
+    assert stats["queues"]["in"] == {MOVE_LANE: 0, SYNC_LANE: 0, LOBBY_LANE: 0}
+    assert stats["rss"] > 0 and stats["uptime"] >= 0
+    assert db.llen(out_q) == 0  # replied on its own list
+    stats = query_stats(db, in_q, timeout=2, top=3, tracemalloc=False)
+    assert len(stats["allocations"]) == 3
+    assert "top allocations" in format_stats(stats)
+    assert query_stats(db, in_q, timeout=2)["allocations"] is None
+
+    # without a reply key, the reply goes to the out queue
+    db.rpush(queue_for(in_q, lane_for("stats-req")), json.dumps([-1, 0, "stats-req", {}]))
+    _, res = db.blpop(out_q, 1)
+    assert json.loads(res)[2] == "stats-cnf"
+
+def test_manage_game_profile_req(rgm, game_id):
+    db, in_q, out_q, prefix = rgm
+
+    profile = query_profile(db, in_q, 200, interval=1, timeout=2)
+    assert profile["samples"] > 0
+    with open(profile["path"]) as folded:
+        assert all(line.split(";", 1)[0] in ("idle", "profile-req") for line in folded)
+
+def test_manage_game_moves_before_lobby(db, in_q, out_q, game_id):
+    rgm = RedisGamesManager(db, in_q, out_q)
+    board = create_game_from_nfen(db, 1000, rgm.game_key_from_id(game_id))
+    board.set_white(0)
+    board.set_black(1)
+
+    # a burst of lobby requests followed by a move, all queued before the manager starts reading,
+    # the move should be answered early
+    pipe = db.pipeline()
+    for i in range(20):
+        pipe.rpush(in_q, json.dumps([game_id + i + 1, 0, "sync-req", None]))
+    pipe.rpush(queue_for(in_q, MOVE_LANE), json.dumps([game_id, 0, "move-req", {"from": "e2", "to": "e4"},
+                                                       {"t": now()}]))
+    pipe.execute()
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    cmds = []
+    for _ in range(21):
+        _, res = db.blpop(out_q, 1)
+        cmds.append(json.loads(res)[2])
+    assert cmds.index("move-cnf") < 3
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
+
+def test_manage_game_fanout(db, in_q, out_q, game_id):
+    rgm = RedisGamesManager(db, in_q, out_q, fanout=True)
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    pubsub = db.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(game_channel(out_q, game_id))
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 1000}]))
+    db.rpush(in_q, json.dumps([game_id, 1, "join-req", None]))
+    _, res = db.blpop(out_q, 1)
+    assert json.loads(res)[2] == "game-cnf"
+    _, res = db.blpop(out_q, 1)
+    assert json.loads(res)[2] == "join-cnf"
+
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "e2", "to": "e4"}]))
+    msg = pubsub.get_message(timeout=1)
+    while msg is None:
+        msg = pubsub.get_message(timeout=1)
+    gid, pid, cmd, data = json.loads(msg["data"])
+    assert gid == game_id and cmd == "move-cnf" and data is not None
+    assert db.llen(out_q) == 0
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
+
+def test_manage_game_ready_ind(db, in_q, out_q, game_id):
+    rgm = RedisGamesManager(db, in_q, out_q, notify_ready=True)
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 100}]))
+    db.rpush(in_q, json.dumps([game_id, 1, "join-req", None]))
+    db.blpop(out_q, 1)
+    db.blpop(out_q, 1)
+
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "e1", "to": "e1"}]))
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "g1", "to": "f3"}]))
+    _, res = db.blpop(out_q, 1)
+    _, res = db.blpop(out_q, 1)
+    move_time = json.loads(res)[3]["move"]["time"]
+
+    _, res = db.blpop(out_q, 1)
+    gid, _, cmd, data = json.loads(res)
+    assert gid == game_id
+    assert cmd == "ready-ind"
+    assert data == {"sqs": ["f3"], "time": move_time}
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
+
+def test_manage_game_premove(rgm, game_id):
+    db, in_q, out_q, prefix = rgm
+
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 300}]))
+    db.rpush(in_q, json.dumps([game_id, 1, "join-req", None]))
+    db.blpop(out_q, 1)
+    db.blpop(out_q, 1)
+
+    # nothing to premove
+    db.rpush(in_q, json.dumps([game_id, 0, "premove-req", {"from": "e4", "to": "e5"}]))
+    _, res = db.blpop(out_q, 1)
+    assert json.loads(res)[2:] == ["move-cnf", None]
+
+    # ready pieces are moved right away
+    db.rpush(in_q, json.dumps([game_id, 0, "premove-req", {"from": "e2", "to": "e4"}]))
+    _, res = db.blpop(out_q, 1)
+    _, _, cmd, data = json.loads(res)
+    assert cmd == "move-cnf" and data["move"]["to"] == "e4"
+    start = time.time()
+
+    # the premove is held until the pawn is ready, a replaced premove fails
+    db.rpush(in_q, json.dumps([game_id, 0, "premove-req", {"from": "e4", "to": "e6"}]))
+    db.rpush(in_q, json.dumps([game_id, 0, "premove-req", {"from": "e4", "to": "e5"}]))
+    _, res = db.blpop(out_q, 1)
+    assert json.loads(res)[2:] == ["move-cnf", None]
+    _, res = db.blpop(out_q, 1)
+    _, pid, cmd, data = json.loads(res)
+    assert time.time() - start >= 0.29
+    assert pid == 0 and cmd == "move-cnf"
+    assert data["move"]["from"] == "e4" and data["move"]["to"] == "e5"
+
+def test_manage_game_snapshots(db, in_q, out_q, game_id):
+    rgm = RedisGamesManager(db, in_q, out_q, snapshots=True)
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    key = snapshot_key(out_q, game_id)
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 1000}]))
+    db.blpop(out_q, 1)
+    assert int(db.hget(key, "version")) == 1
+    assert json.loads(db.hget(key, "data"))["black"] is None
+
+    db.rpush(in_q, json.dumps([game_id, 1, "join-req", None]))
+    db.blpop(out_q, 1)
+    assert int(db.hget(key, "version")) == 2
+    assert json.loads(db.hget(key, "data"))["black"] == 1
+
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "e2", "to": "e4"}]))
+    db.blpop(out_q, 1)
+    assert int(db.hget(key, "version")) == 3
+    data = json.loads(db.hget(key, "data"))
+    assert "e4" in data["board"]["times"]
+    assert data["board"]["nfen"] == "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR KQkq 2"
+
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "e2", "to": "e4"}]))  # illegal, no change
+    db.blpop(out_q, 1)
+    assert int(db.hget(key, "version")) == 3
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
+
+def test_manage_game_expires_idle_games(db, in_q, out_q, game_id):
+    rgm = RedisGamesManager(db, in_q, out_q, snapshots=True, sweep_interval=50)
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 100, "exp": 500}]))
+    db.blpop(out_q, 1)
+    db.rpush(in_q, json.dumps([game_id + 1, 0, "game-req", {"cd": 100}]))
+    db.blpop(out_q, 1)
+    db.rpush(in_q, json.dumps([game_id, 1, "join-req", None]))
+    db.blpop(out_q, 1)
+    time.sleep(0.3)
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "e2", "to": "e4"}]))
+    db.blpop(out_q, 1)
+    time.sleep(0.3)
+    assert db.exists(rgm.game_key_from_id(game_id))  # the move pushed back the expiry
+
+    # sweeps wake up on their own, without requests coming in
+    _, res = db.blpop(out_q, 2)
+    i, p, cmd, data = json.loads(res)
+    assert (i, p, cmd) == (str(game_id), -1, "expire-ind")
+    assert data["state"] in ("playing", None)  # the game key may have expired just before
+    assert not db.exists(rgm.game_key_from_id(game_id))
+    assert not db.exists(snapshot_key(out_q, game_id))
+    assert db.zrange(rgm.expiry_key, 0, -1) == [str(game_id + 1).encode()]
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
+
+def test_archive_drops_premoves(db, in_q, out_q, game_id):
+    rgm = RedisGamesManager(db, in_q, out_q, archive_queue="archive:{}".format(uuid.uuid4()))
+    game_key = rgm.game_key_from_id(game_id)
+    create_game_from_nfen(db, 1000, game_key)
+    rgm._premoves[(game_id, "e2")] = (0, 1)
+    rgm._premoves[(game_id + 1, "e7")] = (1, 2)
+    rgm._archive(game_id, game_key)
+    assert list(rgm._premoves) == [(game_id + 1, "e7")]
+
+def test_manage_game_archives_finished_games(db, in_q, out_q, game_id):
+    archive_q = "archive:{}".format(uuid.uuid4())
+    rgm = RedisGamesManager(db, in_q, out_q, archive_queue=archive_q, snapshots=True)
+    p = Process(target=rgm.run)
+    p.daemon = True
+    p.start()
+
+    game_key = rgm.game_key_from_id(game_id)
+    db.rpush(in_q, json.dumps([game_id, 0, "game-req", {"cd": 0, "nfen": "4k3/8/8/8/8/8/8/4KQ2 - 1"}]))
+    db.rpush(in_q, json.dumps([game_id, 1, "join-req", None]))
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "f1", "to": "f7"}]))
+    db.rpush(in_q, json.dumps([game_id, 0, "move-req", {"from": "f7", "to": "e8"}]))
+    for _ in range(4):
+        db.blpop(out_q, 1)
+    _, res = db.brpop(archive_q, 1)
+    record = json.loads(res)
+    assert record["game_id"] == game_id
+    assert (record["white"], record["black"], record["state"]) == (0, 1, W_WINS)
+    assert [m.split("@")[0] for m in record["history"]] == ["f1f7", "f7e8"]
+    assert record["end_time"] >= record["start_time"]
+    assert not db.exists(game_key) and not db.exists(game_key + ":history")
+    assert not db.exists(snapshot_key(out_q, game_id))
+
+    db.rpush(in_q, json.dumps([-1, -1, "exit-req", None]))
+    db.blpop(out_q, 1)
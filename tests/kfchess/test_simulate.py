@@ -0,0 +1,41 @@
+import io
+import json
+
+from kfchess.game import WHITE, BLACK
+from kfchess.bot.simulate import play, make_configs, simulate, Summary
+
+def test_play_is_reproducible():
+    config = make_configs([1000], [1])[0]
+    assert play(config, 3) == play(config, 3)
+
+def test_play_ends_with_a_winner():
+    config = make_configs([1000], [3, 0])[1]  # 3 vs 0
+    record = play(config, 1)
+    assert record["winner"] == WHITE
+    assert record["captures"][WHITE]["k"] == 1
+    assert record["moves"][WHITE] > 0 and record["time"] > 0
+
+def test_play_draws_after_max_time():
+    config = dict(make_configs([1000], [0], max_time=2000)[0], delay={WHITE: 5000, BLACK: 5000})
+    record = play(config, 1)
+    assert record["winner"] is None and record["time"] == 2000
+
+def test_summary():
+    summary = Summary({"id": 0})
+    summary.add({"winner": WHITE, "time": 100, "moves": {WHITE: 3, BLACK: 2}, "captures": {WHITE: {"k": 1}, BLACK: {}}})
+    summary.add({"winner": None, "time": 300, "moves": {WHITE: 1, BLACK: 1}, "captures": {WHITE: {}, BLACK: {"p": 2}}})
+    res = summary.to_dict()
+    assert res["white_wins"] == 0.5 and res["draws"] == 0.5 and res["black_wins"] == 0
+    assert res["time"]["mean"] == 200 and res["time"]["max"] == 300
+    assert res["moves_per_game"] == 3.5
+    assert res["captures_per_game"] == {WHITE: {"k": 0.5}, BLACK: {"p": 1.0}}
+
+def test_simulate_writes_games_and_summaries():
+    configs = make_configs([1000, 5000], [2])
+    out = io.StringIO()
+    summaries = simulate(configs, 5, out, workers=2, shard_size=2)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    games = [line for line in lines if not line.get("summary")]
+    assert len(games) == 10 and len(lines) == 12
+    assert sorted(game["seed"] for game in games) == list(range(10))
+    assert [summaries[c["id"]].games for c in configs] == [5, 5]
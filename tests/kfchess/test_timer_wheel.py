@@ -0,0 +1,46 @@
+import random
+
+import pytest
+
+from kfchess.timer_wheel import TimerWheel
+
+def test_timer_wheel_expires_in_time():
+    wheel = TimerWheel(1000, resolution=10, slots=8, levels=3)
+    wheel.schedule(1005, "a")
+    wheel.schedule(1010, "b")
+    wheel.schedule(1011, "c")
+    assert len(wheel) == 3
+    assert wheel.advance(1009) == []
+    assert sorted(wheel.advance(1010)) == ["a", "b"]
+    assert wheel.advance(1019) == []
+    assert wheel.advance(1020) == ["c"]
+    assert len(wheel) == 0
+
+def test_timer_wheel_past_timers():
+    wheel = TimerWheel(1000)
+    wheel.schedule(500, "late")
+    assert wheel.advance(1000) == ["late"]
+
+def test_timer_wheel_cascades():
+    random.seed(0)
+    wheel = TimerWheel(0, resolution=10, slots=8, levels=3)  # 5.12 seconds in range
+    timers = {i: random.randint(1, 20000) for i in range(5000)}
+    for i, when in timers.items():
+        wheel.schedule(when, i)
+
+    fired = {}
+    now = 0
+    while now < 21000:
+        prev = now
+        now += random.randint(1, 100)
+        for i in wheel.advance(now):
+            assert i not in fired
+            assert timers[i] <= now
+            assert -(-timers[i] // 10) * 10 > prev  # expired on the first advance it was due
+            fired[i] = now
+    assert len(fired) == len(timers)
+    assert len(wheel) == 0
+
+def test_timer_wheel_slots_power_of_two():
+    with pytest.raises(ValueError):
+        TimerWheel(0, slots=10)
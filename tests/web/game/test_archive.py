@@ -0,0 +1,183 @@
+import json
+import uuid
+
+import pytest
+import redis
+import MySQLdb
+
+from kfchess.archive_file import ArchiveWriter, ArchiveReader
+from web.game.archive import GameArchiver, game_row, insert_games_query, COLUMNS
+from web.ratings import Leaderboard
+
+class FakeConnection():
+    """ Records committed inserts and user ratings, failing as told by errors (a list of
+    exceptions or None, one per statement). """
+
+    def __init__(self, errors=None, ratings=None):
+        self.errors    = errors or []
+        self.committed = []
+        self.archived  = set()
+        self.ratings   = ratings or {}
+        self._pending  = []
+        self._result   = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args):
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        if query.startswith("SELECT `game_id`"):
+            self._result = [(game_id, ) for game_id in args if game_id in self.archived]
+        elif query.startswith("SELECT `user_id`"):
+            self._result = [(user_id, self.ratings[user_id]) for user_id in args if user_id in self.ratings]
+        elif query.startswith("UPDATE"):
+            count = len(args) // 3
+            self._pending.append(("ratings", dict(zip(args[:count * 2:2], args[1:count * 2:2]))))
+        else:
+            rows = [dict(zip(COLUMNS, args[i:i + len(COLUMNS)])) for i in range(0, len(args), len(COLUMNS))]
+            self._pending.append(("games", rows))
+
+    def fetchall(self):
+        return self._result
+
+    def commit(self):
+        for kind, data in self._pending:
+            if kind == "games":
+                self.committed.append(data)
+                self.archived.update(row["game_id"] for row in data)
+            else:
+                self.ratings.update(data)
+        self._pending = []
+
+    def rollback(self):
+        self._pending = []
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def db():
+    return redis.StrictRedis()
+
+@pytest.fixture
+def queue():
+    return "archive:{}".format(uuid.uuid4())
+
+def record(game_id, state="w_wins", white="1", black="2"):
+    return json.dumps({"game_id": game_id, "white": white, "black": black, "state": state,
+                       "nfen": "8/8/8/8/8/8/8/K7 - 12", "history": ["e2e4@100", "d7d5@250"],
+                       "start_time": 1500000000000, "end_time": 1500000060000})
+
+def archiver(db, queue, conn, **kwargs):
+    return GameArchiver(db, queue, lambda: conn, backoff=1, **kwargs)
+
+def test_game_row():
+    row = game_row(json.loads(record(5, "b_wins")))
+    assert row["game_id"] == 5
+    assert row["winner"] == "BLACK" and row["state"] == "DONE"
+    assert row["history"] == "e2e4@100 d7d5@250"
+    assert row["duration"] == 60000
+    assert row["started_on"].year == 2017
+
+def test_game_row_bots():
+    row = game_row(json.loads(record(5, black="bot:3:1f2e")))
+    assert (row["white_user_id"], row["black_user_id"]) == (1, None)
+
+def test_insert_games_query():
+    query = insert_games_query(3)
+    assert query.count("({})".format(", ".join(["%s"] * len(COLUMNS)))) == 3
+    assert "ON DUPLICATE KEY UPDATE" in query
+
+def test_archive_batches(db, queue):
+    conn = FakeConnection()
+    a = archiver(db, queue, conn, batch_size=2)
+    for game_id in range(3):
+        db.lpush(queue, record(game_id))
+    assert a.archive_batch() == 2
+    assert a.archive_batch() == 1
+    assert [[row["game_id"] for row in rows] for rows in conn.committed] == [[0, 1], [2]]
+    assert not db.exists(queue) and not db.exists(queue + ":processing")
+    assert a.archive_batch(timeout=1) == 0
+
+def test_archive_to_file(db, queue, tmpdir):
+    path = str(tmpdir.join("games"))
+    a = archiver(db, queue, FakeConnection(), archive_file=ArchiveWriter(path))
+    db.lpush(queue, record(1))
+    db.lpush(queue, "not json")
+    db.lpush(queue, record(2, "b_wins"))
+    assert a.archive_batch() == 3
+    with ArchiveReader(path) as archive:
+        assert [(g.game_id, g.state) for g in archive.scan()] == [(1, "w_wins"), (2, "b_wins")]
+        assert archive.get(2).history == ["e2e4@100", "d7d5@250"]
+
+def test_archive_to_file_inserted_only(db, queue, tmpdir):
+    path = str(tmpdir.join("games"))
+    # the batch insert fails, then game 1 goes in (select, select, insert) and game 2 fails
+    conn = FakeConnection([None, None, MySQLdb.IntegrityError(), None, None, None, None, None, MySQLdb.IntegrityError()])
+    a = archiver(db, queue, conn, archive_file=ArchiveWriter(path))
+    db.lpush(queue, record(1))
+    db.lpush(queue, record(2))
+    a.archive_batch()
+    # written again after a crash before the processing list was dropped
+    db.lpush(queue + ":processing", record(1))
+    db.lpush(queue + ":processing", record(3))
+    db.lpush(queue + ":processing", record(3))
+    a.archive_batch()
+    assert a.archived == 2  # not counting 1 again
+    with ArchiveReader(path) as archive:
+        assert list(archive.ids()) == [1, 3]
+
+def test_archive_bot_games(db, queue):
+    conn = FakeConnection(ratings={"1": 1500})
+    a = archiver(db, queue, conn)
+    db.lpush(queue, record(1, white="bot:1:ab12"))
+    db.lpush(queue, record(2, "b_wins", black="bot:2:cd34"))
+    a.archive_batch()
+    rows = conn.committed[0]
+    assert [(row["white_user_id"], row["black_user_id"]) for row in rows] == [(None, 2), (1, None)]
+    assert rows[1]["white_rating"] is None  # bots aren't rated
+    assert (a.archived, a.failed) == (2, 0)
+
+def test_archive_retries(db, queue):
+    conn = FakeConnection([MySQLdb.OperationalError(), MySQLdb.OperationalError()])
+    a = archiver(db, queue, conn, retries=1)
+    db.lpush(queue, record(1))
+    a.archive_batch()
+    # left for the next batch
+    assert conn.committed == [] and db.llen(queue + ":processing") == 1
+    a.archive_batch()
+    assert [rows[0]["game_id"] for rows in conn.committed] == [1]
+    assert not db.exists(queue + ":processing")
+
+def test_archive_bad_games(db, queue):
+    # the batch insert fails, then game 1 goes in (select, select, insert) and game 2 fails
+    conn = FakeConnection([None, None, MySQLdb.IntegrityError(), None, None, None, None, None, MySQLdb.IntegrityError()])
+    a = archiver(db, queue, conn)
+    db.lpush(queue, record(1))
+    db.lpush(queue, record(2))
+    db.lpush(queue, "not json")
+    a.archive_batch()
+    assert [rows[0]["game_id"] for rows in conn.committed] == [1]
+    assert (a.archived, a.failed) == (1, 2)
+    assert db.llen(queue + ":failed") == 2
+
+def test_archive_rates_players(db, queue):
+    conn = FakeConnection(ratings={"1": 1500, "2": None})
+    leaderboard = Leaderboard(db, queue + ":leaderboard")
+    a = archiver(db, queue, conn, leaderboard=leaderboard)
+    db.lpush(queue, record(1, "w_wins"))
+    db.lpush(queue, record(2, "b_wins"))
+    a.archive_batch()
+    rows = conn.committed[0]
+    assert (rows[0]["white_rating"], rows[0]["black_rating"]) == (1500, 1500)
+    assert (rows[1]["white_rating"], rows[1]["black_rating"]) == (1516, 1484)
+    assert conn.ratings["1"] < 1516 and conn.ratings["2"] > 1484
+    assert leaderboard.top(1)[0][0] == "2"  # beat the stronger player
+
+    # archived again after a crash, not rated twice
+    ratings = dict(conn.ratings)
+    db.lpush(queue + ":processing", record(1, "w_wins"))
+    a.archive_batch()
+    assert conn.ratings == ratings
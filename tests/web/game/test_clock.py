@@ -0,0 +1,38 @@
+import pytest
+
+from web.game.clock import ClockOffsets
+
+def test_clock_offset_sample():
+    clocks = ClockOffsets()
+    assert clocks.estimate("a") is None
+    # client is 100ms behind the server, 10ms each way, 2ms at the server
+    clocks.sample("a", 1000, 1110, 1112, 1022)
+    assert clocks.estimate("a") == (100, 20)
+
+def test_clock_offset_prefers_lowest_rtt():
+    clocks = ClockOffsets(samples=3)
+    clocks.sample("a", 1000, 1150, 1150, 1100)  # slow way in, offset is off
+    clocks.sample("a", 2000, 2110, 2110, 2020)
+    clocks.sample("a", 3000, 3100, 3100, 3060)  # slow way back
+    assert clocks.estimate("a") == (100, 20)
+
+    # old samples are forgotten
+    for t in range(4000, 7000, 1000):
+        clocks.sample("a", t, t + 60, t + 60, t + 40)
+    assert clocks.estimate("a") == (40, 40)
+
+def test_clock_offset_ignores_bad_samples():
+    clocks = ClockOffsets()
+    clocks.sample("a", 1000, 1110, 1100, 1022)  # server sent before receiving
+    clocks.sample("a", 1000, 1000, 1100, 1022)  # negative round trip
+    assert clocks.estimate("a") is None
+    with pytest.raises(ValueError):
+        clocks.sample("a", "x", 1, 2, 3)
+
+def test_clock_offset_drop():
+    clocks = ClockOffsets()
+    clocks.sample("a", 1000, 1110, 1112, 1022)
+    assert len(clocks) == 1
+    clocks.drop("a")
+    clocks.drop("b")
+    assert len(clocks) == 0
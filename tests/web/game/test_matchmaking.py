@@ -0,0 +1,83 @@
+import json
+import time
+import uuid
+
+import pytest
+import redis
+
+from web.game.matchmaking import Matchmaker
+
+@pytest.fixture
+def db():
+    return redis.StrictRedis()
+
+@pytest.fixture
+def mm(db):
+    key = "mm:{}".format(uuid.uuid4())
+    return Matchmaker(db, key, key + ":reqs", key + ":cnfs", key + ":game_id", [1000, 10000],
+                      window=50, widen=100, widen_interval=100, max_window=250)
+
+def reqs(db, mm):
+    return [json.loads(r) for r in db.lrange(mm._in, 0, -1)]
+
+def inds(db, mm):
+    return [json.loads(r) for r in db.lrange(mm._cnfs, 0, -1)]
+
+def test_window_widens(mm):
+    assert [mm.window(t) for t in (0, 99, 100, 250, 10000)] == [50, 50, 150, 250, 250]
+
+def test_enqueue_invalid_cd(mm):
+    assert not mm.enqueue("1", 1500, 3000)
+    assert mm.waiting() == 0
+
+def test_pairs_closest_players(db, mm):
+    mm.enqueue("1", 1500, 1000)
+    mm.enqueue("2", 1700, 1000)
+    mm.enqueue("3", 1530, 1000)
+    mm.enqueue("4", 1510, 10000)  # different cd
+    mm.match_due()
+    assert mm.matches == 1
+    assert mm.waiting() == 2
+
+    game_req, join_req = reqs(db, mm)
+    assert game_req[2] == "game-req" and join_req[2] == "join-req"
+    assert game_req[0] == join_req[0] == int(db.get(mm._game_id))
+    assert game_req[3]["cd"] == 1000
+    assert {game_req[1], join_req[1]} == {"1", "3"}
+
+    ind = {i[1]: i[3] for i in inds(db, mm)}
+    assert set(ind) == {"1", "3"}
+    assert {ind["1"]["color"], ind["3"]["color"]} == {"w", "b"}
+    assert ind["1"]["game_id"] == game_req[0]
+
+def test_widening_pairs_far_players(db, mm):
+    mm.enqueue("1", 1500, 1000)
+    mm.enqueue("2", 1700, 1000)
+    mm.match_due()
+    assert mm.matches == 0
+    # not looked at again until their window widens
+    attempts = mm.attempts
+    mm.match_due()
+    assert mm.attempts == attempts
+    time.sleep(0.25)
+    mm.match_due()
+    assert mm.matches == 1
+    assert mm.waiting() == 0
+
+def test_cancel(db, mm):
+    mm.enqueue("1", 1500, 1000, sid="a")
+    mm.cancel("1", sid="b")  # other socket of the player
+    assert mm.waiting() == 1
+    mm.cancel("1", sid="a")
+    mm.enqueue("2", 1500, 1000)
+    mm.match_due()
+    assert mm.matches == 0
+    assert mm.waiting() == 1
+
+def test_requeue_moves_cd(db, mm):
+    mm.enqueue("1", 1500, 1000)
+    mm.enqueue("1", 1500, 10000)
+    mm.enqueue("2", 1500, 1000)
+    mm.match_due()
+    assert mm.matches == 0
+    assert db.zcard(mm.cd_key(1000)) == 1
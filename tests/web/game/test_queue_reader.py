@@ -12,7 +12,9 @@ import redis
 from flask_socketio import SocketIO, join_room, send
 
 from web import create_app
-from web.game.queue_reader import poll_game_cnfs, FAIL, SUCCESS
+from web.game.queue_reader import poll_game_cnfs, poll_game_channels, GameChannels, FAIL, SUCCESS
+from web.game.tracing import Tracer
+from kfchess.redis_games_manager import game_channel
 
 def get_client(env):
     client = env.socketio.test_client(env.app)
@@ -96,3 +98,101 @@ def test_poll_sends_bad_move_to_player(env):
     b_received = b_client.get_received('/game')
     assert len(w_received) == 1 and len(b_received) == 0
     assert w_received[0]['args'][0] == {"result": FAIL, "reason": "illegal move"}
+
+def test_poll_skips_malformed_cnfs(env):
+    client = get_client(env)
+    gid = 1
+    client.emit("join", gid)
+    time.sleep(0.01)
+
+    env.db.rpush(env.q, "not json")
+    env.db.rpush(env.q, json.dumps([-1, "exit-cnf"]))
+    env.db.rpush(env.q, json.dumps([gid, 2, "move-cnf", {"state": "playing", "move": "test"}]))
+    env.db.expire(env.q, 10)
+    time.sleep(0.1)
+
+    received = client.get_received('/game')
+    assert len(received) == 1
+    assert received[0]['args'][0]["move"] == "test"
+
+def test_game_channels_subscriptions(env):
+    channels = GameChannels(env.db, env.q)
+    channels.subscribe(1, "sid1")
+    channels.subscribe(1, "sid2")
+    channels.subscribe(2, "sid2")
+    assert channels.games == {1, 2}
+    channels.unsubscribe("sid2")
+    assert channels.games == {1}
+    channels.unsubscribe("sid1")
+    assert channels.games == set()
+
+def test_poll_channels_emits_game_cnfs(env):
+    channels = GameChannels(env.db, env.q)
+    t = Thread(target=poll_game_channels, args=(channels, env.db, "test_store", env.socketio))
+    t.daemon = True
+    t.start()
+
+    client = get_client(env)
+    gid = 1
+    client.emit("join", gid)
+    channels.subscribe(gid, "sid")
+    time.sleep(0.01)
+
+    env.db.publish(game_channel(env.q, gid), json.dumps([gid, 2, "move-cnf", {"state": "playing", "move": "test"}]))
+    env.db.publish(game_channel(env.q, gid + 1), json.dumps([gid + 1, 2, "move-cnf", {"state": "playing", "move": "x"}]))
+    time.sleep(0.1)
+
+    received = client.get_received('/game')
+    assert len(received) == 1
+    assert received[0]['args'][0] == {"result": SUCCESS, "move": "test"}
+
+def test_poll_coalesces_moves_of_game(env):
+    client = get_client(env)
+    gid = 1
+    client.emit("join", gid)
+    time.sleep(0.01)
+
+    pipe = env.db.pipeline()
+    for sq in ["e4", "d4", "c4"]:
+        pipe.rpush(env.q, json.dumps([gid, 2, "move-cnf", {"state": "playing", "move": {"from": "a1", "to": sq}}]))
+    pipe.expire(env.q, 10)
+    pipe.execute()
+    time.sleep(0.1)
+
+    received = client.get_received('/game')
+    assert len(received) == 1
+    assert received[0]['name'] == 'move-cnf-batch'
+    assert [m["to"] for m in received[0]['args'][0]["moves"]] == ["e4", "d4", "c4"]
+
+def test_poll_updates_lobby_sets(env):
+    store = "test_store:{}".format(uuid.uuid4())
+    t = Thread(target=poll_game_cnfs, args=(env.db, store, env.q + ":lobby", env.socketio))
+    t.daemon = True
+    t.start()
+
+    env.db.rpush(env.q + ":lobby", json.dumps([7, 2, "game-cnf", {"state": "waiting"}]))
+    env.db.rpush(env.q + ":lobby", json.dumps([7, 3, "join-cnf", {"state": "playing"}]))
+    env.db.expire(env.q + ":lobby", 10)
+    time.sleep(0.1)
+
+    assert not env.db.sismember("{}:waiting".format(store), 7)
+    assert env.db.sismember("{}:playing".format(store), 7)
+
+    env.db.rpush(env.q + ":lobby", json.dumps(["7", -1, "expire-ind", {"state": "playing"}]))
+    time.sleep(0.1)
+    assert not env.db.sismember("{}:playing".format(store), 7)
+
+def test_poll_records_traces(env):
+    tracer = Tracer(1)
+    q = env.q + ":traced"
+    t = Thread(target=poll_game_cnfs, args=(env.db, "test_store", q, env.socketio), kwargs={"tracer": tracer})
+    t.daemon = True
+    t.start()
+
+    trace = {"trace": "a", "t": 1, "start": 2, "end": 3}
+    env.db.rpush(q, json.dumps([1, 2, "move-cnf", {"state": "playing", "move": "test"}, trace]))
+    env.db.rpush(q, json.dumps([1, 2, "move-cnf", {"state": "playing", "move": "test"}]))
+    env.db.expire(q, 10)
+    time.sleep(0.1)
+
+    assert tracer.traced == 1
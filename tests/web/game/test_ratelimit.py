@@ -0,0 +1,69 @@
+import uuid
+
+import pytest
+import redis
+
+from web.game.ratelimit import RateLimiter, LocalRateLimiter, RedisRateLimiter, create_limiter
+
+LIMITS = {"move-req": (10, 3)}
+
+def take(limiter, player_id, cmd, time):
+    rate, burst = limiter._limits[cmd]
+    return limiter._take(player_id, cmd, rate, burst, time)
+
+@pytest.fixture
+def shared():
+    return RedisRateLimiter(LIMITS, redis.StrictRedis(), "test:{}".format(uuid.uuid4()))
+
+@pytest.fixture(params=["local", "shared"])
+def limiter(request, shared):
+    if request.param == "local":
+        return LocalRateLimiter(LIMITS)
+    return shared
+
+def test_bucket_burst_and_refill(limiter):
+    assert [take(limiter, "a", "move-req", 1000) for _ in range(4)] == [True, True, True, False]
+    assert take(limiter, "b", "move-req", 1000)
+    # 10 tokens per second, one every 100ms
+    assert not take(limiter, "a", "move-req", 1050)
+    assert take(limiter, "a", "move-req", 1100)
+    assert not take(limiter, "a", "move-req", 1100)
+    # never more than the burst
+    assert [take(limiter, "a", "move-req", 5000) for _ in range(4)] == [True, True, True, False]
+
+def test_bucket_clock_backwards(limiter):
+    for _ in range(3):
+        take(limiter, "a", "move-req", 1000)
+    assert not take(limiter, "a", "move-req", 500)
+
+def test_allow_counts(limiter):
+    for _ in range(5):
+        limiter.allow("a", "move-req")
+    assert limiter.allow("a", "sync-req")
+    assert limiter.allowed == 3
+    assert limiter.throttled == {"move-req": 2}
+    assert limiter.stats() == {"allowed": 3, "throttled": {"move-req": 2}}
+
+def test_shared_throttled_stats(shared):
+    for _ in range(5):
+        shared.allow("a", "move-req")
+    db = redis.StrictRedis()
+    assert db.hget("{}:stats:throttled".format(shared._prefix), "move-req") == b"2"
+
+def test_local_prune():
+    limiter = LocalRateLimiter(LIMITS, prune_every=4)
+    take(limiter, "a", "move-req", 1000)
+    take(limiter, "b", "move-req", 1000)
+    take(limiter, "b", "move-req", 1000)
+    assert len(limiter) == 2
+    # a is full again after 100ms, b after 200ms
+    take(limiter, "c", "move-req", 1150)
+    assert len(limiter) == 2
+
+def test_create_limiter():
+    assert isinstance(create_limiter(LIMITS), LocalRateLimiter)
+    assert isinstance(create_limiter(LIMITS, True, redis.StrictRedis(), "test"), RedisRateLimiter)
+
+def test_rate_limiter_is_abstract():
+    with pytest.raises(TypeError):
+        RateLimiter({})
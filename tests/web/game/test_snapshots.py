@@ -0,0 +1,54 @@
+import json
+import uuid
+
+import pytest
+import redis
+
+from kfchess.redis_games_manager import snapshot_key
+from web.game.snapshots import SnapshotCache
+
+@pytest.fixture
+def db():
+    return redis.StrictRedis()
+
+@pytest.fixture
+def cnfs():
+    return "cnfs:{}".format(uuid.uuid4())
+
+def publish(db, cnfs, game_id, data):
+    key = snapshot_key(cnfs, game_id)
+    db.hincrby(key, "version", 1)
+    db.hset(key, "data", json.dumps(data))
+    db.expire(key, 10)
+
+def test_snapshot_cache_missing(db, cnfs):
+    cache = SnapshotCache(db, cnfs)
+    assert cache.get(1) is None
+
+def test_snapshot_cache_versions(db, cnfs):
+    cache = SnapshotCache(db, cnfs)
+    publish(db, cnfs, 1, {"white": "a", "black": None, "board": {}})
+    assert cache.get(1)["white"] == "a"
+    assert cache.get(1)["white"] == "a"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    publish(db, cnfs, 1, {"white": "a", "black": "b", "board": {}})
+    assert cache.get(1)["black"] == "b"
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_snapshot_cache_get_versioned(db, cnfs):
+    cache = SnapshotCache(db, cnfs)
+    assert cache.get_versioned(1) == (None, None)
+    publish(db, cnfs, 1, {"white": "a", "black": None, "board": {}})
+    publish(db, cnfs, 1, {"white": "a", "black": "b", "board": {}})
+    assert cache.get_versioned(1) == (2, {"white": "a", "black": "b", "board": {}})
+    assert cache.get_versioned(1)[0] == 2 and cache.hits == 1
+
+def test_snapshot_cache_lru(db, cnfs):
+    cache = SnapshotCache(db, cnfs, size=2)
+    for game_id in range(3):
+        publish(db, cnfs, game_id, {"white": game_id, "black": None, "board": {}})
+        cache.get(game_id)
+    assert len(cache) == 2
+    cache.get(0)
+    assert cache.misses == 4
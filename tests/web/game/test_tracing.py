@@ -0,0 +1,31 @@
+import json
+
+from web.game.tracing import Tracer, stages, traced
+
+META = {"trace": "abc", "t": 1000, "start": 1004, "end": 1006, "recv": 1009}
+
+def test_tracing_stages():
+    assert stages(META, 1020) == {"queue": 4, "manager": 2, "delivery": 3, "reader": 11, "total": 20}
+
+def test_tracer_sampling():
+    assert Tracer(0).new_trace() is None
+    assert all(Tracer(1).new_trace() for _ in range(10))
+    traces = [Tracer(0.5).new_trace() for _ in range(1000)]
+    assert 300 < sum(t is not None for t in traces) < 700
+
+def test_tracer_record(tmpdir):
+    path = str(tmpdir.join("traces.jsonl"))
+    tracer = Tracer(1, path, flush_every=2)
+    tracer.record("move-cnf", META, 1020)
+    tracer.record("move-cnf", {"trace": "old", "t": 1000}, 1020)  # not traced by the manager
+    assert tracer.traced == 1
+    assert not tmpdir.join("traces.jsonl").exists()
+    tracer.record("sync-cnf", dict(META, trace="def"), 1030)
+    lines = [json.loads(line) for line in open(path)]
+    assert [(l["trace"], l["cmd"], l["total"]) for l in lines] == [("abc", "move-cnf", 20), ("def", "sync-cnf", 30)]
+    assert tracer.summary()["reader"]["max"] == 21
+
+def test_traced_notes_receive_time():
+    cnf = traced([1, "a", "move-cnf", {}, {"trace": "abc", "t": 1}])
+    assert cnf[4]["recv"] >= 1
+    assert traced([1, "a", "move-cnf", {}]) == [1, "a", "move-cnf", {}]
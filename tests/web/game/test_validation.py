@@ -0,0 +1,99 @@
+from kfchess.game import Square, PLAYING, WAITING, now
+from web.game.validation import MoveGate, nfen_piece
+
+START_NFEN = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 1"
+
+def snapshot(state=PLAYING, times=None):
+    return {
+        "white": "w",
+        "black": "b",
+        "board": {
+            "state": state,
+            "nfen": START_NFEN,
+            "times": times or {},
+            "start_time": now() - 5000,
+            "cd": 1000,
+        },
+    }
+
+class Snapshots():
+    """ Snapshots of game 1, a newer version on every read unless a version is given. """
+
+    def __init__(self, data, version=None):
+        self.data    = data
+        self.version = version or 0
+        self.fixed   = version is not None
+
+    def get_versioned(self, game_id):
+        if game_id != 1:
+            return None, None
+        if not self.fixed:
+            self.version += 1
+        return self.version, self.data
+
+def gate(data):
+    return MoveGate(Snapshots(data))
+
+def test_nfen_piece():
+    assert nfen_piece(START_NFEN, Square.FromSan("a1")) == "R"
+    assert nfen_piece(START_NFEN, Square.FromSan("e8")) == "k"
+    assert nfen_piece(START_NFEN, Square.FromSan("e4")) == "P"
+    assert nfen_piece(START_NFEN, Square.FromSan("e2")) is None
+    assert nfen_piece(START_NFEN, Square.FromSan("d4")) is None
+
+def test_gate_malformed():
+    g = gate(snapshot())
+    for move in [None, {}, {"from": "e2"}, {"from": "z9", "to": "e4"}, {"from": "e4", "to": "e4"},
+                 {"from": 5, "to": "e4"}, {"from": "d2", "to": "d4", "promote": "K"}]:
+        assert g.check(1, "w", move) == "malformed move"
+    assert g.rejected["malformed move"] == 7
+    assert g.stats() == {"passed": 0, "rejected": {"malformed move": 7}}
+
+def test_gate_no_snapshot():
+    g = gate(snapshot())
+    assert g.check(2, "w", {"from": "d7", "to": "d5"}) is None
+    assert g.passed == 1
+
+def test_gate_players():
+    g = gate(snapshot())
+    assert g.check(1, "w", {"from": "d2", "to": "d4"}) is None
+    assert g.check(1, "b", {"from": "d7", "to": "d5"}) is None
+    assert g.check(1, "x", {"from": "d2", "to": "d4"}) == "not a player"
+    assert g.check(1, "w", {"from": "d7", "to": "d5"}) == "not your piece"
+    assert g.check(1, "b", {"from": "d2", "to": "d4"}) == "not your piece"
+    assert g.check(1, "w", {"from": "d4", "to": "d5"}) == "not your piece"
+    assert g.check(1, "w", {"from": "d2", "to": "d4", "promote": None}) is None
+
+def test_gate_state():
+    g = gate(snapshot(state=WAITING))
+    assert g.check(1, "w", {"from": "d2", "to": "d4"}) == "game not playing"
+
+def test_gate_cooldown():
+    g = gate(snapshot(times={"e4": 4500, "g1": 3000}))
+    assert g.check(1, "w", {"from": "e4", "to": "e5"}) == "cooldown"
+    assert g.check(1, "w", {"from": "e4", "to": "e5"}, premove=True) is None
+    assert g.check(1, "w", {"from": "g1", "to": "f3"}) is None
+
+def test_gate_cooldown_slack():
+    # 30ms left on the piece is left to the manager
+    g = MoveGate(Snapshots(snapshot(times={"e4": 3970})), slack=50)
+    assert g.check(1, "w", {"from": "e4", "to": "e5"}) is None
+
+def test_gate_premoves_not_checked_on_board():
+    g = gate(snapshot())
+    # e.g. the piece is still on its way to d4
+    assert g.check(1, "w", {"from": "d4", "to": "d5"}, premove=True) is None
+    assert g.check(1, "b", {"from": "d2", "to": "d4"}, premove=True) is None
+    assert g.check(1, "x", {"from": "d4", "to": "d5"}, premove=True) == "not a player"
+
+def test_gate_stale_snapshot():
+    snapshots = Snapshots(snapshot(), version=3)
+    g = MoveGate(snapshots)
+    assert g.check(1, "w", {"from": "d7", "to": "d5"}) == "not your piece"
+    assert g.check(1, "w", {"from": "e4", "to": "e5"}) is None
+    # e4e5 may not be applied yet, so the board isn't checked (for that player only)
+    assert g.check(1, "w", {"from": "e5", "to": "e6"}) is None
+    assert g.check(1, "b", {"from": "e5", "to": "e6"}) == "not your piece"
+    # the manager published a newer snapshot
+    snapshots.version = 4
+    assert g.check(1, "w", {"from": "e5", "to": "e6"}) == "not your piece"
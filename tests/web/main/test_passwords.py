@@ -0,0 +1,28 @@
+import pytest
+
+from web.main.passwords import PasswordHasher, PasswordsBusy
+
+class FakeBcrypt():
+    def generate_password_hash(self, password):
+        return "hash:" + password
+
+    def check_password_hash(self, pw_hash, password):
+        return pw_hash == "hash:" + password
+
+def test_hasher_runs_in_executor():
+    calls = []
+    def execute(func, *args):
+        calls.append(func)
+        return func(*args)
+    hasher = PasswordHasher(FakeBcrypt(), execute=execute)
+    assert hasher.check(hasher.generate("pw"), "pw")
+    assert not hasher.check(hasher.generate("pw"), "other")
+    assert len(calls) == 4
+    stats = hasher.stats()
+    assert stats["done"] == 4 and stats["running"] == 0 and stats["waiting"] == 0
+
+def test_hasher_bounded_queue():
+    hasher = PasswordHasher(FakeBcrypt(), queue=0)
+    with pytest.raises(PasswordsBusy):
+        hasher.generate("pw")
+    assert hasher.stats()["rejected"] == 1
@@ -0,0 +1,72 @@
+import time
+from contextlib import contextmanager
+
+import web.main.user
+from web.main.user import UserCache, User
+
+def user(user_id, token="t"):
+    return User(user_id, token, "user{}".format(user_id), 1500)
+
+def test_user_cache_get_put():
+    cache = UserCache()
+    assert cache.get(1) is None
+    cache.put(user(1))
+    assert cache.get("1").username == "user1"
+    cache.put(user(1, "new token"))
+    assert cache.get(1).player_token == "new token"
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert cache.stats() == {"size": 0, "hits": 2, "misses": 2}
+
+def test_user_cache_lru():
+    cache = UserCache(size=2)
+    cache.put(user(1))
+    cache.put(user(2))
+    cache.get(1)
+    cache.put(user(3))
+    assert len(cache) == 2
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+
+def test_user_cache_ttl():
+    cache = UserCache(ttl=0.05)
+    cache.put(user(1))
+    assert cache.get(1) is not None
+    time.sleep(0.06)
+    assert cache.get(1) is None
+
+class FakeMySQL():
+    """ Answers user queries from rows, recording the queries. """
+
+    def __init__(self, rows):
+        self.rows    = rows
+        self.queries = []
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self, *args):
+        return self
+
+    def execute(self, query, args):
+        self.queries.append(query)
+        self._result = [row for row in self.rows if str(row["user_id"]) in map(str, args)]
+
+    def fetchall(self):
+        return self._result
+
+def test_user_get_many(monkeypatch):
+    rows = [{"user_id": i, "username": "user{}".format(i), "rating": 1500, "player_token": "t"}
+            for i in (1, 2, 3)]
+    fake = FakeMySQL(rows)
+    monkeypatch.setattr(web.main.user, "mysql", fake)
+    monkeypatch.setattr(web.main.user, "_users", UserCache())
+    web.main.user._users.put(user(1))
+
+    users = User.get_many(["1", "2", "3", "4"])
+    assert sorted(users) == ["1", "2", "3"] and users["3"].username == "user3"
+    assert len(fake.queries) == 1 and fake.queries[0].count("%s") == 3  # 1 was cached
+    assert User.get_many(["2", "3"])["2"].username == "user2"
+    assert len(fake.queries) == 1
@@ -0,0 +1,36 @@
+import eventlet
+from eventlet import patcher
+
+from web.hubwatch import HubWatch, Histogram
+
+blocking_sleep = patcher.original("time").sleep
+
+def test_histogram():
+    hist = Histogram([10, 100])
+    for value in [1, 5, 50, 500]:
+        hist.record(value)
+    assert hist.counts == [2, 1, 1]
+    assert hist.percentile(50) == 10
+    assert hist.percentile(99) == 500
+    assert hist.to_dict()["buckets"] == {"<=10": 2, "<=100": 1, ">100": 1}
+    assert Histogram().percentile(50) == 0
+
+def block_the_hub():
+    blocking_sleep(0.2)
+
+def test_hub_watch_reports_blocking_greenlets():
+    watch = HubWatch(threshold=50, interval=10)
+    watch.start()
+    try:
+        eventlet.sleep(0.05)
+        eventlet.spawn(block_the_hub).wait()
+        eventlet.sleep(0.05)
+    finally:
+        watch.stop()
+
+    report = watch.report()
+    assert report["lag"]["max"] >= 100
+    assert report["runs"]["count"] > 0
+    slow = report["slow"][0]
+    assert slow["blocked"] and slow["max"] >= 200
+    assert slow["stack"][-1].endswith("in block_the_hub")
@@ -0,0 +1,65 @@
+import pytest
+import MySQLdb
+
+from web.mysql_pool import MySQLPool, PoolTimeout
+
+class FakeConnection():
+    def __init__(self):
+        self.rollbacks = 0
+        self.pings     = 0
+        self.closed    = False
+        self.broken    = False
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def ping(self):
+        self.pings += 1
+        if self.broken:
+            raise MySQLdb.OperationalError()
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def pool():
+    p = MySQLPool()
+    p.configure(FakeConnection, size=2, timeout=0.01)
+    return p
+
+def test_pool_reuses_connections(pool):
+    with pool.connection() as c1:
+        pass
+    with pool.connection() as c2:
+        assert c2 is c1
+    assert pool.opened == 1
+    assert c1.rollbacks == 2
+
+def test_pool_bounded(pool):
+    with pool.connection() as c1:
+        with pool.connection() as c2:
+            assert c1 is not c2
+            with pytest.raises(PoolTimeout):
+                with pool.connection():
+                    pass
+    assert pool.timeouts == 1
+    assert len(pool) == 2
+
+def test_pool_discards_broken_connections(pool):
+    with pytest.raises(MySQLdb.OperationalError):
+        with pool.connection() as c1:
+            raise MySQLdb.OperationalError()
+    assert c1.closed
+    assert len(pool) == 0
+    with pool.connection():
+        with pool.connection():
+            pass  # both slots are free again
+
+def test_pool_pings_idle_connections(pool):
+    pool.configure(FakeConnection, size=2, timeout=0.01, ping_idle=0)
+    with pool.connection() as c1:
+        pass
+    c1.broken = True
+    with pool.connection() as c2:
+        assert c2 is not c1
+    assert c1.pings == 1 and c1.closed
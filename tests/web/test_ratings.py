@@ -0,0 +1,39 @@
+import uuid
+
+import pytest
+import redis
+
+from web.ratings import expected_score, rate, replay, update_ratings_query, Leaderboard
+
+def test_expected_score():
+    assert expected_score(1500, 1500) == 0.5
+    assert round(expected_score(1900, 1500), 2) == 0.91
+    assert expected_score(1500, 1700) + expected_score(1700, 1500) == pytest.approx(1)
+
+def test_rate():
+    assert rate(1500, 1500, 1) == (1516, 1484)
+    assert rate(1500, 1500, 0.5) == (1500, 1500)
+    white, black = rate(1700, 1500, 0, k=20)
+    assert white + black == pytest.approx(3200)
+    assert 1700 - white > 10
+
+def test_replay_matches_rate():
+    games = [("a", "b", 1), ("b", "c", 0), ("c", "a", 0.5), ("a", "b", 0)]
+    ratings = {p: 1500 for p in "abc"}
+    for white, black, score in games:
+        ratings[white], ratings[black] = rate(ratings[white], ratings[black], score)
+    assert replay(games) == pytest.approx(ratings)
+
+def test_update_ratings_query():
+    assert update_ratings_query(2).count("WHEN %s THEN %s") == 2
+
+def test_leaderboard():
+    db = redis.StrictRedis()
+    board = Leaderboard(db, "leaderboard:{}".format(uuid.uuid4()))
+    board.update({"1": 1500.4, "2": 1600, "3": 1400})
+    assert board.top(2) == [("2", 1600), ("1", 1500)]
+    assert board.rank("3") == 3 and board.rank("4") is None
+    board.replace({"4": 1450})
+    assert board.top() == [("4", 1450)]
+    board.replace({})
+    assert board.top() == []